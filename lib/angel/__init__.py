@@ -26,9 +26,14 @@ import angel.exceptions
 import angel.settings
 import angel.settings.defaults
 import angel.versions
-from angel.util.pidfile import get_only_running_pids, is_any_pid_running
+from angel.util.pidfile import get_only_running_pids, is_any_pid_running, is_pid_in_pidfile_running
+import angel.util.checksum
+import angel.util.dedup_files
 import angel.util.file
+import angel.util.io_governor
 import angel.util.terminal
+import angel.util.trash
+import angel.util.tree_manifest
 
 import devops.process_helpers
 import devops.file_and_dir_helpers
@@ -64,7 +69,7 @@ class Angel():
         if os.path.isfile(os.path.join(self._get_angel_dir(), "versions_dir")):
             try:
                 versions_dir = open(os.path.join(self._get_angel_dir(), "versions_dir")).read().rstrip()
-                self._angel_version_manager = angel.versions.AngelVersionManager(versions_dir)
+                self._angel_version_manager = angel.versions.AngelVersionManager(versions_dir, io_limits=self._get_version_io_limits())
             except Exception as e:
                 print >>sys.stderr, "Warning: can't create angel version manager (%s)." % e
 
@@ -86,6 +91,19 @@ class Angel():
         return os.path.join(self._project_base_dir, ".angel")
 
 
+    def _get_version_io_limits(self):
+        """Return the IOGovernor options for version installs, deletes and dedup work, from VERSION_IO_* settings."""
+        io_limits = {}
+        for (setting_name, option_name) in (('VERSION_IO_BYTES_PER_SECOND', 'bytes_per_second'),
+                                            ('VERSION_IO_OPS_PER_SECOND', 'ops_per_second'),
+                                            ('VERSION_IO_MAX_LOADAVG', 'max_loadavg'),
+                                            ('VERSION_IO_MAX_IO_PRESSURE', 'max_io_pressure'),
+                                            ('VERSION_IO_IONICE_CLASS', 'ionice_class')):
+            if setting_name in self._settings and self._settings[setting_name] is not None:
+                io_limits[option_name] = self._settings[setting_name]
+        return io_limits
+
+
     def get_settings(self):
         """Return the settings object loaded at init time."""
         return self._settings
@@ -419,6 +437,18 @@ class Angel():
                             "description": "hard kill services without waiting for any in-progress work to be finished"
                         }
                     }
+                },
+                "trash": {
+                    "description": "manage files waiting to be deleted in the background (old versions and tmp files)",
+                    "commands": {
+                        "empty": {
+                            "description": "delete everything in the trash now",
+                            "label": "empty [--max-seconds <seconds>] [--sleep-ratio <ratio>]"
+                        },
+                        "status": {
+                            "description": "show the entries, inodes and bytes waiting to be deleted"
+                        }
+                    }
                 }
             }
         }
@@ -578,13 +608,190 @@ class Angel():
                         }
                     }
                 },
+                "add-from-manifest": {
+                    "description": "<versions-dir> <checksum-file> <blob-dir|-> <branch> <version>: install a version from its checksum file, copying in only new files from a dir of checksum-named files (or a tarball of them on stdin); with a <checksum-file>.tree tree manifest, only files that differ from an installed version are looked for",
+                    "options": {
+                        "--sleep-ratio": {
+                            "label": "--sleep-ratio <ratio>",
+                            "description": "ratio of sleep-to-work, for throttling installs on loaded systems (default is 0.1)"
+                        }
+                    }
+                },
                 "add-version": {
-                    "description": "<versions-dir> <path-to-src> <branch> <version>"
+                    "description": "<versions-dir> <path-to-src> <branch> <version>, or with --from-git: <versions-dir> <branch> <version>",
+                    "options": {
+                        "--algorithm": {
+                            "label": "--algorithm <name>",
+                            "description": "checksum algorithm for files not listed in the version's checksum file (default is md5; \"git\" takes committed files' ids from a git checkout without reading them)"
+                        },
+                        "--from-git": {
+                            "label": "--from-git <repo> <ref>",
+                            "description": "install the tree at the given ref of a git repo, streaming new files straight from git without a checkout"
+                        },
+                        "--link-workers": {
+                            "label": "--link-workers <n>",
+                            "description": "number of threads to use for linking files into the new version (defaults to one per cpu, up to 8)"
+                        },
+                        "--sleep-ratio": {
+                            "label": "--sleep-ratio <ratio>",
+                            "description": "ratio of sleep-to-work, for throttling installs on loaded systems (default is 0.1)"
+                        },
+                        "--verify-checksums": {
+                            "description": "re-hash all files instead of trusting the checksum index for unchanged files"
+                        },
+                        "--workers": {
+                            "label": "--workers <n>",
+                            "description": "number of processes to use for checksumming files (defaults to one per cpu)"
+                        }
+                    }
                 },
                 "check-version": {
                     "label": "--version <version> [--branch <branch>]",
                     "description": "check if given version is installed and available"
                 },
+                "dedup": {
+                    "description": "hardlink identical files across installed versions that don't already share a dedup file",
+                    "options": {
+                        "--sleep-ratio": {
+                            "label": "--sleep-ratio <ratio>",
+                            "description": "ratio of sleep-to-work, for throttling on loaded systems (default is 0.5)"
+                        }
+                    }
+                },
+                "diff": {
+                    "label": "<version|checksum-file> <version|checksum-file> [--branch <branch>] [--files]",
+                    "description": "show what installing the second version would add, remove and change relative to the first, from their checksum files (comparing only the dirs that differ when both have tree manifests)",
+                    "options": {
+                        "--branch": {
+                            "label": "--branch <branch>",
+                            "description": "branch of the given versions (defaults to the current branch)"
+                        },
+                        "--files": {
+                            "description": "list added (A), removed (D) and changed (M) files"
+                        }
+                    }
+                },
+                "fsck": {
+                    "description": "re-hash dedup files to check they still match their checksums, quarantining bad ones and listing the versions that use them",
+                    "options": {
+                        "--max-seconds": {
+                            "label": "--max-seconds <seconds>",
+                            "description": "stop after N seconds; re-run to continue where it left off"
+                        },
+                        "--sample": {
+                            "label": "--sample <ratio>",
+                            "description": "only check a random sample of the given fraction (0 to 1) of the dedup files"
+                        },
+                        "--sleep-ratio": {
+                            "label": "--sleep-ratio <ratio>",
+                            "description": "ratio of sleep-to-work, for throttling on loaded systems (default is 0.5)"
+                        },
+                        "--workers": {
+                            "label": "--workers <n>",
+                            "description": "number of processes to use for checksumming files (defaults to one per cpu)"
+                        }
+                    }
+                },
+                "gc": {
+                    "description": "remove dedup files that no installed version uses (deleting a version already does this for its files)",
+                    "options": {
+                        "--max-seconds": {
+                            "label": "--max-seconds <seconds>",
+                            "description": "stop after N seconds; re-run to continue where it left off"
+                        },
+                        "--sleep-ratio": {
+                            "label": "--sleep-ratio <ratio>",
+                            "description": "ratio of sleep-to-work, for throttling on loaded systems (default is 0.5)"
+                        }
+                    }
+                },
+                "migrate-checksums": {
+                    "label": "migrate-checksums <algorithm>",
+                    "description": "rename md5-based dedup files to use a faster checksum algorithm (old manifests keep working)",
+                    "options": {
+                        "--max-seconds": {
+                            "label": "--max-seconds <seconds>",
+                            "description": "stop after N seconds; re-run to continue where it left off"
+                        },
+                        "--sleep-ratio": {
+                            "label": "--sleep-ratio <ratio>",
+                            "description": "ratio of sleep-to-work, for throttling on loaded systems (default is 0.5)"
+                        }
+                    }
+                },
+                "migrate-dedup-layout": {
+                    "description": "move dedup files into fan-out subdirs, for faster lookups on large installs (safe to run while in use)",
+                    "options": {
+                        "--max-seconds": {
+                            "label": "--max-seconds <seconds>",
+                            "description": "stop after N seconds; re-run to continue where it left off"
+                        },
+                        "--sleep-ratio": {
+                            "label": "--sleep-ratio <ratio>",
+                            "description": "ratio of sleep-to-work, for throttling on loaded systems (default is 0.5)"
+                        }
+                    }
+                },
+                "pack": {
+                    "label": "<version> [--base <version>] [--branch <branch>] [--output <file>]",
+                    "description": "write a version pack -- the version's checksum file plus only the files that the base version doesn't have -- to stdout or a file",
+                    "options": {
+                        "--base": {
+                            "label": "--base <version>",
+                            "description": "leave out files that the given version, installed on the receiving host, already has"
+                        },
+                        "--branch": {
+                            "label": "--branch <branch>",
+                            "description": "branch of the given versions (defaults to the current branch)"
+                        },
+                        "--output": {
+                            "label": "--output <file>",
+                            "description": "write the pack to the given file instead of stdout"
+                        }
+                    }
+                },
+                "prewarm": {
+                    "label": "<version> [--branch <branch>] [--bytes <n>]",
+                    "description": "pull the files that running services use into the page cache from the given version",
+                    "options": {
+                        "--branch": {
+                            "label": "--branch <branch>",
+                            "description": "branch of the given version (defaults to the current branch)"
+                        },
+                        "--bytes": {
+                            "label": "--bytes <n>",
+                            "description": "maximum bytes to read (defaults to the VERSION_PREWARM_BYTES setting)"
+                        }
+                    }
+                },
+                "space": {
+                    "label": "[--keep <n>]",
+                    "description": "show the disk space each version uses by itself, shares with other versions and would free if deleted (from manifests; trees aren't walked)",
+                    "options": {
+                        "--keep": {
+                            "label": "--keep <n>",
+                            "description": "number of newest versions per branch that aren't purge candidates (defaults to the SYSTEM_INSTALLED_VERSIONS_TO_KEEP setting)"
+                        }
+                    }
+                },
+                "unpack": {
+                    "label": "[<pack-file>] [--branch <branch>] [--version <version>] [--sleep-ratio <ratio>]",
+                    "description": "install a version from a version pack read from stdin (or a file), streaming its files straight into the dedup dir",
+                    "options": {
+                        "--branch": {
+                            "label": "--branch <branch>",
+                            "description": "install as the given branch instead of the one recorded in the pack"
+                        },
+                        "--sleep-ratio": {
+                            "label": "--sleep-ratio <ratio>",
+                            "description": "ratio of sleep-to-work, for throttling installs on loaded systems (default is 0.1)"
+                        },
+                        "--version": {
+                            "label": "--version <version>",
+                            "description": "install as the given version instead of the one recorded in the pack"
+                        }
+                    }
+                },
                 "versions": {
                     "description": "list all locally-available branches and versions"
                 }
@@ -1082,20 +1289,82 @@ class Angel():
                 branch = None
                 version = None
                 sleep_ratio = 0.1
+                workers = None
+                verify_checksums = False
+                algorithm = angel.util.checksum.DEFAULT_CHECKSUM_ALGORITHM
+                git_repo_path = None
+                git_ref = None
+                link_workers = None
                 try:
                     while len(args):
                         if args[0] == "--sleep-ratio":
                             args.pop(0)
                             sleep_ratio = float(args.pop(0))
+                        elif args[0] == "--workers":
+                            args.pop(0)
+                            workers = int(args.pop(0))
+                        elif args[0] == "--verify-checksums":
+                            args.pop(0)
+                            verify_checksums = True
+                        elif args[0] == "--algorithm":
+                            args.pop(0)
+                            algorithm = args.pop(0)
+                        elif args[0] == "--link-workers":
+                            args.pop(0)
+                            link_workers = int(args.pop(0))
+                        elif args[0] == "--from-git":
+                            args.pop(0)
+                            git_repo_path = args.pop(0)
+                            git_ref = args.pop(0)
+                        elif git_repo_path is not None:
+                            versions_dir = args.pop(0)
+                            branch = args.pop(0)
+                            version = args.pop(0)
                         else:
                             versions_dir = args.pop(0)
                             src_path = args.pop(0)
                             branch = args.pop(0)
                             version = args.pop(0)
                 except:
-                    raise angel.exceptions.AngelArgException('<versions dir> <src path> <branch name> <version>')
-                vm = angel.versions.AngelVersionManager(versions_dir)
-                vm.add_version(branch, version, src_path, sleep_ratio=sleep_ratio)
+                    raise angel.exceptions.AngelArgException('<versions dir> <src path> <branch name> <version>, or --from-git <repo> <ref> <versions dir> <branch name> <version>')
+                vm = angel.versions.AngelVersionManager(versions_dir, io_limits=self._get_version_io_limits())
+                if git_repo_path is not None:
+                    vm.add_version_from_git(branch, version, git_repo_path, git_ref, sleep_ratio=sleep_ratio, link_workers=link_workers)
+                    return 0
+                if algorithm not in angel.util.checksum.get_checksum_algorithm_names():
+                    raise angel.exceptions.AngelArgException("unknown checksum algorithm '%s' (available: %s)" %
+                                                             (algorithm, ', '.join(angel.util.checksum.get_checksum_algorithm_names())))
+                vm.add_version(branch, version, src_path, sleep_ratio=sleep_ratio, workers=workers,
+                               verify_checksums=verify_checksums, algorithm=algorithm, link_workers=link_workers)
+                return 0
+
+
+            elif verb == 'add-from-manifest':
+                sleep_ratio = 0.1
+                positional_args = []
+                try:
+                    while len(args):
+                        if args[0] == "--sleep-ratio":
+                            args.pop(0)
+                            sleep_ratio = float(args.pop(0))
+                        else:
+                            positional_args.append(args.pop(0))
+                    (versions_dir, checksum_file, blob_source, branch, version) = positional_args
+                except:
+                    raise angel.exceptions.AngelArgException('<versions dir> <checksum file> <blob dir|-> <branch name> <version>')
+                file_checksums = angel.util.dedup_files.dedup_load_checksum_file(checksum_file)
+                if file_checksums is None:
+                    raise angel.exceptions.AngelArgException("unable to load checksum file '%s'." % checksum_file)
+                tree_manifest = angel.util.tree_manifest.load_tree_manifest(angel.util.tree_manifest.get_tree_manifest_path(checksum_file))
+                vm = angel.versions.AngelVersionManager(versions_dir, io_limits=self._get_version_io_limits())
+                if blob_source == '-':
+                    vm.add_version_from_manifest(branch, version, file_checksums, blob_source_fileobj=sys.stdin, sleep_ratio=sleep_ratio,
+                                                 tree_manifest=tree_manifest)
+                else:
+                    if not os.path.isdir(blob_source):
+                        raise angel.exceptions.AngelArgException("blob dir '%s' doesn't exist." % blob_source)
+                    vm.add_version_from_manifest(branch, version, file_checksums, blob_source_dir=blob_source, sleep_ratio=sleep_ratio,
+                                                 tree_manifest=tree_manifest)
                 return 0
 
 
@@ -1175,7 +1444,9 @@ class Angel():
                     raise angel.exceptions.AngelArgException('Missing version to delete')
                 if branch is None:
                     branch = self.get_project_code_branch()
-                return self._angel_version_manager.delete_version(branch, version)
+                self._angel_version_manager.delete_version(branch, version, in_background=True)
+                self.start_trash_worker()
+                return 0
 
 
             elif verb == 'rollback':
@@ -1304,6 +1575,321 @@ class Angel():
                     raise angel.exceptions.AngelArgException("unknown pinning option '%s'." % action)
 
 
+            elif verb == 'dedup':
+                sleep_ratio = 0.5
+                try:
+                    while len(args):
+                        opt = args.pop(0)
+                        if opt == '--sleep-ratio':
+                            sleep_ratio = float(args.pop(0))
+                        else:
+                            raise angel.exceptions.AngelArgException("unknown option '%s'." % opt)
+                except (IndexError, ValueError):
+                    raise angel.exceptions.AngelArgException('invalid dedup options.')
+                if 0 != self._angel_version_manager.dedup_files(sleep_ratio=sleep_ratio):
+                    return 1
+                return 0
+
+
+            elif verb == 'diff':
+                branch = self.get_project_code_branch()
+                list_files = False
+                targets = []
+                try:
+                    while len(args):
+                        opt = args.pop(0)
+                        if opt == '--branch':
+                            branch = args.pop(0)
+                        elif opt == '--files':
+                            list_files = True
+                        else:
+                            targets.append(opt)
+                    (old_target, new_target) = targets
+                except (IndexError, ValueError):
+                    raise angel.exceptions.AngelArgException('usage: diff <version|checksum-file> <version|checksum-file>')
+
+                for target in (old_target, new_target):
+                    if not os.path.isfile(target) and not self._angel_version_manager.is_version_installed(branch, target):
+                        raise angel.exceptions.AngelArgException("'%s' is neither a checksum file nor an installed version of branch %s." % (target, branch))
+
+                def _load_manifest(target):
+                    if os.path.isfile(target):
+                        checksums = angel.util.dedup_files.dedup_load_checksum_file(target)
+                    else:
+                        checksums = self._angel_version_manager.get_version_manifest(branch, target)
+                    if checksums is None:
+                        raise angel.exceptions.AngelArgException("no checksum file for '%s'." % target)
+                    return checksums
+
+                def _load_tree_manifest(target):
+                    if os.path.isfile(target):
+                        return angel.util.tree_manifest.load_tree_manifest(angel.util.tree_manifest.get_tree_manifest_path(target))
+                    return self._angel_version_manager.get_version_tree_manifest(branch, target)
+
+                # With tree manifests of both sides, only the dirs that differ are read:
+                old_tree_manifest = _load_tree_manifest(old_target)
+                new_tree_manifest = _load_tree_manifest(new_target)
+                if old_tree_manifest is not None and new_tree_manifest is not None:
+                    diff = self._angel_version_manager.diff_versions(None, None, old_tree_manifest=old_tree_manifest,
+                                                                     new_tree_manifest=new_tree_manifest)
+                else:
+                    diff = self._angel_version_manager.diff_versions(_load_manifest(old_target), _load_manifest(new_target))
+                if list_files:
+                    for (flag, key) in (('A', 'added'), ('D', 'removed'), ('M', 'changed')):
+                        for path in diff[key]:
+                            print "%s %s" % (flag, path)
+                print "Added:   %s files" % len(diff['added'])
+                print "Removed: %s files" % len(diff['removed'])
+                print "Changed: %s files" % len(diff['changed'])
+                print "New:     %s bytes in %s files not yet in the dedup dir" % (diff['new_bytes'], diff['new_files'])
+                print "Shared:  %s bytes in %s files already in the dedup dir" % (diff['shared_bytes'], diff['shared_files'])
+                return 0
+
+
+            elif verb == 'fsck':
+                max_seconds = None
+                sample_ratio = None
+                sleep_ratio = 0.5
+                workers = None
+                try:
+                    while len(args):
+                        opt = args.pop(0)
+                        if opt == '--max-seconds':
+                            max_seconds = int(args.pop(0))
+                        elif opt == '--sample':
+                            sample_ratio = float(args.pop(0))
+                        elif opt == '--sleep-ratio':
+                            sleep_ratio = float(args.pop(0))
+                        elif opt == '--workers':
+                            workers = int(args.pop(0))
+                        else:
+                            raise angel.exceptions.AngelArgException("unknown option '%s'." % opt)
+                except (IndexError, ValueError):
+                    raise angel.exceptions.AngelArgException('invalid fsck options.')
+                if sample_ratio is not None and not 0 < sample_ratio <= 1:
+                    raise angel.exceptions.AngelArgException('--sample must be between 0 and 1.')
+                result = self._angel_version_manager.fsck(sample_ratio=sample_ratio, workers=workers, max_seconds=max_seconds,
+                                                          sleep_ratio=sleep_ratio)
+                for name in sorted(result['bad']):
+                    users = ', '.join(['%s %s' % (branch, version) for (branch, version) in result['bad_versions'].get(name, [])])
+                    print "BAD %s (quarantined at %s); used by: %s" % (name, result['bad'][name] or '(not moved)', users or 'no installed versions')
+                megabytes = result['bytes'] / 1048576.0
+                print >>sys.stderr, "Checked %s dedup files (%.1f MB) in %.1f seconds (%.1f MB/s); %s bad%s." % \
+                                    (result['files'], megabytes, result['seconds'], megabytes / max(result['seconds'], 0.001),
+                                     len(result['bad']), '' if result['is_complete'] else ' (incomplete; re-run to continue)')
+                if len(result['bad']):
+                    return 2
+                if not result['is_complete']:
+                    return 1
+                return 0
+
+
+            elif verb == 'gc':
+                max_seconds = None
+                sleep_ratio = 0.5
+                try:
+                    while len(args):
+                        opt = args.pop(0)
+                        if opt == '--max-seconds':
+                            max_seconds = int(args.pop(0))
+                        elif opt == '--sleep-ratio':
+                            sleep_ratio = float(args.pop(0))
+                        else:
+                            raise angel.exceptions.AngelArgException("unknown option '%s'." % opt)
+                except (IndexError, ValueError):
+                    raise angel.exceptions.AngelArgException('invalid gc options.')
+                start_time = time.time()
+                (removed_count, removed_bytes, is_complete) = self._angel_version_manager.remove_unused_dedup_files(max_seconds=max_seconds,
+                                                                                                                   sleep_ratio=sleep_ratio)
+                print >>sys.stderr, "Reclaimed %s bytes from %s unused dedup files in %.1f seconds%s." % \
+                                    (removed_bytes, removed_count, time.time() - start_time,
+                                     '' if is_complete else ' (incomplete; re-run to continue)')
+                if not is_complete:
+                    return 1
+                return 0
+
+
+            elif verb == 'pack':
+                branch = self.get_project_code_branch()
+                base_version = None
+                output_path = None
+                version = None
+                try:
+                    while len(args):
+                        opt = args.pop(0)
+                        if opt == '--branch':
+                            branch = args.pop(0)
+                        elif opt == '--base':
+                            base_version = args.pop(0)
+                        elif opt == '--output':
+                            output_path = args.pop(0)
+                        elif version is None:
+                            version = opt
+                        else:
+                            raise angel.exceptions.AngelArgException("unknown option '%s'." % opt)
+                except IndexError:
+                    raise angel.exceptions.AngelArgException('invalid pack options.')
+                if version is None:
+                    raise angel.exceptions.AngelArgException('usage: pack <version> [--base <version>] [--branch <branch>] [--output <file>]')
+                for v in (version, base_version):
+                    if v is not None and not self._angel_version_manager.is_version_installed(branch, v):
+                        raise angel.exceptions.AngelArgException("branch %s, version %s not installed." % (branch, v))
+                if output_path is None and sys.stdout.isatty():
+                    raise angel.exceptions.AngelArgException("refusing to write a version pack to a terminal; redirect stdout or use --output.")
+                start_time = time.time()
+                if output_path is None:
+                    (blob_count, blob_bytes) = self._angel_version_manager.pack_version(branch, version, sys.stdout, base_version=base_version)
+                    sys.stdout.flush()
+                else:
+                    output_path_tmp = '%s-%s' % (output_path, time.time())
+                    try:
+                        with open(output_path_tmp, 'wb') as f:
+                            (blob_count, blob_bytes) = self._angel_version_manager.pack_version(branch, version, f, base_version=base_version)
+                        os.rename(output_path_tmp, output_path)
+                    finally:
+                        if os.path.exists(output_path_tmp):
+                            os.remove(output_path_tmp)
+                print >>sys.stderr, "Packed branch %s, version %s with %s files (%s bytes) not in %s in %.1f seconds." % \
+                                    (branch, version, blob_count, blob_bytes,
+                                     "version %s" % base_version if base_version else "any base version", time.time() - start_time)
+                return 0
+
+
+            elif verb == 'space':
+                keep_newest_n_versions = self._settings['SYSTEM_INSTALLED_VERSIONS_TO_KEEP']
+                try:
+                    while len(args):
+                        opt = args.pop(0)
+                        if opt == '--keep':
+                            keep_newest_n_versions = int(args.pop(0))
+                        else:
+                            raise angel.exceptions.AngelArgException("unknown option '%s'." % opt)
+                except (IndexError, ValueError):
+                    raise angel.exceptions.AngelArgException('invalid space options.')
+                (versions, candidates_reclaimable_bytes) = self._angel_version_manager.get_space_usage(keep_newest_n_versions=keep_newest_n_versions)
+
+                def _mb(byte_count):
+                    if byte_count is None:
+                        return '-'
+                    return '%.1f' % (byte_count / 1048576.0)
+
+                longest_branch_name_len = max([len("Branch")] + [len(usage['branch']) for usage in versions])
+                longest_version_number = max([len("Version")] + [len(usage['version']) for usage in versions])
+                print "%s  %s  %9s  %10s  %10s  %10s  %14s  %s" % ("Branch".ljust(longest_branch_name_len), "Version".ljust(longest_version_number),
+                                                               "Files", "Total MB", "Unique MB", "Shared MB", "Reclaimable MB", "Notes")
+                for usage in versions:
+                    print "%s  %s  %9s  %10s  %10s  %10s  %14s  %s" % (usage['branch'].ljust(longest_branch_name_len),
+                                                                   usage['version'].ljust(longest_version_number),
+                                                                   usage['files'] if usage['files'] is not None else '-',
+                                                                   _mb(usage['bytes']), _mb(usage['unique_bytes']), _mb(usage['shared_bytes']),
+                                                                   _mb(usage['reclaimable_bytes']),
+                                                                   'purge-candidate' if usage['is_purge_candidate'] else '')
+                print "Deleting all purge candidates would free %s MB." % _mb(candidates_reclaimable_bytes)
+                return 0
+
+
+            elif verb == 'unpack':
+                branch = None
+                version = None
+                sleep_ratio = 0.1
+                pack_path = None
+                try:
+                    while len(args):
+                        opt = args.pop(0)
+                        if opt == '--branch':
+                            branch = args.pop(0)
+                        elif opt == '--version':
+                            version = args.pop(0)
+                        elif opt == '--sleep-ratio':
+                            sleep_ratio = float(args.pop(0))
+                        elif pack_path is None:
+                            pack_path = opt
+                        else:
+                            raise angel.exceptions.AngelArgException("unknown option '%s'." % opt)
+                except (IndexError, ValueError):
+                    raise angel.exceptions.AngelArgException('invalid unpack options.')
+                if pack_path is None or pack_path == '-':
+                    (branch, version) = self._angel_version_manager.unpack_version(sys.stdin, branch=branch, version=version, sleep_ratio=sleep_ratio)
+                else:
+                    with open(pack_path, 'rb') as f:
+                        (branch, version) = self._angel_version_manager.unpack_version(f, branch=branch, version=version, sleep_ratio=sleep_ratio)
+                print >>sys.stderr, "Installed branch %s, version %s." % (branch, version)
+                return 0
+
+
+            elif verb == 'prewarm':
+                branch = self.get_project_code_branch()
+                byte_budget = self._settings['VERSION_PREWARM_BYTES']
+                version = None
+                try:
+                    while len(args):
+                        opt = args.pop(0)
+                        if opt == '--branch':
+                            branch = args.pop(0)
+                        elif opt == '--bytes':
+                            byte_budget = int(args.pop(0))
+                        elif version is None:
+                            version = opt
+                        else:
+                            raise angel.exceptions.AngelArgException("unknown option '%s'." % opt)
+                except (IndexError, ValueError):
+                    raise angel.exceptions.AngelArgException('invalid prewarm options.')
+                if version is None:
+                    raise angel.exceptions.AngelArgException('usage: prewarm <version> [--branch <branch>] [--bytes <n>]')
+                if not self._angel_version_manager.is_version_installed(branch, version):
+                    raise angel.exceptions.AngelArgException("branch %s, version %s not installed." % (branch, version))
+                self._prewarm_version(branch, version, byte_budget)
+                return 0
+
+
+            elif verb == 'migrate-checksums':
+                algorithm = None
+                max_seconds = None
+                sleep_ratio = 0.5
+                try:
+                    while len(args):
+                        opt = args.pop(0)
+                        if opt == '--max-seconds':
+                            max_seconds = int(args.pop(0))
+                        elif opt == '--sleep-ratio':
+                            sleep_ratio = float(args.pop(0))
+                        elif algorithm is None:
+                            algorithm = opt
+                        else:
+                            raise angel.exceptions.AngelArgException("unknown option '%s'." % opt)
+                except (IndexError, ValueError):
+                    raise angel.exceptions.AngelArgException('invalid migrate-checksums options.')
+                if algorithm not in angel.util.checksum.get_checksum_algorithm_names():
+                    raise angel.exceptions.AngelArgException("unknown checksum algorithm '%s' (available: %s)" %
+                                                             (algorithm, ', '.join(angel.util.checksum.get_checksum_algorithm_names())))
+                remaining = self._angel_version_manager.migrate_checksum_algorithm(algorithm,
+                                                                                  sleep_ratio=sleep_ratio,
+                                                                                  max_seconds=max_seconds)
+                if remaining:
+                    return 1
+                return 0
+
+
+            elif verb == 'migrate-dedup-layout':
+                max_seconds = None
+                sleep_ratio = 0.5
+                try:
+                    while len(args):
+                        opt = args.pop(0)
+                        if opt == '--max-seconds':
+                            max_seconds = int(args.pop(0))
+                        elif opt == '--sleep-ratio':
+                            sleep_ratio = float(args.pop(0))
+                        else:
+                            raise angel.exceptions.AngelArgException("unknown option '%s'." % opt)
+                except (IndexError, ValueError):
+                    raise angel.exceptions.AngelArgException('invalid migrate-dedup-layout options.')
+                remaining = self._angel_version_manager.migrate_dedup_layout(sleep_ratio=sleep_ratio, max_seconds=max_seconds)
+                if remaining:
+                    return 1
+                return 0
+
+
             elif verb == 'versions':
                 default_branch = self._angel_version_manager.get_default_branch()
                 branches = self._angel_version_manager.get_available_installed_branches()
@@ -1327,13 +1913,14 @@ class Angel():
                                           "-"*install_time_len,
                                           "-"*(max_width - longest_branch_name_len - longest_version_number - install_time_len - 6))
 
+                open_path_index = self._angel_version_manager.get_open_path_index()
                 for branch in sorted(branches):
                     default_version_for_branch = self._angel_version_manager.get_default_version(branch)
                     versions = self._angel_version_manager.get_available_installed_versions(branch)
                     for version in sorted(versions):
 
-                        path = self._angel_version_manager.get_path_for_version(branch, version)
-                        install_time = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(os.stat(path).st_mtime))
+                        catalog_entry = self._angel_version_manager.get_version_catalog_entry(branch, version)
+                        install_time = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(catalog_entry['install_time']))
 
                         print "%s  %s  %s " % (branch.ljust(longest_branch_name_len),
                                               version.ljust(longest_version_number),
@@ -1341,8 +1928,8 @@ class Angel():
                         sys.stdout.flush()
 
                         notes = []
-                        is_running = self._angel_version_manager.is_version_in_use_by_processes(branch, version)
-                        is_unused = not self._angel_version_manager.is_version_in_use(branch, version)
+                        is_running = self._angel_version_manager.is_version_in_use_by_processes(branch, version, open_path_index=open_path_index)
+                        is_unused = not self._angel_version_manager.is_version_in_use(branch, version, open_path_index=open_path_index)
                         if is_running:
                             notes += ["in-use"]
                         else:
@@ -1703,6 +2290,36 @@ class Angel():
                     need_to_release_lock = True
                     return self.service_repair()
 
+                if verb == 'trash':
+                    if not len(args): raise angel.exceptions.AngelArgException('missing action.')
+                    action = args.pop(0)
+                    if action == 'status':
+                        if is_pid_in_pidfile_running(os.path.join(os.path.expanduser(self.get_settings()['LOCK_DIR']), 'angel-trash-worker')):
+                            print "Background trash worker is running."
+                        for trash in self._get_trashes():
+                            (entry_count, inode_count, byte_count) = trash.get_status()
+                            print "%s: %s entries, %s inodes, %s bytes" % (trash.get_path(), entry_count, inode_count, byte_count)
+                        return 0
+                    if action == 'empty':
+                        max_seconds = None
+                        sleep_ratio = 0
+                        try:
+                            while len(args):
+                                opt = args.pop(0)
+                                if opt == '--max-seconds':
+                                    max_seconds = int(args.pop(0))
+                                elif opt == '--sleep-ratio':
+                                    sleep_ratio = float(args.pop(0))
+                                else:
+                                    raise angel.exceptions.AngelArgException("unknown option '%s'." % opt)
+                        except (IndexError, ValueError):
+                            raise angel.exceptions.AngelArgException('invalid trash empty options.')
+                        if not self.empty_trashes(max_seconds=max_seconds, sleep_ratio=sleep_ratio):
+                            print >>sys.stderr, "Trash not empty yet (stopped early, or another process is emptying it); re-run to continue."
+                            return 1
+                        return 0
+                    raise angel.exceptions.AngelArgException("unknown trash action '%s'." % action)
+
                 raise angel.exceptions.AngelArgException("unknown service command '%s'." % verb)
 
             except LockUnavailableError:
@@ -2456,18 +3073,77 @@ class Angel():
 
 
     def clear_tmp_dir(self):
-        if os.path.isdir(self.get_settings()['TMP_DIR']):
-            for f in os.listdir(self.get_settings()['TMP_DIR']):
+        tmp_dir = os.path.expanduser(self.get_settings()['TMP_DIR'])
+        if os.path.isdir(tmp_dir):
+            trash = self._get_tmp_dir_trash()
+            trashed_count = 0
+            for f in os.listdir(tmp_dir):
                 try:
-                    path = os.path.join(self.get_settings()['TMP_DIR'], f)
-                    if os.path.isdir(path):
-                        shutil.rmtree(path)
-                    elif os.path.isfile(path):
-                        os.remove(path)
+                    path = os.path.join(tmp_dir, f)
+                    if path == trash.get_path():
+                        continue
+                    if os.path.isdir(path) or os.path.isfile(path):
+                        trash.move_to_trash(path)
+                        trashed_count += 1
                     else:
                         print >>sys.stderr, 'Warning: unknown file type in tmp dir (%s); skipping it.' % path
                 except Exception as e:
                     print >>sys.stderr, 'Warning: clearing tmp dir file "%s" failed (%s), possibly do to concurrent runs?' % (f, e)
+            if trashed_count:
+                self.start_trash_worker()
+
+
+    def _get_tmp_dir_trash(self):
+        """Return the angel.util.trash.Trash that clear_tmp_dir moves TMP_DIR entries into (it has to be on the same
+        filesystem as them, so it's inside TMP_DIR)."""
+        return angel.util.trash.Trash(os.path.join(os.path.expanduser(self.get_settings()['TMP_DIR']), '.angel-trash'))
+
+
+    def _get_trashes(self):
+        """Return the angel.util.trash.Trash objects that deleted files are moved into: the TMP_DIR trash, plus the
+        versions trash."""
+        trashes = [self._get_tmp_dir_trash()]
+        if self._angel_version_manager:
+            trashes.append(self._angel_version_manager.get_trash())
+        return trashes
+
+
+    def empty_trashes(self, max_seconds=None, sleep_ratio=0):
+        """Remove everything in the trash dirs (see _get_trashes); returns True if they're all empty."""
+        io_governor = angel.util.io_governor.get_io_governor(self._get_version_io_limits(), sleep_ratio=sleep_ratio)
+        is_complete = True
+        for trash in self._get_trashes():
+            if self._angel_version_manager and trash.get_path() == self._angel_version_manager.get_trash().get_path():
+                trash_is_empty = self._angel_version_manager.empty_trash(io_governor=io_governor, max_seconds=max_seconds)
+            else:
+                trash_is_empty = trash.empty(io_governor=io_governor, max_seconds=max_seconds)[1]
+            is_complete = is_complete and trash_is_empty
+        return is_complete
+
+
+    def start_trash_worker(self):
+        """Start a background process that empties the trash dirs, unless one is already running."""
+        def _get_trash_entries():
+            return set([(trash.get_path(), name) for trash in self._get_trashes() for name in trash.get_entry_names()])
+        def _empty_trashes_until_done():
+            # Keep going until a pass finds nothing left, so that anything trashed while we're running is picked up;
+            # give up once a pass leaves exactly what it started with (e.g. entries we aren't allowed to remove):
+            while True:
+                entries = _get_trash_entries()
+                is_complete = self.empty_trashes()
+                remaining_entries = _get_trash_entries()
+                if is_complete and not len(remaining_entries):
+                    return 0
+                if len(remaining_entries) and remaining_entries == entries:
+                    print >>sys.stderr, "Warning: unable to remove %s trash entries; leaving them." % len(remaining_entries)
+                    return 1
+                time.sleep(1)
+        pidfile = os.path.join(os.path.expanduser(self.get_settings()['LOCK_DIR']), 'angel-trash-worker')
+        log_basepath = os.path.join(os.path.expanduser(self.get_settings()['LOG_DIR']), 'angel', 'trash-worker')
+        if is_pid_in_pidfile_running(pidfile):
+            return 0
+        return devops.process_helpers.run_function_in_background(self.get_settings(), 'angel-trash-worker', pidfile,
+                                                                 _empty_trashes_until_done, log_basepath=log_basepath)
 
 
     def get_service_state(self):
@@ -3067,6 +3743,22 @@ class Angel():
         return 0
 
 
+    def _prewarm_version(self, branch, version, byte_budget):
+        """Pull the files our running services use into the page cache from the given version, ahead of a reload.
+        Prewarming is only an optimization, so failures are reported and ignored."""
+        try:
+            start_time = time.time()
+            (files_warmed, bytes_warmed, files_shared, files_skipped) = \
+                self._angel_version_manager.prewarm_version(branch, version, byte_budget,
+                                                            running_branch=self.get_project_code_branch(),
+                                                            running_version=self.get_project_code_version())
+            print >>sys.stderr, "Prewarmed %s files (%s bytes) of %s/%s in %.1f seconds; %s files were shared with the running version%s." % \
+                                (files_warmed, bytes_warmed, branch, version, time.time() - start_time, files_shared,
+                                 '' if not files_skipped else '; %s files over the %s byte budget were skipped' % (files_skipped, byte_budget))
+        except Exception as e:
+            print >>sys.stderr, "Warning: unable to prewarm branch %s, version %s (%s); continuing." % (branch, version, e)
+
+
     def activate_version_and_reload_code(self, branch, version,
                                          force=False,
                                          jitter=0,
@@ -3097,7 +3789,8 @@ class Angel():
         if download_only:
             # Purge old versions here when doing download-only, so we don't stack up lots of versions.
             # We normally wait to do this, so that download to activation time is shorter.
-            self._angel_version_manager.delete_stale_versions(branch, self._settings['SYSTEM_INSTALLED_VERSIONS_TO_KEEP'])
+            self._angel_version_manager.delete_stale_versions(branch, self._settings['SYSTEM_INSTALLED_VERSIONS_TO_KEEP'], in_background=True)
+            self.start_trash_worker()
             return 0
 
         version_to_activate = version
@@ -3107,6 +3800,9 @@ class Angel():
                                                      downgrade_allowed=downgrade_allowed,
                                                      jitter=jitter)
 
+        if not skip_reload and 'VERSION_PREWARM_BYTES' in self._settings and self._settings['VERSION_PREWARM_BYTES']:
+            self._prewarm_version(branch, version_to_activate, self._settings['VERSION_PREWARM_BYTES'])
+
         try:
             if not skip_reload:
                 pid = os.fork()
@@ -3120,7 +3816,8 @@ class Angel():
                                                                           self._project_entry_script,
                                                                           ("service", "reload", "--code-only"))
         finally:
-            self._angel_version_manager.delete_stale_versions(branch, self._settings['SYSTEM_INSTALLED_VERSIONS_TO_KEEP'])
+            self._angel_version_manager.delete_stale_versions(branch, self._settings['SYSTEM_INSTALLED_VERSIONS_TO_KEEP'], in_background=True)
+            self.start_trash_worker()
 
         if wait_for_ok:
             if self.are_services_running():
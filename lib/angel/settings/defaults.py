@@ -11,6 +11,22 @@ SYSTEM_AUTO_UPGRADE = True
 SYSTEM_INSTALLED_VERSIONS_TO_KEEP = 10
 
 
+# Limits on the disk work done by version installs, deletes and dedup runs, so they don't starve running services.
+# Budgets are per second; when the 1-minute load average per cpu or the percent of time tasks are stalled on I/O
+# (/proc/pressure/io) is above its max, the budgets are cut back until the host is quiet. None means no limit.
+# VERSION_IO_IONICE_CLASS may be 'best-effort' or 'idle'. See angel.util.io_governor.IOGovernor.
+VERSION_IO_BYTES_PER_SECOND = None
+VERSION_IO_OPS_PER_SECOND = None
+VERSION_IO_MAX_LOADAVG = None
+VERSION_IO_MAX_IO_PRESSURE = None
+VERSION_IO_IONICE_CLASS = None
+
+
+# Before reloading services onto a newly activated version, pull the files the running version uses into the page
+# cache, so the new code doesn't start on a cold cache. This caps the bytes read; set to 0 to disable prewarming.
+VERSION_PREWARM_BYTES = 268435456
+
+
 # We determine which services to call reload on during upgrades by first looking for a boolean "xxx_SERVICE_RELOAD_ON_UPGRADE".
 # If that's not defined, we look at DEFAULT_SERVICE_RELOAD_ON_UPGRADE.
 # This allows us to pin a running service to a particular version by doing something like:
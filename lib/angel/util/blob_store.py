@@ -0,0 +1,291 @@
+import errno
+import filecmp
+import os
+import stat
+import sys
+import thread
+import time
+
+import angel.exceptions
+from angel.util.checksum import get_hasher, split_prefixed_checksum
+from angel.util.file_copy import copy_file
+from angel.util.io_governor import IOGovernor
+
+
+class DedupBlobStore():
+
+    """ Content-addressed store of the files that versioned copies hardlink to (the "dedup_hardlinks" dir).
+
+    Each file ("blob") is named by its checksum-based name (see dedup_get_checksum_based_name). Blobs are stored in a
+    two-level fan-out layout keyed on the leading hex digits of their digest, e.g. "ab/cd/<algorithm>-abcd....<size>.<mode>",
+    so that no single directory grows to hundreds of thousands of entries.
+
+    Older pools kept every blob directly in the top-level dir. Lookups check both layouts, so a pool can be used while
+    migrate_flat_layout() moves blobs into the fan-out dirs in the background.
+
+    Blobs renamed by a checksum algorithm migration are recorded in an alias file (old name -> new name), so that
+    manifests that still use the old names resolve.
+
+    A blob whose link count is 1 is only referenced by the store, and can be removed as unused.
+
+    """
+
+    _root = None
+    _aliases = None
+    copy_method_counts = None
+
+    SAFETY_CHECK_FILENAME = ".dedup_safety_check"
+    ALIASES_FILENAME = ".dedup_aliases"
+
+    def __init__(self, hardlink_checksum_dir):
+        self._root = os.path.abspath(os.path.expanduser(hardlink_checksum_dir))
+        self.copy_method_counts = {}
+
+
+    def get_root(self):
+        return self._root
+
+
+    def exists(self):
+        return os.path.isdir(self._root)
+
+
+    def create_if_needed(self):
+        """Create the store's dir, if missing; throws an AngelVersionException on error."""
+        try:
+            if not os.path.isdir(os.path.dirname(self._root)):
+                os.makedirs(os.path.dirname(self._root))  # Make parent dirs with default umask
+            if not os.path.isdir(self._root):
+                os.makedirs(self._root, mode=0700)
+                # Touch a file that we verify exists in remove_unused_links, as a safety check:
+                safety_check_path = os.path.join(self._root, self.SAFETY_CHECK_FILENAME)
+                open(safety_check_path, "w").write(str(time.time()))
+                # Create a hardlink to the safety file, so that the link count is >1, just to avoid potentially manually clearing it for nlink=1 checks:
+                os.link(safety_check_path, "%s-2" % safety_check_path)
+        except Exception as e:
+            raise angel.exceptions.AngelVersionException("can't make hardlink_checksum_dir %s: %s" % (self._root, e))
+
+
+    def check_safety_file(self):
+        """Throw an AngelVersionException unless the store's dir looks like one we created; use before removing blobs."""
+        if not os.path.isfile(os.path.join(self._root, self.SAFETY_CHECK_FILENAME)):
+            raise angel.exceptions.AngelVersionException("Invalid hardlink_checksum_dir (missing safety check)")
+
+
+    def get_path(self, name):
+        """Return the path that the blob with the given name is stored at in the fan-out layout (whether or not it exists)."""
+        digest = split_prefixed_checksum(name.split('.', 1)[0])[1]
+        return os.path.join(self._root, digest[0:2], digest[2:4], name)
+
+
+    def find(self, name):
+        """Return the path to the blob with the given name, following migration aliases; None if it isn't in the store."""
+        path = self._find_without_aliases(name)
+        if path is None:
+            aliases = self.get_aliases()
+            if name in aliases:
+                path = self._find_without_aliases(aliases[name])
+        return path
+
+
+    def _find_without_aliases(self, name):
+        path = self.get_path(name)
+        if os.path.exists(path):
+            return path
+        flat_path = os.path.join(self._root, name)
+        if os.path.exists(flat_path):
+            return flat_path
+        return None
+
+
+    def contains(self, name):
+        return self.find(name) is not None
+
+
+    def add_file(self, src_path, name):
+        """Copy the file at src_path into the store as the given name, preserving mode and times; return the blob's path.
+        The blob appears atomically, so a concurrent reader never sees a partial copy. The data is copied with the
+        cheapest method the filesystem supports (see angel.util.file_copy); copy_method_counts tallies which were used."""
+        path = self.get_path(name)
+        self._make_shard_dir(os.path.dirname(path))
+        tmp_path = os.path.join(os.path.dirname(path), '.adding-%s-%s-%s' % (os.getpid(), thread.get_ident(), name))
+        try:
+            method = copy_file(src_path, tmp_path)
+            os.rename(tmp_path, path)
+            self.copy_method_counts[method] = self.copy_method_counts.get(method, 0) + 1
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        return path
+
+
+    def add_stream(self, fileobj, name):
+        """Read a blob's contents from fileobj into the store as the given name; return the blob's path.
+        The contents are verified against the checksum and size in the name, and the blob's permissions are set from the
+        mode in the name, so blobs can be taken from untrusted sources (e.g. another host). Throws an
+        AngelVersionException if the contents don't match."""
+        try:
+            (checksum, size, mode) = name.split('.')
+            (algorithm, digest) = split_prefixed_checksum(checksum)
+            size = int(size)
+            mode = int(mode)
+            hasher = get_hasher(algorithm)
+            if hasattr(hasher, 'set_size'):
+                hasher.set_size(size)
+        except ValueError as e:
+            raise angel.exceptions.AngelVersionException("Invalid blob name %s (%s)" % (name, e))
+        if '/' in name or name.startswith('.'):
+            raise angel.exceptions.AngelVersionException("Invalid blob name %s" % name)
+        path = self.get_path(name)
+        self._make_shard_dir(os.path.dirname(path))
+        tmp_path = os.path.join(os.path.dirname(path), '.adding-%s-%s-%s' % (os.getpid(), thread.get_ident(), name))
+        try:
+            bytes_read = 0
+            with open(tmp_path, 'wb') as f:
+                while True:
+                    data = fileobj.read(65536)
+                    if not data:
+                        break
+                    hasher.update(data)
+                    f.write(data)
+                    bytes_read += len(data)
+            if bytes_read != size or hasher.hexdigest() != digest:
+                raise angel.exceptions.AngelVersionException("Contents of blob %s don't match its name (got %s bytes with checksum %s)" %
+                                                             (name, bytes_read, hasher.hexdigest()))
+            os.chmod(tmp_path, stat.S_IMODE(mode))
+            os.rename(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        return path
+
+
+    def _make_shard_dir(self, shard_dir):
+        if not os.path.isdir(shard_dir):
+            try:
+                os.makedirs(shard_dir, 0700)
+            except OSError:
+                if not os.path.isdir(shard_dir):  # Another process could have created it at the same time
+                    raise
+
+
+    def iter_blobs(self):
+        """Yield (name, path) for every blob in the store, in both the fan-out and the legacy flat layouts."""
+        if not os.path.isdir(self._root):
+            return
+        for entry in os.listdir(self._root):
+            if entry.startswith('.'):
+                continue
+            entry_path = os.path.join(self._root, entry)
+            if len(entry) == 2 and '.' not in entry:
+                for sub_entry in os.listdir(entry_path):
+                    sub_entry_path = os.path.join(entry_path, sub_entry)
+                    for name in os.listdir(sub_entry_path):
+                        if not name.startswith('.'):
+                            yield (name, os.path.join(sub_entry_path, name))
+            else:
+                yield (entry, entry_path)
+
+
+    def iter_shard_dirs(self):
+        """Yield the paths of all second-level fan-out dirs, in sorted order (useful for processing the store in slices)."""
+        if not os.path.isdir(self._root):
+            return
+        for entry in sorted(os.listdir(self._root)):
+            if len(entry) != 2 or '.' in entry or entry.startswith('.'):
+                continue
+            for sub_entry in sorted(os.listdir(os.path.join(self._root, entry))):
+                yield os.path.join(self._root, entry, sub_entry)
+
+
+    def get_aliases(self):
+        """Return a dict of old blob name -> current blob name, for blobs renamed by a checksum algorithm migration."""
+        if self._aliases is not None:
+            return self._aliases
+        self._aliases = {}
+        alias_file = os.path.join(self._root, self.ALIASES_FILENAME)
+        if not os.path.isfile(alias_file):
+            return self._aliases
+        try:
+            # The last element is either empty or a partial line from an interrupted append; skip it either way:
+            for line in open(alias_file, 'r').read().split('\n')[:-1]:
+                (old_name, new_name) = line.split(' ')
+                self._aliases[old_name] = new_name
+        except Exception as e:
+            print >>sys.stderr, "Warning: unable to parse %s (%s); ignoring checksum aliases." % (alias_file, e)
+            self._aliases = {}
+        return self._aliases
+
+
+    def rename_with_alias(self, old_name, new_name):
+        """Rename a blob, recording old_name as an alias of new_name. The alias is written first, so that the old name
+        is resolvable at every point in time."""
+        old_path = self._find_without_aliases(old_name)
+        if old_path is None:
+            raise angel.exceptions.AngelVersionException("Can't rename missing blob %s" % old_name)
+        new_path = self.get_path(new_name)
+        if not os.path.isdir(os.path.dirname(new_path)):
+            os.makedirs(os.path.dirname(new_path), 0700)
+        fd = os.open(os.path.join(self._root, self.ALIASES_FILENAME), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0600)
+        try:
+            os.write(fd, '%s %s\n' % (old_name, new_name))
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        os.rename(old_path, new_path)
+        self.get_aliases()[old_name] = new_name
+
+
+    def prune_aliases(self):
+        """Atomically rewrite the alias file without aliases whose blobs have since been removed."""
+        aliases = self.get_aliases()
+        live_aliases = dict([(old_name, new_name) for (old_name, new_name) in aliases.items()
+                             if self._find_without_aliases(new_name) is not None])
+        if len(live_aliases) == len(aliases):
+            return
+        alias_file = os.path.join(self._root, self.ALIASES_FILENAME)
+        alias_file_tmp = '%s-%s' % (alias_file, time.time())
+        open(alias_file_tmp, 'w').write(''.join(['%s %s\n' % (old_name, live_aliases[old_name]) for old_name in sorted(live_aliases)]))
+        os.rename(alias_file_tmp, alias_file)
+        self._aliases = live_aliases
+
+
+    def migrate_flat_layout(self, max_seconds=None, sleep_ratio=0, verbose=True, io_governor=None):
+        """Move blobs stored directly in the top-level dir into the fan-out layout. The store stays usable throughout,
+        and this can be interrupted and re-run at any time. Returns the number of flat blobs that remain."""
+        if io_governor is None:
+            io_governor = IOGovernor(sleep_ratio=sleep_ratio)
+        self.check_safety_file()
+        start_time = time.time()
+        moved_count = 0
+        remaining_count = 0
+        for name in os.listdir(self._root):
+            if name.startswith('.') or (len(name) == 2 and '.' not in name):
+                continue
+            if max_seconds is not None and time.time() - start_time > max_seconds:
+                remaining_count += 1
+                continue
+            path = self.get_path(name)
+            flat_path = os.path.join(self._root, name)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path), 0700)
+            # Link, then unlink, rather than rename(): rename() would silently replace a blob that a concurrent install has
+            # already added to the fan-out layout, orphaning the links to it. Either way the inode is kept, so versions
+            # hardlinked to the blob are unaffected.
+            try:
+                os.link(flat_path, path)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+                if not filecmp.cmp(flat_path, path, shallow=False):
+                    print >>sys.stderr, "Warning: flat blob %s differs from %s; leaving it in place." % (flat_path, path)
+                    remaining_count += 1
+                    continue
+                io_governor.account(bytes=2 * os.path.getsize(path))
+            os.remove(flat_path)
+            io_governor.account()
+            moved_count += 1
+        if verbose:
+            print >>sys.stderr, "Moved %s blobs into fan-out dirs (%s remaining; %.1f seconds)." % \
+                                (moved_count, remaining_count, time.time() - start_time)
+        return remaining_count
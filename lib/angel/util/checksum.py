@@ -1,11 +1,115 @@
 
+import collections
 import hashlib
+import multiprocessing
 import os
 import sys
 
+from angel.util.tree_walk import list_dir_entries
 
-def get_checksum(string):
-    return hashlib.md5(string).hexdigest()
+
+# Registry of content hash algorithms that can be used for dedup checksums, by name.
+# md5 is the legacy algorithm: its checksums are bare hex digests; checksums from any other algorithm are written as
+# "<algorithm>-<hexdigest>" (see get_prefixed_checksum), so pools and manifests can hold a mix of algorithms.
+DEFAULT_CHECKSUM_ALGORITHM = 'md5'
+_checksum_algorithms = {}
+
+
+def register_checksum_algorithm(name, hash_constructor):
+    ''' Register a hashlib-style constructor (returns an object with update() and hexdigest()) under the given name.
+        Names must not contain '-' or '.', as they're used as prefixes in checksum-based file names. '''
+    if '-' in name or '.' in name:
+        raise ValueError("invalid checksum algorithm name '%s'" % name)
+    _checksum_algorithms[name] = hash_constructor
+
+
+def get_checksum_algorithm_names():
+    return sorted(_checksum_algorithms)
+
+
+def get_hasher(algorithm=DEFAULT_CHECKSUM_ALGORITHM):
+    ''' Return a new hash object for the given algorithm; throws ValueError for unknown algorithms. '''
+    if algorithm not in _checksum_algorithms:
+        raise ValueError("unknown checksum algorithm '%s' (available: %s)" %
+                         (algorithm, ', '.join(get_checksum_algorithm_names())))
+    return _checksum_algorithms[algorithm]()
+
+
+def get_prefixed_checksum(hexdigest, algorithm=DEFAULT_CHECKSUM_ALGORITHM):
+    ''' Return the checksum string for the given digest: bare for md5 (legacy format), "<algorithm>-<hexdigest>" otherwise. '''
+    if hexdigest is None:
+        return None
+    if algorithm == 'md5':
+        return hexdigest
+    return '%s-%s' % (algorithm, hexdigest)
+
+
+def split_prefixed_checksum(checksum):
+    ''' Inverse of get_prefixed_checksum: return (algorithm, hexdigest) for the given checksum string. '''
+    if '-' in checksum:
+        return tuple(checksum.split('-', 1))
+    return ('md5', checksum)
+
+
+class GitBlobHasher():
+
+    """ hashlib-style hasher giving git's object id for a blob: the sha1 of "blob <size>\\0" followed by the contents.
+    Checksums from the "git" algorithm thus match the ids in a git checkout (see angel.util.git_checksums), so files
+    committed to git can be listed without being read.
+
+    The header needs the size up front: callers that know it call set_size() before update(), and the contents are then
+    hashed as they're given; otherwise they're buffered until hexdigest().
+
+    """
+
+    _sha1 = None
+    _buffered = None
+
+    def __init__(self):
+        self._sha1 = None
+        self._buffered = []
+
+
+    def set_size(self, size):
+        self._sha1 = hashlib.sha1('blob %d\0' % size)
+
+
+    def update(self, data):
+        if self._sha1 is None:
+            self._buffered.append(data)
+        else:
+            self._sha1.update(data)
+
+
+    def hexdigest(self):
+        if self._sha1 is None:
+            data = ''.join(self._buffered)
+            self.set_size(len(data))
+            self._sha1.update(data)
+            self._buffered = []
+        return self._sha1.hexdigest()
+
+
+register_checksum_algorithm('md5', hashlib.md5)
+register_checksum_algorithm('git', GitBlobHasher)
+register_checksum_algorithm('sha1', hashlib.sha1)
+try:
+    _blake2b = hashlib.blake2b
+except AttributeError:
+    try:
+        import pyblake2
+        _blake2b = pyblake2.blake2b
+    except ImportError:
+        _blake2b = None
+if _blake2b is not None:
+    # A 160-bit digest keeps checksum-based file names reasonably short while still being far more collision-resistant than md5:
+    register_checksum_algorithm('blake2b', lambda: _blake2b(digest_size=20))
+
+
+def get_checksum(string, algorithm='md5'):
+    h = get_hasher(algorithm)
+    h.update(string)
+    return h.hexdigest()
 
 
 def get_md5_of_path_filestats(p, symlink_loop_detection=20):
@@ -46,19 +150,93 @@ def get_md5_of_path_contents(path):
     return None
 
 
-def _get_md5_of_file(file):
-    ''' Return an md5 hex digest for the given file, or None if not a file. '''
+def get_checksums_in_parallel(items, algorithm=DEFAULT_CHECKSUM_ALGORITHM, workers=None, chunk_size=32):
+    ''' Given an iterable of (key, path) tuples, yield (key, hexdigest) tuples in the same order, hashing the files with the
+        given algorithm across up to <workers> processes (defaults to the number of cpus). Items with a path of None are
+        passed through with a hexdigest of None, so that callers can stream dirs and other entries that don't need hashing
+        through in walk order. Items can also be (key, path, algorithm) tuples, to hash that file with another algorithm.
+        Only a bounded number of chunks are kept in flight, so a consumer that sleeps between items (e.g. to honor a
+        sleep_ratio) also throttles the workers. '''
+    get_hasher(algorithm)  # Fail fast on unknown algorithms, instead of inside a worker
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    if workers <= 1:
+        for item in items:
+            if item[1] is None:
+                yield (item[0], None)
+            else:
+                yield (item[0], get_checksum_of_file(item[1], item[2] if len(item) > 2 else algorithm))
+        return
+
+    pool = multiprocessing.Pool(workers)
+    in_flight = collections.deque()
+    max_in_flight = workers * 4
+
+    def _submit(chunk):
+        paths = [(item[1], item[2] if len(item) > 2 else algorithm) for item in chunk if item[1] is not None]
+        if len(paths):
+            in_flight.append((chunk, pool.apply_async(_get_checksums_of_files, (paths,))))
+        else:
+            in_flight.append((chunk, None))
+
+    def _results_of_oldest_chunk():
+        (chunk, result) = in_flight.popleft()
+        checksums = iter(())
+        if result is not None:
+            checksums = iter(result.get())
+        for item in chunk:
+            if item[1] is None:
+                yield (item[0], None)
+            else:
+                yield (item[0], checksums.next())
+
     try:
-        md5 = hashlib.md5()
+        chunk = []
+        for item in items:
+            chunk.append(item)
+            if len(chunk) < chunk_size:
+                continue
+            _submit(chunk)
+            chunk = []
+            while len(in_flight) >= max_in_flight:
+                for result in _results_of_oldest_chunk():
+                    yield result
+        if len(chunk):
+            _submit(chunk)
+        while len(in_flight):
+            for result in _results_of_oldest_chunk():
+                yield result
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def _get_checksums_of_files(paths):
+    ''' Return a list of hex digests for the given (path, algorithm) tuples; runs inside get_checksums_in_parallel worker processes. '''
+    return [get_checksum_of_file(path, algorithm) for (path, algorithm) in paths]
+
+
+def get_checksum_of_file(file, algorithm=DEFAULT_CHECKSUM_ALGORITHM):
+    ''' Return a hex digest of the given file's contents using the given algorithm, or None if not a file. '''
+    try:
+        h = get_hasher(algorithm)
         with open(file, 'rb') as f:  # Skip check if os.path.isfile() to avoid syscall; open() will throw an IOError if it's not a file
+            if hasattr(h, 'set_size'):
+                h.set_size(os.fstat(f.fileno()).st_size)
             for chunk in iter(lambda: f.read(65536), ''):
-                md5.update(chunk)
-        return md5.hexdigest()
+                h.update(chunk)
+        return h.hexdigest()
     except IOError as e:
-        print >>sys.stderr, "Error: get_md5_of_file unable to read file %s (%s)." % (file, e)
+        print >>sys.stderr, "Error: get_checksum_of_file unable to read file %s (%s)." % (file, e)
         return None
 
 
+def _get_md5_of_file(file):
+    ''' Return an md5 hex digest for the given file, or None if not a file. '''
+    return get_checksum_of_file(file, 'md5')
+
+
 def _get_md5_of_dir(path, offset_into_path_string=None):
     # Given a path, return an MD5 hex digest of the contents under that path.
     # Filename changes or file content changes should change the hash;
@@ -73,13 +251,13 @@ def _get_md5_of_dir(path, offset_into_path_string=None):
 
     checksum_string = ''
 
-    for f in sorted(os.listdir(path)):
-        this_path = os.path.join(path,f)
+    for entry in list_dir_entries(path, sort=True):
+        this_path = entry.path
         md5_value = None
 
-        if os.path.isfile(this_path):
+        if entry.is_file():
             md5_value = _get_md5_of_file(this_path)
-        elif os.path.isdir(this_path):
+        elif entry.is_dir():
             md5_value = _get_md5_of_dir(this_path, offset_into_path_string=offset_into_path_string)
         else:
             print >>sys.stderr, "Error: unknown file type in _get_md5_of_dir() for file %s" % this_path
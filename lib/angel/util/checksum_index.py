@@ -0,0 +1,155 @@
+import os
+import sys
+import time
+
+from angel.util.checksum import DEFAULT_CHECKSUM_ALGORITHM, split_prefixed_checksum
+
+
+class ChecksumIndex():
+
+    """ Persistent cache of file checksums, keyed by the stat info of the file they were calculated from.
+
+    Entries are keyed by (device, inode, algorithm) and are only used when the file's size, mtime and ctime are
+    unchanged, so a file that's been modified, replaced or re-checked-out will be re-hashed. Checksums are stored in
+    prefixed form (see angel.util.checksum.get_prefixed_checksum), which is how the algorithm is recorded.
+
+    The index file is an append-only log of "<dev> <ino> <size> <mtime> <ctime> <checksum>" lines; later lines
+    override earlier ones. Updates are appended with a single write, so a crash can at worst leave a partial last
+    line, which is ignored on load. Superseded lines are dropped by compact(), which rewrites the file atomically.
+
+    """
+
+    _index_path = None
+    _verify = False
+    _entries = None
+    _pending = None
+    _seen_keys = None
+    _log_line_count = 0
+    hits = 0
+    misses = 0
+    mismatches = 0
+
+    # Files modified this recently might still be changing within mtime granularity; don't trust their stat info yet:
+    _RACY_WINDOW_SECONDS = 2
+
+    def __init__(self, index_path, verify=False):
+        """
+        @param index_path: path to the index file; it's created on first save
+        @param verify: when True, all lookups miss so every file is re-hashed, and mismatches against the index are reported
+        """
+        self._index_path = index_path
+        self._verify = verify
+        self._entries = {}
+        self._pending = {}
+        self._seen_keys = set()
+        self.hits = 0
+        self.misses = 0
+        self.mismatches = 0
+        self._load()
+
+
+    def _load(self):
+        if not os.path.isfile(self._index_path):
+            return
+        try:
+            lines = open(self._index_path, 'r').read().split('\n')
+        except IOError as e:
+            print >>sys.stderr, "Warning: unable to read checksum index %s (%s); ignoring it." % (self._index_path, e)
+            return
+        # The last element is either empty or a partially-written line from an interrupted append; skip it either way:
+        for line in lines[:-1]:
+            try:
+                (dev, ino, size, mtime, ctime, checksum) = line.split(' ')
+                if not len(checksum):
+                    continue
+                key = (int(dev), int(ino), split_prefixed_checksum(checksum)[0])
+                self._entries[key] = (int(size), float(mtime), float(ctime), checksum)
+            except ValueError:
+                continue
+        self._log_line_count = len(lines) - 1
+
+
+    def get_checksum(self, file_stat, algorithm=DEFAULT_CHECKSUM_ALGORITHM):
+        """Return the cached checksum for the file with the given stat info, or None if it needs to be (re-)hashed."""
+        key = (file_stat.st_dev, file_stat.st_ino, algorithm)
+        self._seen_keys.add(key)
+        entry = self._entries.get(key)
+        if self._verify or entry is None or entry[:3] != (file_stat.st_size, file_stat.st_mtime, file_stat.st_ctime):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry[3]
+
+
+    def set_checksum(self, file_stat, checksum):
+        """Record the (prefixed) checksum of the file with the given stat info; call save() to persist it."""
+        if checksum is None:
+            return
+        key = (file_stat.st_dev, file_stat.st_ino, split_prefixed_checksum(checksum)[0])
+        entry = (file_stat.st_size, file_stat.st_mtime, file_stat.st_ctime, checksum)
+        self._seen_keys.add(key)
+        old_entry = self._entries.get(key)
+        if self._verify and old_entry is not None and old_entry[:3] == entry[:3] and old_entry[3] != checksum:
+            self.mismatches += 1
+            print >>sys.stderr, "Warning: checksum index entry for inode %s was %s but file now hashes to %s." % \
+                                (file_stat.st_ino, old_entry[3], checksum)
+        if old_entry == entry:
+            return
+        if time.time() - max(file_stat.st_mtime, file_stat.st_ctime) < self._RACY_WINDOW_SECONDS:
+            return
+        self._entries[key] = entry
+        self._pending[key] = entry
+
+
+    def save(self):
+        """Append any new entries to the index file; compacts the file if it's mostly superseded lines."""
+        if not len(self._pending):
+            return
+        data = ''.join([self._format_entry(key, self._pending[key]) for key in self._pending])
+        try:
+            if not os.path.isdir(os.path.dirname(self._index_path)):
+                os.makedirs(os.path.dirname(self._index_path))
+            fd = os.open(self._index_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0600)
+            try:
+                os.write(fd, data)
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+        except (IOError, OSError) as e:
+            print >>sys.stderr, "Warning: unable to update checksum index %s (%s)." % (self._index_path, e)
+            return
+        self._log_line_count += len(self._pending)
+        self._pending = {}
+        if self._log_line_count > 2 * len(self._entries) + 1024:
+            self.compact()
+
+
+    def compact(self, seen_only=False):
+        """Atomically rewrite the index file with one line per entry.
+        If seen_only is True, also drop entries for files that weren't looked up or set since the index was loaded."""
+        keys = self._entries.keys()
+        if seen_only:
+            keys = [key for key in keys if key in self._seen_keys]
+            self._entries = dict([(key, self._entries[key]) for key in keys])
+        tmp_path = '%s-%s' % (self._index_path, time.time())
+        try:
+            if not os.path.isdir(os.path.dirname(self._index_path)):
+                os.makedirs(os.path.dirname(self._index_path))
+            with open(tmp_path, 'w') as f:
+                for key in sorted(keys):
+                    f.write(self._format_entry(key, self._entries[key]))
+                f.flush()
+                os.fsync(f.fileno())
+            os.chmod(tmp_path, 0600)
+            os.rename(tmp_path, self._index_path)
+        except (IOError, OSError) as e:
+            print >>sys.stderr, "Warning: unable to compact checksum index %s (%s)." % (self._index_path, e)
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return
+        self._log_line_count = len(keys)
+        self._pending = {}
+
+
+    def _format_entry(self, key, entry):
+        return '%d %d %d %r %r %s\n' % (key[0], key[1], entry[0], entry[1], entry[2], entry[3])
@@ -0,0 +1,177 @@
+import mmap
+import os
+import struct
+
+
+# Binary checksum manifests hold the same path -> checksum mapping as text checksum files ("<checksum> <path>" lines),
+# but are laid out so that they can be mmap'ed and searched in place, without parsing every entry up front:
+#
+#   header:  8-byte magic, little-endian uint32 entry count
+#   index:   one little-endian uint32 per entry, the file offset of its record; entries are sorted by path
+#   records: "<path>\0<checksum>\n" per entry
+#
+# Lookups binary-search the index, so loading a manifest of any size costs one open() and one mmap(), and only the
+# pages that lookups touch are read in.
+
+BINARY_MANIFEST_MAGIC = 'ANGELCK1'
+_HEADER_FORMAT = '<8sI'
+_HEADER_SIZE = struct.calcsize(_HEADER_FORMAT)
+_OFFSET_FORMAT = '<I'
+_OFFSET_SIZE = struct.calcsize(_OFFSET_FORMAT)
+
+
+def is_binary_checksum_manifest(path):
+    ''' Return True if the file at path is a binary checksum manifest (as opposed to a text checksum file). '''
+    try:
+        with open(path, 'rb') as f:
+            return f.read(len(BINARY_MANIFEST_MAGIC)) == BINARY_MANIFEST_MAGIC
+    except IOError:
+        return False
+
+
+def write_binary_checksum_manifest(path, checksums):
+    ''' Atomically write a dict of path to checksum to path as a binary checksum manifest. '''
+    entries = []
+    for (file_path, checksum) in checksums.items():
+        if isinstance(file_path, unicode):
+            file_path = file_path.encode('utf-8')
+        if '\0' in file_path or '\n' in checksum:
+            raise ValueError("can't store path %r with checksum %r in a binary manifest" % (file_path, checksum))
+        entries.append((file_path, checksum))
+    entries.sort()
+    offsets = []
+    offset = _HEADER_SIZE + _OFFSET_SIZE * len(entries)
+    for (file_path, checksum) in entries:
+        offsets.append(offset)
+        offset += len(file_path) + len(checksum) + 2
+    if offset > 0xffffffff:
+        raise ValueError("too many entries for a binary manifest (%s bytes)" % offset)
+    tmp_path = '%s-%s' % (path, os.getpid())
+    try:
+        with open(tmp_path, 'wb') as f:
+            f.write(struct.pack(_HEADER_FORMAT, BINARY_MANIFEST_MAGIC, len(entries)))
+            f.write(struct.pack('<%dI' % len(offsets), *offsets))
+            for (file_path, checksum) in entries:
+                f.write('%s\0%s\n' % (file_path, checksum))
+        os.rename(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+class BinaryChecksumManifest():
+
+    """ Read-only, dict-like view of a binary checksum manifest (see write_binary_checksum_manifest).
+
+    Supports the read operations that code taking a path -> checksum dict uses (lookups, "in", len(), iteration over
+    paths in sorted order, keys/values/items), so it can be passed wherever a loaded text checksum file is expected.
+
+    """
+
+    _path = None
+    _map = None
+    _count = 0
+
+    def __init__(self, path):
+        self._path = path
+        with open(path, 'rb') as f:
+            header = f.read(_HEADER_SIZE)
+            if len(header) != _HEADER_SIZE:
+                raise ValueError("truncated binary manifest %s" % path)
+            (magic, self._count) = struct.unpack(_HEADER_FORMAT, header)
+            if magic != BINARY_MANIFEST_MAGIC:
+                raise ValueError("%s isn't a binary manifest" % path)
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self._map) < _HEADER_SIZE + _OFFSET_SIZE * self._count:
+            raise ValueError("truncated binary manifest %s" % path)
+
+
+    def _get_entry(self, i):
+        offset = struct.unpack_from(_OFFSET_FORMAT, self._map, _HEADER_SIZE + _OFFSET_SIZE * i)[0]
+        path_end = self._map.find('\0', offset)
+        checksum_end = self._map.find('\n', path_end)
+        return (self._map[offset:path_end], self._map[path_end+1:checksum_end])
+
+
+    def _get_path(self, i):
+        offset = struct.unpack_from(_OFFSET_FORMAT, self._map, _HEADER_SIZE + _OFFSET_SIZE * i)[0]
+        return self._map[offset:self._map.find('\0', offset)]
+
+
+    def _find(self, path):
+        if isinstance(path, unicode):
+            path = path.encode('utf-8')
+        low = 0
+        high = self._count
+        while low < high:
+            middle = (low + high) // 2
+            if self._get_path(middle) < path:
+                low = middle + 1
+            else:
+                high = middle
+        if low < self._count:
+            entry = self._get_entry(low)
+            if entry[0] == path:
+                return entry[1]
+        return None
+
+
+    def get(self, path, default=None):
+        checksum = self._find(path)
+        if checksum is None:
+            return default
+        return checksum
+
+
+    def __getitem__(self, path):
+        checksum = self._find(path)
+        if checksum is None:
+            raise KeyError(path)
+        return checksum
+
+
+    def __contains__(self, path):
+        return self._find(path) is not None
+
+    has_key = __contains__
+
+
+    def __len__(self):
+        return self._count
+
+
+    def __iter__(self):
+        return self.iterkeys()
+
+
+    def iterkeys(self):
+        for i in xrange(self._count):
+            yield self._get_path(i)
+
+
+    def itervalues(self):
+        for i in xrange(self._count):
+            yield self._get_entry(i)[1]
+
+
+    def iteritems(self):
+        for i in xrange(self._count):
+            yield self._get_entry(i)
+
+
+    def keys(self):
+        return list(self.iterkeys())
+
+
+    def values(self):
+        return list(self.itervalues())
+
+
+    def items(self):
+        return list(self.iteritems())
+
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
@@ -1,13 +1,30 @@
+import cStringIO
+import errno
+import fnmatch
+import functools
 import os
+import random
 import shutil
 import stat
 import sys
+import tarfile
 import time
 
 import angel.exceptions
-from angel.util.checksum import get_md5_of_path_contents
+from angel.util.blob_store import DedupBlobStore
+from angel.util.checksum import DEFAULT_CHECKSUM_ALGORITHM, get_checksum_of_file, get_checksums_in_parallel, get_hasher, get_prefixed_checksum, split_prefixed_checksum
+from angel.util.checksum_manifest import BinaryChecksumManifest, is_binary_checksum_manifest
+from angel.util.git_checksums import GitObjectReader, get_git_blob_checksums
+from angel.util.install_journal import InstallJournal
+from angel.util.io_governor import IOGovernor
+from angel.util.parallel_link import ParallelLinker
+from angel.util.tree_manifest import diff_tree_manifests
+from angel.util.tree_walk import walk_tree
 
 
+# Size of the blocks at the start and end of a file that dedup_files hashes to rule out files before hashing them in full:
+_DEDUP_PARTIAL_HASH_BLOCK_SIZE = 4096
+
 
 # import angel.util.dedup_files
 # import time
@@ -16,44 +33,95 @@ from angel.util.checksum import get_md5_of_path_contents
 
 # angel.util.dedup_files.dedup_create_copy('~/test-src/', '~/test-dest/v1', '~/test-linkdir', file_checksums=file_checksums)
 
-def dedup_calculate_checksums(src_path):
+def dedup_calculate_checksums(src_path, workers=1, checksum_index=None, algorithm=DEFAULT_CHECKSUM_ALGORITHM, stat_snapshot=None):
     ''' Given a path, return a dictionary of file->checksums for those files that can be dedupped.
-        Unsupported files (e.g. symlinks) are not included in the checksum map. '''
+        Unsupported files (e.g. symlinks) are not included in the checksum map.
+        File contents are hashed with the given algorithm (see angel.util.checksum.get_checksum_algorithm_names).
+        Files are hashed across up to <workers> processes (None for one per cpu).
+        If checksum_index (a ChecksumIndex) is given, files whose stat info is unchanged since they were last hashed
+        are not re-read; the caller is responsible for calling checksum_index.save().
+        If stat_snapshot (a StatSnapshot) is given, files whose size and mtime are unchanged since its baseline run are
+        given the baseline's checksum without being re-read, and every file's stats are recorded into it.
+        With the "git" algorithm, committed files in a git checkout are given their git blob ids without being read
+        (see _get_git_blob_checksums). '''
     src_path = os.path.abspath(os.path.expanduser(src_path))
     src_path_len = len(src_path)
     checksums = {}
-    for (path, dirs, files) in os.walk(src_path):
-        for file in files:
-            file_srcpath = os.path.join(path, file)
-            file_relpath = file_srcpath[(1+src_path_len):]
-            file_stat = os.lstat(file_srcpath)
-            if file_stat.st_mode & stat.S_ISUID:
-                # We shouldn't ever have any setuid bits; explictily check for them and skip files that have it set.
-                print >>sys.stderr, "Warning: setuid permissions not supported (%s: %s)" % (file_srcpath, file_stat.st_mode)
-                continue
-            if stat.S_ISLNK(file_stat.st_mode):
-                continue  # Silently skip symlinks -- we see them in python virtual envs
-            if not stat.S_ISREG(file_stat.st_mode):
-                print >>sys.stderr, "Warning: unknown file type at %s; skipping file." % file_srcpath
-                continue
-            checksum_filename = dedup_get_checksum_based_name(get_md5_of_path_contents(file_srcpath), file_stat.st_size, file_stat.st_mode)
-            if checksum_filename is None:
-                print >>sys.stderr, "Warning: unable to get checksum name for %s; skipping file." % file_srcpath
-                continue
-            checksums[file_relpath] = checksum_filename
-        for dir in dirs:
-            dir_srcpath = os.path.join(path, dir)
-            dir_relpath = dir_srcpath[(1+src_path_len):]
-            dir_stat = os.lstat(dir_srcpath)
-            checksums[dir_relpath] = dedup_get_checksum_based_name(0,0,dir_stat.st_mode)
+    git_checksums = _get_git_blob_checksums(src_path, algorithm)
+
+    def _files_to_checksum():
+        for (path, dir_entries, file_entries) in walk_tree(src_path):
+            for file_entry in file_entries:
+                file_srcpath = file_entry.path
+                file_relpath = file_srcpath[(1+src_path_len):]
+                file_stat = file_entry.lstat()
+                if file_stat.st_mode & stat.S_ISUID:
+                    # We shouldn't ever have any setuid bits; explictily check for them and skip files that have it set.
+                    print >>sys.stderr, "Warning: setuid permissions not supported (%s: %s)" % (file_srcpath, file_stat.st_mode)
+                    continue
+                if stat.S_ISLNK(file_stat.st_mode):
+                    continue  # Silently skip symlinks -- we see them in python virtual envs
+                if not stat.S_ISREG(file_stat.st_mode):
+                    print >>sys.stderr, "Warning: unknown file type at %s; skipping file." % file_srcpath
+                    continue
+                cached_checksum = _get_git_blob_checksum(git_checksums, file_relpath, file_stat)
+                if stat_snapshot is not None:
+                    stat_snapshot.record(file_relpath, file_stat)
+                    if cached_checksum is None:
+                        cached_checksum = stat_snapshot.get_checksum(file_relpath, file_stat, algorithm)
+                if checksum_index is not None and cached_checksum is None:
+                    cached_checksum = checksum_index.get_checksum(file_stat, algorithm)
+                if cached_checksum is not None:
+                    yield ((file_srcpath, file_relpath, file_stat, cached_checksum), None)
+                else:
+                    yield ((file_srcpath, file_relpath, file_stat, None), file_srcpath)
+            for dir_entry in dir_entries:
+                dir_relpath = dir_entry.path[(1+src_path_len):]
+                checksums[dir_relpath] = dedup_get_checksum_based_name(0,0,dir_entry.lstat().st_mode)
+
+    for ((file_srcpath, file_relpath, file_stat, cached_checksum), file_digest) in \
+            get_checksums_in_parallel(_files_to_checksum(), algorithm=algorithm, workers=workers):
+        file_checksum = cached_checksum
+        if file_checksum is None:
+            file_checksum = get_prefixed_checksum(file_digest, algorithm)
+            if checksum_index is not None:
+                checksum_index.set_checksum(file_stat, file_checksum)
+        checksum_filename = dedup_get_checksum_based_name(file_checksum, file_stat.st_size, file_stat.st_mode)
+        if checksum_filename is None:
+            print >>sys.stderr, "Warning: unable to get checksum name for %s; skipping file." % file_srcpath
+            continue
+        checksums[file_relpath] = checksum_filename
     return checksums
 
 
+def _get_git_blob_checksums(src_path, algorithm):
+    ''' Return the git blob checksums of committed files under src_path (see angel.util.git_checksums) when hashing with
+        the "git" algorithm, whose checksums are git blob ids; otherwise (or if src_path isn't a git checkout) an empty dict. '''
+    if algorithm != 'git':
+        return {}
+    git_checksums = get_git_blob_checksums(src_path)
+    if git_checksums is None:
+        print >>sys.stderr, "Warning: %s isn't a git checkout; hashing every file." % src_path
+        return {}
+    return git_checksums
+
+
+def _get_git_blob_checksum(git_checksums, file_relpath, file_stat):
+    ''' Return the checksum from git_checksums for the given file, or None if it's not there or its size doesn't match. '''
+    entry = git_checksums.get(file_relpath)
+    if entry is None or entry[1] != file_stat.st_size:
+        return None
+    return entry[0]
+
+
 def dedup_get_info_from_checksum(file_checksum):
     ''' Given a checksum, return some info about the file (see dedup_get_checksum_based_name). '''
     try:
         (file_checksum, file_size, file_mode) = file_checksum.split('.')
-        return {'checksum': file_checksum, 'size': int(file_size), 'mode': int(file_mode)}
+        return {'checksum': file_checksum,
+                'algorithm': split_prefixed_checksum(file_checksum)[0],
+                'size': int(file_size),
+                'mode': int(file_mode)}
     except Exception as e:
         print >>sys.stderr, "Error: unable to parse checksum %s." % file_checksum
         return None
@@ -62,17 +130,46 @@ def dedup_get_info_from_checksum(file_checksum):
 def dedup_get_checksum_based_name(file_checksum, file_size, file_mode):
     ''' Return a checksum string for files. We use file_size as a minor extra check; we need file_mode because hard links can only have one permission set across all instances.
         Use '0' for a file_checksum of a directory.
+        file_checksum should come from angel.util.checksum.get_prefixed_checksum, so that names record which algorithm
+        produced them: legacy md5 names are "<md5>.<size>.<mode>", all others are "<algorithm>-<hexdigest>.<size>.<mode>".
     '''
     if file_checksum is None:
         return None
     return '%s.%s.%s' % (file_checksum, file_size, file_mode)
 
 
+def dedup_is_safe_manifest_path(path):
+    ''' Return True if path is one that a manifest can list: relative, non-empty, and not going up out of the tree.
+        Manifests can come from other hosts (e.g. version packs), so callers creating files from them check each path. '''
+    if not len(path) or path.startswith('/'):
+        return False
+    return not len([part for part in path.split('/') if part in ('', '.', '..')])
+
+
+def dedup_check_manifest(file_checksums, symlinks=None):
+    ''' Throw an AngelVersionException if any path in file_checksums or symlinks isn't safe to create (see
+        dedup_is_safe_manifest_path), or if any checksum name has a path separator in it. '''
+    for path in list(file_checksums) + list(symlinks or {}):
+        if not dedup_is_safe_manifest_path(path):
+            raise angel.exceptions.AngelVersionException("Unsafe path '%s' in manifest" % path)
+    for checksum in file_checksums.itervalues():
+        if '/' in checksum:
+            raise angel.exceptions.AngelVersionException("Invalid checksum '%s' in manifest" % checksum)
+
+
 def dedup_load_checksum_file(checksum_file):
     ''' Given a file that has one checksum entry per line, "<checksum><space><path>", return a dict of path to checksum.
-        Note that path may contain spaces! '''
+        Note that path may contain spaces!
+        Binary manifests (see angel.util.checksum_manifest) are detected automatically; for those, a read-only dict-like
+        BinaryChecksumManifest is returned instead, which looks entries up in place rather than loading them all. '''
     if not os.path.isfile(checksum_file):
         return None
+    if is_binary_checksum_manifest(checksum_file):
+        try:
+            return BinaryChecksumManifest(checksum_file)
+        except (IOError, ValueError) as e:
+            print >>sys.stderr, "Error loading %s: %s" % (checksum_file, e)
+            return None
     checksums = {}
     try:
         for line in open(checksum_file, 'r').read().split('\n'):
@@ -85,27 +182,379 @@ def dedup_load_checksum_file(checksum_file):
     return checksums
 
 
-def dedup_get_unknown_checksums_in_manifest(file_checksums, hardlink_checksum_dir):
-    ''' Given a checksum dictionary (path to checksum), return a list of all checksum files that don't exist in hardlink_checksum_dir. '''
+def dedup_write_checksum_file(checksum_file, checksums):
+    ''' Atomically write a dict of path to checksum to checksum_file, in the format read by dedup_load_checksum_file. '''
+    checksum_file_tmp = '%s-%s' % (checksum_file, time.time())
+    try:
+        with open(checksum_file_tmp, 'w') as f:
+            for (path, checksum) in sorted(checksums.items()):
+                f.write('%s %s\n' % (checksum, path))
+        os.rename(checksum_file_tmp, checksum_file)
+    finally:
+        if os.path.exists(checksum_file_tmp):
+            os.remove(checksum_file_tmp)
+
+
+def dedup_get_changed_checksums(tree_manifest, known_tree_manifest):
+    ''' Return a dict of path to checksum of the entries of tree_manifest that aren't the same in known_tree_manifest
+        (both TreeManifests), without going through the subtrees they have in common. '''
+    return dict([(path, new_checksum) for (path, old_checksum, new_checksum) in diff_tree_manifests(known_tree_manifest, tree_manifest)
+                 if new_checksum is not None])
+
+
+def dedup_get_unknown_checksums_in_manifest(file_checksums, hardlink_checksum_dir, tree_manifest=None, known_tree_manifest=None):
+    ''' Given a checksum dictionary (path to checksum), return a list of all checksum files that don't exist in hardlink_checksum_dir.
+        If tree_manifest (the TreeManifest of file_checksums) and known_tree_manifest (that of a tree whose files are all
+        in hardlink_checksum_dir, e.g. an installed version) are given, only the files that differ between the two are
+        looked up, skipping the subtrees they have in common (see angel.util.tree_manifest). '''
     # The eventual intent here is that, given a checksum manifest for a build, we can generate a list of the files
     # that we don't know about, pull them down from a central repo, and then trigger a version install with dedup_create_copy_from_manifest.
     # This would greatly speed things up and would also mean that "version diffs" wouldn't require any sort of sequential roll-out;
     # just a "here's what's missing to create the requested version."
-    if not os.path.isdir(hardlink_checksum_dir):
+    if tree_manifest is not None and known_tree_manifest is not None:
+        file_checksums = dedup_get_changed_checksums(tree_manifest, known_tree_manifest)
+    file_checksum_names = set([checksum for checksum in file_checksums.values() if not checksum.startswith('0.')])  # '0.' entries are dirs
+    blob_store = DedupBlobStore(hardlink_checksum_dir)
+    if not blob_store.exists():
         print >>sys.stderr, "Warning: no directory found at %s." % hardlink_checksum_dir
-        return set(file_checksums.keys())
-    return set(file_checksums.keys()) - set(os.listdir(hardlink_checksum_dir))
+        return file_checksum_names
+    return set([checksum for checksum in file_checksum_names if not blob_store.contains(checksum)])
+
+
+def dedup_diff_checksums(old_checksums, new_checksums, hardlink_checksum_dir=None):
+    ''' Compare two checksum dictionaries (e.g. the manifests of two versions) without touching the files they describe.
+        Returns a dict with:
+          added, removed, changed: sorted lists of file paths (dirs aren't included)
+          new_bytes, new_files: size and count of distinct files in new_checksums that need adding to the dedup dir
+          shared_bytes, shared_files: size and count of distinct files in new_checksums that can be hardlinked instead
+        A file can be hardlinked if old_checksums has it or, when hardlink_checksum_dir is given, if the dedup dir does. '''
+    added = []
+    removed = []
+    changed = []
+    for (path, checksum) in new_checksums.iteritems():
+        if checksum.startswith('0.'):
+            continue  # '0.' entries are dirs
+        old_checksum = old_checksums.get(path)
+        if old_checksum is None or old_checksum.startswith('0.'):
+            added.append(path)
+        elif old_checksum != checksum:
+            changed.append(path)
+    for (path, checksum) in old_checksums.iteritems():
+        if not checksum.startswith('0.') and path not in new_checksums:
+            removed.append(path)
+
+    blob_store = None
+    if hardlink_checksum_dir is not None and os.path.isdir(hardlink_checksum_dir):
+        blob_store = DedupBlobStore(hardlink_checksum_dir)
+    old_checksum_names = set(old_checksums.itervalues())
+    ret_val = {'added': sorted(added), 'removed': sorted(removed), 'changed': sorted(changed),
+               'new_bytes': 0, 'new_files': 0, 'shared_bytes': 0, 'shared_files': 0}
+    for checksum_filename in set(new_checksums.itervalues()):
+        if checksum_filename.startswith('0.'):
+            continue
+        info = dedup_get_info_from_checksum(checksum_filename)
+        if info is None:
+            continue
+        if checksum_filename in old_checksum_names or (blob_store is not None and blob_store.contains(checksum_filename)):
+            ret_val['shared_bytes'] += info['size']
+            ret_val['shared_files'] += 1
+        else:
+            ret_val['new_bytes'] += info['size']
+            ret_val['new_files'] += 1
+    return ret_val
+
+
+def dedup_diff_tree_manifests(old_tree, new_tree, hardlink_checksum_dir):
+    ''' Like dedup_diff_checksums, but for two TreeManifests (see angel.util.tree_manifest), descending only into the
+        dirs that differ, so the cost depends on how much changed rather than on the size of the trees.
+        "Shared" means the same as there: in old_tree or in the dedup dir. Files outside the changed dirs are in both
+        trees; changed files are looked up in the dedup dir, and only those it doesn't have are looked for in the rest
+        of old_tree. '''
+    added = []
+    removed = []
+    changed = []
+    candidate_checksums = set()
+    for (path, old_checksum, new_checksum) in diff_tree_manifests(old_tree, new_tree):
+        old_is_file = old_checksum is not None and not old_checksum.startswith('0.')
+        new_is_file = new_checksum is not None and not new_checksum.startswith('0.')
+        if new_is_file:
+            candidate_checksums.add(new_checksum)
+            if old_is_file:
+                changed.append(path)
+            else:
+                added.append(path)
+        elif old_is_file:
+            removed.append(path)
+
+    blob_store = None
+    if hardlink_checksum_dir is not None and os.path.isdir(hardlink_checksum_dir):
+        blob_store = DedupBlobStore(hardlink_checksum_dir)
+    ret_val = {'added': sorted(added), 'removed': sorted(removed), 'changed': sorted(changed),
+               'new_bytes': 0, 'new_files': 0, 'shared_bytes': 0, 'shared_files': 0}
+    new_checksums = set([checksum_filename for checksum_filename in candidate_checksums
+                         if blob_store is None or not blob_store.contains(checksum_filename)])
+    if len(new_checksums):
+        new_checksums.difference_update([checksum_filename for (path, checksum_filename) in old_tree.iteritems()])
+    for checksum_filename in new_checksums:
+        info = dedup_get_info_from_checksum(checksum_filename)
+        if info is not None:
+            ret_val['new_bytes'] += info['size']
+            ret_val['new_files'] += 1
+    ret_val['shared_bytes'] = new_tree.distinct_bytes - ret_val['new_bytes']
+    ret_val['shared_files'] = new_tree.distinct_files - ret_val['new_files']
+    return ret_val
+
+
+def dedup_import_blobs_from_dir(file_checksums, blob_source_dir, hardlink_checksum_dir, sleep_ratio=0, io_governor=None):
+    ''' Copy the files listed in file_checksums that are missing from hardlink_checksum_dir in from blob_source_dir.
+        blob_source_dir can hold blobs named by checksum either directly or in fan-out dirs, so another host's
+        hardlink_checksum_dir (e.g. over NFS) works as a source. Contents are verified against their checksums.
+        Returns (files_added, bytes_added); files not found in blob_source_dir are skipped.
+        Work is throttled by io_governor (an IOGovernor) if given, otherwise by sleep_ratio. '''
+    if io_governor is None:
+        io_governor = IOGovernor(sleep_ratio=sleep_ratio)
+    blob_store = DedupBlobStore(hardlink_checksum_dir)
+    blob_store.create_if_needed()
+    source_store = DedupBlobStore(blob_source_dir)
+    added_count = 0
+    added_bytes = 0
+    for checksum_filename in sorted(dedup_get_unknown_checksums_in_manifest(file_checksums, hardlink_checksum_dir)):
+        source_path = source_store.find(checksum_filename)
+        if source_path is None:
+            continue
+        with open(source_path, 'rb') as f:
+            blob_store.add_stream(f, checksum_filename)
+        added_count += 1
+        added_bytes += dedup_get_info_from_checksum(checksum_filename)['size']
+        io_governor.account(bytes=dedup_get_info_from_checksum(checksum_filename)['size'])
+    return (added_count, added_bytes)
 
 
-def dedup_create_copy_from_manifest(file_checksums, dest_path, hardlink_checksum_dir, sleep_ratio=0):
+def dedup_import_blobs_from_tarfile(file_checksums, fileobj, hardlink_checksum_dir, sleep_ratio=0, io_governor=None):
+    ''' Like dedup_import_blobs_from_dir, but reads blobs from a (optionally compressed) tar stream, such as stdin.
+        Tar members are matched by their basename; members that aren't needed are skipped. The stream is read
+        sequentially, so it doesn't need to be seekable. Returns (files_added, bytes_added). '''
+    try:
+        tar = tarfile.open(fileobj=fileobj, mode='r|*')
+    except tarfile.TarError as e:
+        raise angel.exceptions.AngelVersionException("Unable to read blob tarball: %s" % e)
+    try:
+        return dedup_import_blobs_from_tar(file_checksums, tar, hardlink_checksum_dir, sleep_ratio=sleep_ratio, io_governor=io_governor)
+    finally:
+        tar.close()
+
+
+def dedup_import_blobs_from_tar(file_checksums, tar, hardlink_checksum_dir, sleep_ratio=0, io_governor=None):
+    ''' Like dedup_import_blobs_from_tarfile, but reads the remaining members of an already-open tarfile.TarFile (e.g.
+        one returned by dedup_open_version_pack). The caller closes tar. Returns (files_added, bytes_added). '''
+    if io_governor is None:
+        io_governor = IOGovernor(sleep_ratio=sleep_ratio)
+    blob_store = DedupBlobStore(hardlink_checksum_dir)
+    blob_store.create_if_needed()
+    unknown_checksums = dedup_get_unknown_checksums_in_manifest(file_checksums, hardlink_checksum_dir)
+    added_count = 0
+    added_bytes = 0
+    try:
+        # Call next() directly rather than iterating, as iterating would start over with members already read:
+        member = tar.next()
+        while member is not None:
+            checksum_filename = os.path.basename(member.name)
+            if member.isfile() and checksum_filename in unknown_checksums:
+                blob_store.add_stream(tar.extractfile(member), checksum_filename)
+                unknown_checksums.remove(checksum_filename)
+                added_count += 1
+                added_bytes += member.size
+                io_governor.account(bytes=member.size)
+            member = tar.next()
+    except tarfile.TarError as e:
+        raise angel.exceptions.AngelVersionException("Unable to read blob tarball: %s" % e)
+    return (added_count, added_bytes)
+
+
+def dedup_import_blobs_from_git(file_checksums, repo_path, hardlink_checksum_dir, sleep_ratio=0, io_governor=None):
+    ''' Copy the files listed in file_checksums that hardlink_checksum_dir doesn't have yet out of the git repo at
+        repo_path, streaming them from a single "git cat-file --batch" process (see angel.util.git_checksums).
+        Only "git" checksums can be found this way: the checksum is the id of the blob to read. The blobs are verified
+        as they're added (see DedupBlobStore.add_stream). Returns (files_added, bytes_added). '''
+    if io_governor is None:
+        io_governor = IOGovernor(sleep_ratio=sleep_ratio)
+    blob_store = DedupBlobStore(hardlink_checksum_dir)
+    blob_store.create_if_needed()
+    added_count = 0
+    added_bytes = 0
+    with GitObjectReader(repo_path) as git_reader:
+        # Sorted by blob id, so that reads go through the repo's packs in a stable order:
+        for checksum_filename in sorted(dedup_get_unknown_checksums_in_manifest(file_checksums, hardlink_checksum_dir)):
+            (algorithm, object_id) = split_prefixed_checksum(checksum_filename.split('.', 1)[0])
+            if algorithm != 'git':
+                raise angel.exceptions.AngelVersionException("Can't get %s from a git repo (not a git checksum)" % checksum_filename)
+            (size, fileobj) = git_reader.open_blob(object_id)
+            blob_store.add_stream(fileobj, checksum_filename)
+            added_count += 1
+            added_bytes += size
+            io_governor.account(bytes=size)
+    return (added_count, added_bytes)
+
+
+# Version packs: a single tar stream holding a version's manifest plus only the blobs that a host with a given base
+# version lacks, for shipping upgrades between hosts. Members are, in order:
+#   angel-version-pack     "<key> <value>" lines: format, branch, version and base (or "-")
+#   manifest               the version's checksum file (see dedup_write_checksum_file)
+#   blobs/<checksum name>  one per blob that's in the manifest but not in the base version's manifest
+# The manifest comes before the blobs, so a reader knows what it needs before the blobs arrive, and can stream them
+# straight into the dedup dir without extracting the pack anywhere first.
+_VERSION_PACK_INFO_NAME = 'angel-version-pack'
+_VERSION_PACK_MANIFEST_NAME = 'manifest'
+_VERSION_PACK_FORMAT = '1'
+
+
+def dedup_write_version_pack(fileobj, file_checksums, hardlink_checksum_dir, base_checksums=None, pack_info=None, io_governor=None):
+    ''' Write a version pack (see above) of the version with the given manifest to fileobj, which is written to
+        sequentially (e.g. stdout). Blobs listed in base_checksums (a manifest) are left out. pack_info is a dict of extra
+        info to record (e.g. branch, version, base); keys and values may not contain spaces or newlines.
+        Throws AngelVersionException if a blob is missing from hardlink_checksum_dir. Returns (blobs_written, bytes_written). '''
+    if io_governor is None:
+        io_governor = IOGovernor()
+    blob_store = DedupBlobStore(hardlink_checksum_dir)
+    blob_names = set([checksum for checksum in file_checksums.values() if not checksum.startswith('0.')])  # '0.' entries are dirs
+    if base_checksums is not None:
+        blob_names.difference_update(base_checksums.values())
+    now = int(time.time())
+
+    def _add_string_member(tar, name, data):
+        tarinfo = tarfile.TarInfo(name)
+        tarinfo.size = len(data)
+        tarinfo.mtime = now
+        tarinfo.mode = 0644
+        tar.addfile(tarinfo, cStringIO.StringIO(data))
+
+    info = dict(pack_info or {})
+    info['format'] = _VERSION_PACK_FORMAT
+    blob_count = 0
+    blob_bytes = 0
+    tar = tarfile.open(fileobj=fileobj, mode='w|')
+    try:
+        _add_string_member(tar, _VERSION_PACK_INFO_NAME, ''.join(['%s %s\n' % (key, info[key]) for key in sorted(info)]))
+        _add_string_member(tar, _VERSION_PACK_MANIFEST_NAME,
+                           ''.join(['%s %s\n' % (checksum, path) for (path, checksum) in sorted(file_checksums.items())]))
+        for checksum_filename in sorted(blob_names):
+            blob_path = blob_store.find(checksum_filename)
+            if blob_path is None:
+                raise angel.exceptions.AngelVersionException("Blob %s is missing from the dedup dir" % checksum_filename)
+            blob_info = dedup_get_info_from_checksum(checksum_filename)
+            tarinfo = tarfile.TarInfo('blobs/%s' % checksum_filename)
+            tarinfo.size = blob_info['size']
+            tarinfo.mtime = now
+            tarinfo.mode = stat.S_IMODE(blob_info['mode'])
+            with open(blob_path, 'rb') as f:
+                tar.addfile(tarinfo, f)
+            blob_count += 1
+            blob_bytes += blob_info['size']
+            io_governor.account(bytes=blob_info['size'])
+    finally:
+        tar.close()  # Writes the end-of-archive blocks; fileobj itself is left open
+    return (blob_count, blob_bytes)
+
+
+def dedup_open_version_pack(fileobj):
+    ''' Start reading a version pack (see dedup_write_version_pack) from fileobj, which is read sequentially (e.g. stdin).
+        Returns (tar, pack_info, file_checksums); pass tar to dedup_import_blobs_from_tar to read the blobs, then close it.
+        Throws AngelVersionException if fileobj doesn't start with a version pack. '''
+    try:
+        tar = tarfile.open(fileobj=fileobj, mode='r|*')
+        info_member = tar.next()
+        if info_member is None or info_member.name != _VERSION_PACK_INFO_NAME:
+            raise angel.exceptions.AngelVersionException("Not a version pack (no %s header)" % _VERSION_PACK_INFO_NAME)
+        pack_info = {}
+        for line in tar.extractfile(info_member).read().split('\n'):
+            if len(line):
+                (key, value) = line.split(' ', 1)
+                pack_info[key] = value
+        if pack_info.get('format') != _VERSION_PACK_FORMAT:
+            raise angel.exceptions.AngelVersionException("Unsupported version pack format '%s'" % pack_info.get('format'))
+        manifest_member = tar.next()
+        if manifest_member is None or manifest_member.name != _VERSION_PACK_MANIFEST_NAME:
+            raise angel.exceptions.AngelVersionException("Version pack is missing its manifest")
+        file_checksums = {}
+        for line in tar.extractfile(manifest_member).read().split('\n'):
+            if len(line):
+                (checksum, path) = line.split(' ', 1)
+                file_checksums[path] = checksum
+    except (tarfile.TarError, ValueError) as e:
+        raise angel.exceptions.AngelVersionException("Unable to read version pack: %s" % e)
+    dedup_check_manifest(file_checksums)
+    return (tar, pack_info, file_checksums)
+
+
+def dedup_migrate_hardlinks(hardlink_checksum_dir, algorithm, sleep_ratio=0, max_seconds=None, verbose=True, io_governor=None):
+    ''' Rename legacy md5-named files in hardlink_checksum_dir to names using the given checksum algorithm.
+        Each old name is recorded as an alias of its new name, so manifests that use md5 checksums still resolve.
+        This is meant to run in the background: it's throttled by io_governor (or sleep_ratio), stops after max_seconds,
+        and can be interrupted and re-run at any time. Returns the number of legacy files that remain. '''
+    if io_governor is None:
+        io_governor = IOGovernor(sleep_ratio=sleep_ratio)
+    if algorithm == 'md5':
+        raise angel.exceptions.AngelVersionException("md5 is the legacy checksum algorithm; nothing to migrate to.")
+    blob_store = DedupBlobStore(hardlink_checksum_dir)
+    blob_store.check_safety_file()
+
+    # Drop aliases whose files have since been removed as unused, so the alias file doesn't grow without bound:
+    blob_store.prune_aliases()
+
+    start_time = time.time()
+    migrated_count = 0
+    remaining_count = 0
+    for (name, old_path) in list(blob_store.iter_blobs()):
+        info = dedup_get_info_from_checksum(name)
+        if info is None or info['algorithm'] != 'md5':
+            continue
+        if max_seconds is not None and time.time() - start_time > max_seconds:
+            remaining_count += 1
+            continue
+        new_name = dedup_get_checksum_based_name(get_prefixed_checksum(get_checksum_of_file(old_path, algorithm), algorithm),
+                                                 info['size'], info['mode'])
+        if new_name is None:
+            remaining_count += 1
+            continue
+        if blob_store.contains(new_name):
+            # The same content was also added under the new name; both copies stay, as version files link to each of them.
+            remaining_count += 1
+            continue
+        blob_store.rename_with_alias(name, new_name)
+        migrated_count += 1
+        io_governor.account(bytes=info['size'], ops=2)  # Read to hash, then the alias append and the rename
+        if migrated_count % 100 == 0:
+            if verbose:
+                sys.stdout.write('.')
+                sys.stdout.flush()
+
+    if verbose:
+        print >>sys.stderr, "Migrated %s files to %s checksums (%s remaining; %.1f seconds)." % \
+                            (migrated_count, algorithm, remaining_count, time.time() - start_time)
+    return remaining_count
+
+
+def dedup_create_copy_from_manifest(file_checksums, dest_path, hardlink_checksum_dir, sleep_ratio=0, io_governor=None, symlinks=None,
+                                    link_workers=None):
     ''' Given a checksum dictionary, generate a directory at dest_path with hardlinks to the checksummed files found in hardlink_checksum_dir.
-        hardlink_checksum_dir MUST contain all files listed in file_checksums before this is called. '''
+        hardlink_checksum_dir MUST contain all files listed in file_checksums before this is called.
+        Manifests don't list symlinks; symlinks (a dict of path to link target) are created after everything else.
+        The dir skeleton is created first, then links are made across up to <link_workers> threads (see
+        angel.util.parallel_link.ParallelLinker; None for the default, 1 to make them one at a time).
+        Work is throttled by io_governor (an IOGovernor) if given, otherwise by sleep_ratio. '''
+    if io_governor is None:
+        io_governor = IOGovernor(sleep_ratio=sleep_ratio)
     if file_checksums is None or len(file_checksums) == 0:
         print >>sys.stderr, "Error: invalid file checksum list."
         return 1
     if os.path.exists(dest_path):
-        print >>sys.stderr, "Error: dest path '%s' already exists."
+        print >>sys.stderr, "Error: dest path '%s' already exists." % dest_path
         return 2
+    try:
+        dedup_check_manifest(file_checksums, symlinks)
+    except angel.exceptions.AngelVersionException as e:
+        print >>sys.stderr, "Error: %s." % e
+        return 9
     dest_path_tmp = os.path.join(os.path.dirname(dest_path), ".dedup_creating_%s" % os.path.basename(dest_path))
     if os.path.exists(dest_path_tmp):
         print >>sys.stderr, "Error: tmp dest path '%s' exists." % dest_path_tmp
@@ -115,31 +564,36 @@ def dedup_create_copy_from_manifest(file_checksums, dest_path, hardlink_checksum
     except Exception as e:
         print >>sys.stderr, "Error: unable to make tmp dir %s: %s" % (dest_path_tmp, e)
         return 4
+    linker = ParallelLinker(link_workers)
     try:
-        count = 0
-        start_time = time.time()
-        seconds_slept = 0
+        blob_store = DedupBlobStore(hardlink_checksum_dir)
+        # Check every entry and create the dirs first, so that the files can then be linked in across threads:
+        file_paths = []
         for path in sorted(file_checksums):
-            count += 1
-            if count % 400 == 0:
-                seconds_slept += _dedup_microsleep(start_time, seconds_slept, sleep_ratio)
-            full_path = os.path.join(dest_path_tmp, path)
             path_info = dedup_get_info_from_checksum(file_checksums[path])
             if path_info['mode'] & stat.S_ISUID:
                 print >>sys.stderr, "Error: setuid bit set for path %s." % path
                 return 5
             if stat.S_ISDIR(path_info['mode']):
-                os.mkdir(full_path, stat.S_IMODE(path_info['mode']))
+                io_governor.account()
+                os.mkdir(os.path.join(dest_path_tmp, path), stat.S_IMODE(path_info['mode']))
             elif stat.S_ISREG(path_info['mode']):
-                hardlink_src = os.path.join(hardlink_checksum_dir, file_checksums[path])
-                try:
-                    os.link(hardlink_src, full_path)
-                except Exception as e:
-                    print >>sys.stderr, "Error: unable to create link %s -> %s: %s" % (hardlink_src, full_path, e)
-                    return 6
+                file_paths.append(path)
             else:
                 print >>sys.stderr, "Error: unknown file type (%s: %s)" % (path, path_info['mode'])
                 return 7
+        try:
+            for path in file_paths:
+                io_governor.account()
+                hardlink_src = blob_store.find(file_checksums[path]) or blob_store.get_path(file_checksums[path])
+                linker.link(hardlink_src, os.path.join(dest_path_tmp, path))
+            for path in sorted(symlinks or {}):
+                io_governor.account()
+                linker.symlink(symlinks[path], os.path.join(dest_path_tmp, path))
+            linker.finish()
+        except OSError as e:
+            print >>sys.stderr, "Error: unable to create link: %s" % e
+            return 6
 
         # Only move the new dir in place after everything has been created:
         try:
@@ -152,13 +606,16 @@ def dedup_create_copy_from_manifest(file_checksums, dest_path, hardlink_checksum
         print >>sys.stderr, "Error: interrupt received; removing new version."
 
     finally:
+        linker.close()
         if os.path.isdir(dest_path_tmp):
             shutil.rmtree(dest_path_tmp)
 
     return 0
 
 
-def dedup_create_copy(src_path, dest_path, hardlink_checksum_dir, file_checksums=None, sleep_ratio=0):
+def dedup_create_copy(src_path, dest_path, hardlink_checksum_dir, file_checksums=None, sleep_ratio=0, workers=1, checksum_index=None,
+                      algorithm=DEFAULT_CHECKSUM_ALGORITHM, io_governor=None, resumable=False, link_workers=None,
+                      unknown_checksums=None):
     ''' Given a src path, create a versioned copy of it under dest_path; throws exception on any error
         The directory at hardlink_checksum_dir is used to create hardlinks for the copies; it must be on the same partition as dest_path.
 
@@ -167,19 +624,39 @@ def dedup_create_copy(src_path, dest_path, hardlink_checksum_dir, file_checksums
         Files in the list must NOT start with "./" -- e.g. "foo.txt" -> 4d622415ef92bd8d53ac23688f61d873, "bar/foo.txt" -> 525....
         (Using this hash will speed up deploys where the checksums can be calculated in advance, e.g. on a build server.)
 
+        Returns a dict of path to checksum for every file and dir in the new copy (symlinks aren't included), suitable
+        for dedup_write_checksum_file; this is what remove_unused_links_in_manifest needs when the copy is later removed.
+
+        Files that need checksumming are hashed with the given algorithm across up to <workers> processes (None for one per cpu);
+        checksums given in file_checksums may use any algorithm, so build-server manifests and the pool can differ.
+        If checksum_index (a ChecksumIndex) is given, it's consulted before hashing a file and updated afterwards;
+        the caller is responsible for calling checksum_index.save().
+        With the "git" algorithm, committed files in a git checkout are given their git blob ids without being read.
+
+        Work is throttled by io_governor (an IOGovernor) if given, otherwise by sleep_ratio.
+
+        Files are linked into the copy across up to <link_workers> threads (see angel.util.parallel_link.ParallelLinker;
+        None for the default, 1 to link them one at a time as they're walked); each dir is created before anything in it.
+        If unknown_checksums is given, it's the set of checksum names in file_checksums that may be missing from the dedup
+        dir (see dedup_get_unknown_checksums_in_manifest with tree manifests); files with any other name in file_checksums
+        are linked without looking them up in the dedup dir first. That's only an optimization: files that turn out not to
+        be where they're expected are still found (or added) as usual.
+
+        If resumable is True, progress is recorded in an InstallJournal next to the tmp copy, and a failed copy is left
+        in place rather than removed, so that calling this again picks up where it left off: files the journal records
+        as done are neither re-hashed nor re-linked, provided the source file is unchanged and the partial copy still
+        links it to the right dedup file. Anything else in the partial copy is redone or removed.
+
         '''
 
-    if sleep_ratio > 0.999:
-        print >>sys.stderr, "Warning: sleep ratio '%s' too large; using 0.99" % sleep_ratio
-        sleep_ratio = 0.99
-    if sleep_ratio < 0:
-        sleep_ratio = 0
+    if io_governor is None:
+        io_governor = IOGovernor(sleep_ratio=sleep_ratio)
 
     file_checksums = file_checksums or {}
     src_path = os.path.abspath(os.path.expanduser(src_path))
     dest_path_final = os.path.abspath(os.path.expanduser(dest_path))
     dest_path_tmp = os.path.join(os.path.dirname(dest_path_final), ".dedup_creating_%s" % os.path.basename(dest_path_final))
-    hardlink_checksum_dir = os.path.abspath(os.path.expanduser(hardlink_checksum_dir))
+    blob_store = DedupBlobStore(hardlink_checksum_dir)
 
     if not os.path.isdir(src_path):
         raise angel.exceptions.AngelVersionException("Unable to create copy (missing source path '%s')" % src_path)
@@ -190,39 +667,102 @@ def dedup_create_copy(src_path, dest_path, hardlink_checksum_dir, file_checksums
     if os.path.exists(dest_path_final):
         raise angel.exceptions.AngelVersionException("Unable to create copy (version path '%s' already exists)" % dest_path_final)
 
-    if os.path.exists(dest_path_tmp):
+    journal = None
+    if resumable:
+        if not os.path.isdir(os.path.dirname(dest_path_tmp)):
+            os.makedirs(os.path.dirname(dest_path_tmp))
+        journal = InstallJournal('%s.journal' % dest_path_tmp, src_path)
+        journal.open()
+
+    if os.path.exists(dest_path_tmp) and (journal is None or not journal.is_resuming):
+        if journal is not None:
+            journal.remove()
         raise angel.exceptions.AngelVersionException("tmp dest path '%s' already exists." % dest_path_tmp)
 
-    try:
-        if not os.path.isdir(os.path.dirname(hardlink_checksum_dir)):
-            os.makedirs(os.path.dirname(hardlink_checksum_dir))  # Make parent dirs with default umask
-        if not os.path.isdir(hardlink_checksum_dir):
-            os.makedirs(hardlink_checksum_dir, mode=0700)
-            # Touch a file that we verify exists in remove_unused_links, as a safety check:
-            open(os.path.join(hardlink_checksum_dir, ".dedup_safety_check"), "w").write(str(time.time()))
-            # Create a hardlink to the safety file, so that the link count is >1, just to avoid potentially manually clearing it for nlink=1 checks:
-            os.link(os.path.join(hardlink_checksum_dir, ".dedup_safety_check"), os.path.join(hardlink_checksum_dir, ".dedup_safety_check-2"))
-    except Exception as e:
-        raise angel.exceptions.AngelVersionException("can't make hardlink_checksum_dir %s: %s" %
-                                                     (hardlink_checksum_dir, e))
+    blob_store.create_if_needed()
+    git_checksums = _get_git_blob_checksums(src_path, algorithm)
 
-    start_time = time.time()
-    seconds_slept = 0
     files_missing_checksums = ()
+    created_checksums = {}
+    linker = ParallelLinker(link_workers)
+    is_complete = False
+    resumed_paths = None  # When resuming, every relpath in the new copy, so leftovers from the earlier attempt can be removed
+    if journal is not None and journal.is_resuming:
+        resumed_paths = set()
+
+    def _is_linked_to_blob(file_destpath, checksum_filename):
+        hardlink_master_path = blob_store.find(checksum_filename)
+        try:
+            return hardlink_master_path is not None and os.lstat(file_destpath).st_ino == os.lstat(hardlink_master_path).st_ino
+        except OSError:
+            return False
+
+    def _remove_stale_dest(path):
+        if os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path)
+        elif os.path.lexists(path):
+            os.remove(path)
 
     try:
         try:
-            os.makedirs(dest_path_tmp)
+            if not os.path.isdir(dest_path_tmp):
+                os.makedirs(dest_path_tmp)
         except Exception as e:
             raise angel.exceptions.AngelVersionException("unable to create destination dir '%s': %s" %
                                                          (dest_path_tmp, e))
 
-        for (path, dirs, files) in os.walk(src_path):
-            for dir in dirs:
-                dir_srcpath = os.path.join(path, dir)
+        def _walk_src_path():
+            # Yield every dir and file in walk order; only files that still need a checksum are given a path to hash,
+            # so that hashing can be fanned out to workers while results stream back in the order we walked them.
+            # Files that a resumed journal shows as already linked are passed along with their checksum name instead.
+            for (path, dir_entries, file_entries) in walk_tree(src_path):
+                for dir_entry in dir_entries:
+                    yield ((dir_entry.path, True, dir_entry.lstat(), None, None), None)
+                for file_entry in file_entries:
+                    file_srcpath = file_entry.path
+                    file_relpath = file_srcpath[(1+len(src_path)):]
+                    file_stat = file_entry.lstat()
+                    if resumed_paths is not None and stat.S_ISREG(file_stat.st_mode):
+                        journaled_filename = journal.get_file(file_relpath, file_stat)
+                        if journaled_filename is not None and file_checksums.get(file_relpath, journaled_filename) == journaled_filename and \
+                                _is_linked_to_blob(os.path.join(dest_path_tmp, file_relpath), journaled_filename):
+                            yield ((file_srcpath, False, file_stat, None, journaled_filename), None)
+                            continue
+                    if not stat.S_ISREG(file_stat.st_mode) or file_relpath in file_checksums:
+                        yield ((file_srcpath, False, file_stat, None, None), None)
+                        continue
+                    cached_checksum = _get_git_blob_checksum(git_checksums, file_relpath, file_stat)
+                    if checksum_index is not None and cached_checksum is None:
+                        cached_checksum = checksum_index.get_checksum(file_stat, algorithm)
+                    if cached_checksum is not None:
+                        yield ((file_srcpath, False, file_stat, cached_checksum, None), None)
+                    else:
+                        yield ((file_srcpath, False, file_stat, None, None), file_srcpath)
+
+        for ((entry_srcpath, is_dir, file_stat, cached_checksum, journaled_filename), file_digest) in \
+                get_checksums_in_parallel(_walk_src_path(), algorithm=algorithm, workers=workers):
+            # Potentially sleep -- we support this so large copies can be time-sliced out, to reduce i/o pressure in prod systems.
+            # (The workers that hash files read ahead of us by a bounded amount, so sleeping here throttles them too.)
+            io_governor.account(bytes=(file_stat.st_size if file_digest is not None else 0))
+
+            if is_dir:
+                dir_srcpath = entry_srcpath
                 dir_relpath = dir_srcpath[(1+len(src_path)):]
                 dir_destpath = os.path.join(dest_path_tmp, dir_relpath)
-                if os.path.islink(dir_srcpath):
+                dir_stat = file_stat
+                if resumed_paths is not None:
+                    resumed_paths.add(dir_relpath)
+                    if stat.S_ISDIR(dir_stat.st_mode) and os.path.isdir(dir_destpath) and not os.path.islink(dir_destpath):
+                        if journal.has_dir(dir_relpath):
+                            journal.reused_dirs += 1
+                        else:
+                            journal.record_dir(dir_relpath)
+                        os.utime(dir_destpath, (dir_stat.st_atime, dir_stat.st_mtime))
+                        os.chmod(dir_destpath, stat.S_IMODE(dir_stat.st_mode))
+                        created_checksums[dir_relpath] = dedup_get_checksum_based_name(0, 0, dir_stat.st_mode)
+                        continue
+                    _remove_stale_dest(dir_destpath)
+                if stat.S_ISLNK(dir_stat.st_mode):
                     # If it's a dir symlink to another point inside the tree, do a relative path link, otherwise abspath link.
                     # Debian package policy is that links are relative -- even if outside the install tree -- if they point at
                     # files under the same root dir. E.g.: /usr/foo -> /usr/bar will result in a relative link between foo and bar.
@@ -233,46 +773,83 @@ def dedup_create_copy(src_path, dest_path, hardlink_checksum_dir, file_checksums
                     if not link_dest_abspath.startswith(src_path):
                         link_dest = link_dest_abspath
                     os.symlink(link_dest, dir_destpath)
-                elif os.path.isdir(dir_srcpath):  # note that symlinks to dirs returns True for this as well!
+                elif stat.S_ISDIR(dir_stat.st_mode):
                     os.mkdir(dir_destpath)
-                    shutil.copystat(dir_srcpath, dir_destpath)
+                    # Same as shutil.copystat(), but from the stat info we already have:
+                    os.utime(dir_destpath, (dir_stat.st_atime, dir_stat.st_mtime))
+                    os.chmod(dir_destpath, stat.S_IMODE(dir_stat.st_mode))
+                    created_checksums[dir_relpath] = dedup_get_checksum_based_name(0, 0, dir_stat.st_mode)
+                    if journal is not None:
+                        journal.record_dir(dir_relpath)
                 else:
                     raise angel.exceptions.AngelVersionException("unknown dir type at path '%s'." % dir_srcpath)
-            for file in files:
-                file_srcpath = os.path.join(path, file)
-                file_stat = os.lstat(file_srcpath)
-                file_relpath = file_srcpath[(1+len(src_path)):]
-                file_destpath = os.path.join(dest_path_tmp, file_relpath)
-                if stat.S_ISLNK(file_stat.st_mode):
-                    # See note above in dirs section about absolute vs relative link paths.
-                    link_dest = os.readlink(file_srcpath)
-                    link_dest_abspath = os.path.normpath(os.path.join(os.path.dirname(file_srcpath),link_dest))
-                    if not link_dest_abspath.startswith(src_path):
-                        link_dest = link_dest_abspath
-                    os.symlink(link_dest, file_destpath)
+                continue
+
+            file_srcpath = entry_srcpath
+            file_relpath = file_srcpath[(1+len(src_path)):]
+            file_destpath = os.path.join(dest_path_tmp, file_relpath)
+            if resumed_paths is not None:
+                resumed_paths.add(file_relpath)
+                if journaled_filename is not None:
+                    created_checksums[file_relpath] = journaled_filename
+                    journal.reused_files += 1
+                    journal.reused_bytes += file_stat.st_size
                     continue
-                if not stat.S_ISREG(file_stat.st_mode): 
-                    print >>sys.stderr, "Unsupported file type at %s" % file_srcpath
-                    return 7
-                if file_relpath in file_checksums:
-                    checksum_filename = file_checksums[file_relpath]
-                else:
-                    checksum_filename = dedup_get_checksum_based_name(get_md5_of_path_contents(file_srcpath), file_stat.st_size, file_stat.st_mode)
-                    if len(file_checksums) and file_relpath != ".angel/file_checksums":
-                        # Warn about files that exist that don't appear in the checksums file (except for the checksum file itself):
-                        files_missing_checksums += (file_relpath,)
-                if checksum_filename is None:
-                    print >>sys.stderr, "Error: unable to find checksum_filename for %s; bailing." % file_srcpath
-                    return 8
-                hardlink_master_path = os.path.join(hardlink_checksum_dir, checksum_filename)
-                if not os.path.exists(hardlink_master_path):
-                    shutil.copy2(file_srcpath, hardlink_master_path)
-                os.link(hardlink_master_path, file_destpath)
-
-            # After each dir, potentially sleep -- we support this so large copies can be time-sliced out, to reduce i/o pressure in prod systems:
-            seconds_slept += _dedup_microsleep(start_time, seconds_slept, sleep_ratio)
+                _remove_stale_dest(file_destpath)
+            if stat.S_ISLNK(file_stat.st_mode):
+                # See note above in dirs section about absolute vs relative link paths.
+                link_dest = os.readlink(file_srcpath)
+                link_dest_abspath = os.path.normpath(os.path.join(os.path.dirname(file_srcpath),link_dest))
+                if not link_dest_abspath.startswith(src_path):
+                    link_dest = link_dest_abspath
+                linker.symlink(link_dest, file_destpath)
+                continue
+            if not stat.S_ISREG(file_stat.st_mode):
+                raise angel.exceptions.AngelVersionException("unsupported file type at %s" % file_srcpath)
+            if file_relpath in file_checksums:
+                checksum_filename = file_checksums[file_relpath]
+            else:
+                file_checksum = cached_checksum
+                if file_checksum is None:
+                    file_checksum = get_prefixed_checksum(file_digest, algorithm)
+                    if checksum_index is not None:
+                        checksum_index.set_checksum(file_stat, file_checksum)
+                checksum_filename = dedup_get_checksum_based_name(file_checksum, file_stat.st_size, file_stat.st_mode)
+                if len(file_checksums) and file_relpath not in (".angel/file_checksums", ".angel/file_checksums.bin",
+                                                                 ".angel/file_checksums.tree"):
+                    # Warn about files that exist that don't appear in the checksums file (except for the checksum files themselves):
+                    files_missing_checksums += (file_relpath,)
+            if checksum_filename is None:
+                raise angel.exceptions.AngelVersionException("unable to find checksum_filename for %s" % file_srcpath)
+            created_checksums[file_relpath] = checksum_filename
+            record_file = None
+            if journal is not None:
+                # Only journal the file once it's linked:
+                record_file = functools.partial(journal.record_file, file_relpath, checksum_filename, file_stat)
+            if unknown_checksums is not None and file_relpath in file_checksums and checksum_filename not in unknown_checksums:
+                linker.link(blob_store.get_path(checksum_filename), file_destpath, callback=record_file,
+                            find_source=functools.partial(_find_or_add_blob, blob_store, file_srcpath, checksum_filename,
+                                                          file_stat.st_size, io_governor))
+                continue
+            hardlink_master_path = blob_store.find(checksum_filename)
+            if hardlink_master_path is None:
+                hardlink_master_path = blob_store.add_file(file_srcpath, checksum_filename)
+                io_governor.account(bytes=file_stat.st_size)
+            linker.link(hardlink_master_path, file_destpath, callback=record_file)
+
+        linker.finish()
+
+        if resumed_paths is not None:
+            # Remove anything left over from the earlier attempt that's no longer in the source:
+            for (path, dir_entries, file_entries) in walk_tree(dest_path_tmp):
+                for entry in dir_entries + file_entries:
+                    if entry.path[(1+len(dest_path_tmp)):] not in resumed_paths:
+                        _remove_stale_dest(entry.path)
+                        if entry in dir_entries:
+                            dir_entries.remove(entry)
 
         os.rename(dest_path_tmp, dest_path_final)
+        is_complete = True
 
     except Exception as e:
         raise angel.exceptions.AngelVersionException("failed to create copy: %s" % e)
@@ -281,17 +858,59 @@ def dedup_create_copy(src_path, dest_path, hardlink_checksum_dir, file_checksums
         raise angel.exceptions.AngelVersionException("interrupt received")
 
     finally:
-        if os.path.isdir(dest_path_tmp):
-            shutil.rmtree(dest_path_tmp)
+        linker.close()
+        if journal is None:
+            if os.path.isdir(dest_path_tmp):
+                shutil.rmtree(dest_path_tmp)
+        elif is_complete:
+            journal.remove()
+        else:
+            journal.close()
+            if os.path.isdir(dest_path_tmp):
+                print >>sys.stderr, "Partial copy kept at %s; re-run to resume it, or remove it and %s.journal to start over." % \
+                                    (dest_path_tmp, dest_path_tmp)
+
+    if resumed_paths is not None:
+        print >>sys.stderr, "Resumed interrupted copy: reused %s files (%s bytes) and %s dirs without re-hashing or re-linking them." % \
+                            (journal.reused_files, journal.reused_bytes, journal.reused_dirs)
 
     if len(files_missing_checksums) > 5:
         print >>sys.stderr, "Warning: %s files missing checksums" % len(files_missing_checksums)
 
+    if len(blob_store.copy_method_counts):
+        print >>sys.stderr, "Added %s new files to %s (%s)." % \
+                            (sum(blob_store.copy_method_counts.values()), blob_store.get_root(),
+                             ', '.join(['%s by %s' % (blob_store.copy_method_counts[method], method) for method in sorted(blob_store.copy_method_counts)]))
+
+    return created_checksums
+
 
-def dedup_files(path, sleep_ratio=0, verbose=True):
+def _find_or_add_blob(blob_store, file_srcpath, checksum_filename, size, io_governor):
+    hardlink_master_path = blob_store.find(checksum_filename)
+    if hardlink_master_path is None:
+        hardlink_master_path = blob_store.add_file(file_srcpath, checksum_filename)
+        io_governor.account(bytes=size)
+    return hardlink_master_path
+
+
+def dedup_files(path, sleep_ratio=0, verbose=True, io_governor=None, include=None, exclude=None,
+                algorithm=DEFAULT_CHECKSUM_ALGORITHM, keep_external_links=False):
     ''' Hard link all identical files under a given path.
         Assumes that path does not contain more than one mountpoint!
         If sleep_ratio is >0, we'll insert sleeps in our loops, so as to throttle dedupping to a moderate amount for background processing where desired.
+        Alternatively, pass an IOGovernor as io_governor to throttle by its limits instead.
+
+        include and exclude are lists of fnmatch patterns, matched against paths relative to path; if include is given,
+        only files matching one of its patterns are considered, and files or dirs matching an exclude pattern are
+        skipped (a dir matches if "<dir>/" does, so "*/.git/*" skips every .git dir without walking it).
+
+        Only files that could have a duplicate are read: files are grouped by size and mode, groups with a single inode
+        are dropped, the rest are grouped by a hash of their first and last blocks, and only files still sharing a group
+        are hashed in full (with the given checksum algorithm).
+
+        If keep_external_links is True, files that have links outside of what's walked (e.g. into an excluded dedup dir)
+        are never relinked, only linked to: whatever records those links (e.g. version manifests) stays accurate.
+        Returns 0 on success, or a negative number if dedupping stopped early.
      '''
 
     path = os.path.abspath(os.path.expanduser(path))
@@ -300,153 +919,330 @@ def dedup_files(path, sleep_ratio=0, verbose=True):
         print >>sys.stderr, "Invalid path '%s' to file de-dup." % path
         return -1
 
-    if sleep_ratio > 0.999:
-        print >>sys.stderr, "Warning: sleep ratio '%s' too large; using 0.99" % sleep_ratio
-        sleep_ratio = 0.99
-    if sleep_ratio < 0:
-        sleep_ratio = 0
+    if io_governor is None:
+        io_governor = IOGovernor(sleep_ratio=sleep_ratio)
 
-    seen_inodes = {}
-    checksum_to_path = {}
+    def _is_excluded(relpath):
+        for pattern in exclude or ():
+            if fnmatch.fnmatch(relpath, pattern):
+                return True
+        return False
 
-    start_time = time.time()
-    seconds_slept = 0
+    def _is_included(relpath):
+        if include is None:
+            return True
+        for pattern in include:
+            if fnmatch.fnmatch(relpath, pattern):
+                return True
+        return False
 
-    ret_val = 0
-    
-    dedup_files_preserved_stats = {}
-    dedup_files_released_stats = {}
-    dedup_files_count = 0
-    
-    for (path, dirs, files) in os.walk(path):
-        for file in files:
-            first_file_path = os.path.join(path, file)
+    # Pass 1: group every regular file by (size, mode); hardlinks can only join files with the same mode.
+    # Each group maps inode -> (stat, [paths]), since a file that's already hardlinked is seen under several paths.
+    candidates = {}
+    files_seen = 0
+    bytes_seen = 0
+    for (dir_path, dir_entries, file_entries) in walk_tree(path):
+        relpath_offset = len(path) + 1
+        for dir_entry in list(dir_entries):
+            if _is_excluded('%s/' % dir_entry.path[relpath_offset:]):
+                dir_entries.remove(dir_entry)
+        for file_entry in file_entries:
+            file_relpath = file_entry.path[relpath_offset:]
+            if _is_excluded(file_relpath) or not _is_included(file_relpath):
+                continue
             try:
-                first_file_stat = os.lstat(first_file_path)
+                file_stat = file_entry.lstat()
             except OSError as e:
-                print >>sys.stderr, "Warning: can't stat %s (%s); skipping." % (first_file_path, e)
-                continue
-            if not stat.S_ISREG(first_file_stat.st_mode):
-                continue
-            if first_file_stat.st_ino in seen_inodes:
+                print >>sys.stderr, "Warning: can't stat %s (%s); skipping." % (file_entry.path, e)
                 continue
-            
-            first_file_checksum = None
-            try:
-                first_file_checksum = dedup_get_checksum_based_name(get_md5_of_path_contents(first_file_path), first_file_stat.st_size, first_file_stat.st_mode)
-            except Exception as e:
-                print >>sys.stderr, "Error: checksum of %s failed" % first_file_path
-            if first_file_checksum is None:
-                ret_val = -2
-                break
-                
-            dedup_files_preserved_stats[first_file_stat.st_ino] = first_file_stat.st_size
-            if first_file_checksum not in checksum_to_path:
-                checksum_to_path[first_file_checksum] = first_file_path
-                seen_inodes[first_file_stat.st_ino] = True
+            if not stat.S_ISREG(file_stat.st_mode):
                 continue
-            
-            # We now have two files with the same checksum but different inodes; we need to hardlink them together.
-            second_file_path = checksum_to_path[first_file_checksum]  # This returns the path to a version seen in a previous iteration of our loop
+            inodes = candidates.setdefault((file_stat.st_size, file_stat.st_mode), {})
+            if file_stat.st_ino not in inodes:
+                inodes[file_stat.st_ino] = (file_stat, [])
+                files_seen += 1
+                bytes_seen += file_stat.st_size
+            inodes[file_stat.st_ino][1].append(file_entry.path)
+    size_groups = [inodes for inodes in candidates.values() if len(inodes) > 1]
+    del candidates
+
+    bytes_read = [0]
+
+    def _group_by_hash(inodes, hash_function):
+        groups = {}
+        for (ino, (file_stat, paths)) in inodes.items():
             try:
-                second_file_stat = os.lstat(second_file_path)
-            except OSError:
-                # It's possible that the second file was removed since we've seen it -- i.e. a version being deleted.
-                # If this happens, reset the checksum marker to use first_file and continue:
-                checksum_to_path[first_file_checksum] = first_file_path
-                seen_inodes[first_file_stat.st_ino] = True
+                digest = hash_function(paths[0], file_stat.st_size)
+            except (IOError, OSError) as e:
+                print >>sys.stderr, "Warning: can't read %s (%s); skipping." % (paths[0], e)
                 continue
+            groups.setdefault(digest, {})[ino] = (file_stat, paths)
+        return [group for group in groups.values() if len(group) > 1]
+
+    def _partial_hash(file_path, size):
+        # Files of up to two blocks are read whole, which makes this their full hash:
+        h = get_hasher(algorithm)
+        with open(file_path, 'rb') as f:
+            data = f.read(_DEDUP_PARTIAL_HASH_BLOCK_SIZE)
+            h.update(data)
+            if size > 2 * _DEDUP_PARTIAL_HASH_BLOCK_SIZE:
+                f.seek(-_DEDUP_PARTIAL_HASH_BLOCK_SIZE, os.SEEK_END)
+            tail = f.read(_DEDUP_PARTIAL_HASH_BLOCK_SIZE)
+            h.update(tail)
+        bytes_read[0] += len(data) + len(tail)
+        io_governor.account(bytes=len(data) + len(tail))
+        return h.hexdigest()
+
+    def _full_hash(file_path, size):
+        digest = get_checksum_of_file(file_path, algorithm)
+        if digest is None:
+            raise IOError("unable to hash file")
+        bytes_read[0] += size
+        io_governor.account(bytes=size)
+        return digest
+
+    ret_val = 0
+    dedup_files_count = 0
+    files_released = 0
+    bytes_released = 0
+    try:
+        # Passes 2 and 3: narrow each size group down by partial hash, then by full hash where the partial hash didn't
+        # cover the whole file. Zero-length files are all identical, so they skip both.
+        for size_group in size_groups:
+            size = size_group.values()[0][0].st_size
+            if size == 0:
+                duplicate_groups = [size_group]
+            else:
+                duplicate_groups = _group_by_hash(size_group, _partial_hash)
+                if size > 2 * _DEDUP_PARTIAL_HASH_BLOCK_SIZE:
+                    duplicate_groups = [full_group for group in duplicate_groups for full_group in _group_by_hash(group, _full_hash)]
+
+            # Pass 4: link every path in the group to one inode. We keep the inode with the most links (then the lowest
+            # inode number), so that files that are already partially hardlinked don't spin between inodes.
+            for group in duplicate_groups:
+                inodes = sorted(group.keys(), key=lambda ino: (-group[ino][0].st_nlink, ino))
+                (first_file_stat, first_file_paths) = group[inodes[0]]
+                for ino in inodes[1:]:
+                    (second_file_stat, second_file_paths) = group[ino]
+                    if keep_external_links and second_file_stat.st_nlink > len(second_file_paths):
+                        continue
+                    relinked_count = 0
+                    for second_file_path in second_file_paths:
+                        try:
+                            current_stat = os.lstat(second_file_path)
+                        except OSError:
+                            continue  # Removed since we saw it -- e.g. a version being deleted
+                        if (current_stat.st_ino, current_stat.st_size, current_stat.st_mtime) != \
+                                (second_file_stat.st_ino, second_file_stat.st_size, second_file_stat.st_mtime):
+                            continue  # Changed since we hashed it
+                        # Create a hard link to the first file and then atomically move it on top of the second path to release it:
+                        tmp_file_path = '%s-%s' % (second_file_path, time.time())
+                        try:
+                            os.link(first_file_paths[0], tmp_file_path)
+                            os.rename(tmp_file_path, second_file_path)
+                        except OSError as e:
+                            if os.path.lexists(tmp_file_path):
+                                os.remove(tmp_file_path)
+                            if e.errno == errno.ENOENT:
+                                continue  # One of the files was removed since we saw it
+                            print >>sys.stderr, "Error: unable to relink files in dedup step (%s->%s: %s)" % (second_file_path, first_file_paths[0], e)
+                            return -3
+                        io_governor.account(ops=2)
+                        relinked_count += 1
+                        dedup_files_count += 1
+                        if verbose and 0 == dedup_files_count % 400:
+                            sys.stdout.write('.')
+                            sys.stdout.flush()
+                    if relinked_count and relinked_count == second_file_stat.st_nlink:
+                        # Every link to the second inode was under path, so its space was released:
+                        files_released += 1
+                        bytes_released += second_file_stat.st_size
+
+    except KeyboardInterrupt:
+        print >>sys.stderr, "Interrupted during dedup; bailing."
+        ret_val = -4
+
+    finally:
+        if verbose:
+            print >>sys.stderr, "Files seen (by inode count): %s (%s bytes)" % (files_seen, bytes_seen)
+            print >>sys.stderr, "Bytes read: %s (%.2f%% of a full hash of every file)" % \
+                                (bytes_read[0], 100 * float(bytes_read[0]) / bytes_seen if bytes_seen else 0)
+            print >>sys.stderr, "Files dedupped: %s paths relinked; %s files (%s bytes) released" % \
+                                (dedup_files_count, files_released, bytes_released)
 
-            # It's possible that file paths A, B, and C all have the same data but where A is one instance and B and C are already hardlinked.
-            # To avoid "spinning" through files (Linking A to B; then B to C while leaving A at old value),
-            # we take the inode that has the higher link count and use it.
-            # If the link count is identitcal (usually 1 for two new files), we take the lower inode number, although this shouldn't matter. 
-            # It's still possible to hit a suboptimal case (e.g. if one has A, B, CDE), but that should be rare in practice 
-            # and won't cause any actual issue other than an extra copy on disk; and subsequent runs would dedup it.
-            if (second_file_stat.st_nlink > first_file_stat.st_nlink) or (second_file_stat.st_nlink == first_file_stat.st_nlink and second_file_stat.st_ino < first_file_stat.st_ino):
-                first_file_path_2 = second_file_path
-                first_file_stat_2 = second_file_stat
-                second_file_path = first_file_path
-                second_file_stat = first_file_stat
-                first_file_path = first_file_path_2
-                first_file_stat = first_file_stat_2
-                del first_file_path_2, first_file_stat_2
-            
-            # Create a hard link to first_file_path and then atomically move it on top of path to second_file_path to release the second instance:
-            tmp_file_path = '%s-%s' % (second_file_path, time.time())
-            try:
-                os.link(first_file_path, tmp_file_path)
-                os.rename(tmp_file_path, second_file_path)
-                dedup_files_count += 1
-                seen_inodes[first_file_stat.st_ino] = True  # It's possible the "new" file's inode is the winner; e.g. replacing a previously-seen copy
-                if second_file_stat.st_ino in seen_inodes:
-                    # Need to delete out the loosing inode instance, so that any upcoming instances that were hardlinked to it get cleaned up:
-                    del seen_inodes[second_file_stat.st_ino]
-                if verbose:
-                    if 0 == dedup_files_count % 400:
-                        sys.stdout.write('.')
-                        sys.stdout.flush()
-                dedup_files_released_stats[second_file_stat.st_ino] = second_file_stat.st_size
-                if second_file_stat.st_ino in dedup_files_preserved_stats:
-                    del dedup_files_preserved_stats[second_file_stat.st_ino]  # Can happen if >2 hardlinkes to a file
-            except Exception as e:
-                print >>sys.stderr, "Error: unable to relink files in dedup step (%s->%s: %s)" % (second_file_path, first_file_path, e)
-                ret_val = -3
-                break
-        
-        # At the end of every dir that we've traversed, check if we need to micro-sleep:
-        try:
-            seconds_slept += _dedup_microsleep(start_time, seconds_slept, sleep_ratio)
-        except:
-            print >>sys.stderr, "Interrupted during dedup sleep; bailing."
-            ret_val = -4
-            break
-
-    files_seen = len(checksum_to_path)
-    inodes_seen = len(dedup_files_preserved_stats) + len(dedup_files_released_stats)
-    files_deleted = len(dedup_files_released_stats)
-    disk_usage_before = sum(dedup_files_preserved_stats.values()) + sum(dedup_files_released_stats.values())
-    disk_usage_after = sum(dedup_files_preserved_stats.values())
-    disk_usage_released = sum(dedup_files_released_stats.values())
-    
-    if verbose:
-        print >>sys.stderr, "Unique files seen (checksum method): %s" % (files_seen)
-        print >>sys.stderr, "Total files seen (by inode count): %s" % (inodes_seen)
-        print >>sys.stderr, "Disk usage, before: %s bytes" % (disk_usage_before)
-        if disk_usage_before > 0:
-            print >>sys.stderr, "Disk usage, after: %s bytes (%.2f%% change)" % (disk_usage_after, 100 - 100*(float(disk_usage_after)/float(disk_usage_before)))
-        else:
-            print >>sys.stderr, "Disk usage, after: 0"
-        print >>sys.stderr, "Files dedupped: %s (%s bytes released)" % (files_deleted, disk_usage_released)
-        
     return ret_val
 
 
-def remove_unused_links(hardlink_checksum_dir):
-    """Run through hardlinks dir and remove any file that has a link count of exactly one."""
+def remove_unused_links(hardlink_checksum_dir, max_seconds=None, sleep_ratio=0, io_governor=None):
+    """Run through hardlinks dir and remove any file that has a link count of exactly one.
+    If max_seconds is given, stop after roughly that long; the next call resumes where this one left off, so a large
+    pool can be swept in slices from a background job. The sweep is throttled by io_governor, or else by sleep_ratio.
+    Returns (files_removed, bytes_removed, is_complete), where is_complete is False if the sweep stopped early."""
 
     # This is rather dangerous if run with a bad input path, so we create a safety check file when we
     # first create the hardlink dir, and verify that that file exists when removing files.
-    if not os.path.isfile(os.path.join(hardlink_checksum_dir, ".dedup_safety_check")):
-        raise angel.exceptions.AngelVersionException("Invalid hardlink_checksum_dir (missing safety check)")
-    for f in os.listdir(hardlink_checksum_dir):
-        if f == ".dedup_safety_check":
+    blob_store = DedupBlobStore(hardlink_checksum_dir)
+    blob_store.check_safety_file()
+    checkpoint_file = os.path.join(blob_store.get_root(), ".dedup_gc_checkpoint")
+    resume_after = None
+    if max_seconds is not None and os.path.isfile(checkpoint_file):
+        resume_after = open(checkpoint_file, 'r').read().strip()  # Empty if only the flat slice was done
+
+    if io_governor is None:
+        io_governor = IOGovernor(sleep_ratio=sleep_ratio)
+    start_time = time.time()
+    removed_count = 0
+    removed_bytes = 0
+
+    def _remove_if_unused(path):
+        file_stat = os.lstat(path)
+        if file_stat.st_nlink == 1:
+            os.remove(path)
+            return file_stat.st_size
+        return None
+
+    # Flat (legacy layout) files are swept as the first slice, then each fan-out dir in sorted order:
+    slices = [None] + [shard_dir[len(blob_store.get_root())+1:] for shard_dir in blob_store.iter_shard_dirs()]
+    for slice_name in slices:
+        if resume_after is not None and (slice_name is None or slice_name <= resume_after):
             continue
-        p = os.path.join(hardlink_checksum_dir, f)
-        if os.stat(p).st_nlink == 1:
-            os.remove(p)
-
-
-def _dedup_microsleep(start_time, seconds_slept, sleep_ratio):
-    ''' Sleep for a short amount of time, based on sleep_ratio and start time; return amount of time slept. '''
-    run_time = time.time() - start_time
-    if seconds_slept > run_time * sleep_ratio:
-        return 0
-    seconds_to_sleep = run_time * sleep_ratio - seconds_slept
-    if seconds_to_sleep > 2:
-        seconds_to_sleep = 2
-    if seconds_to_sleep > 0.05:
-        time.sleep(seconds_to_sleep)
-        return seconds_to_sleep
-    return 0
+        if slice_name is None:
+            paths = [path for (name, path) in blob_store.iter_blobs() if os.path.dirname(path) == blob_store.get_root()]
+        else:
+            slice_dir = os.path.join(blob_store.get_root(), slice_name)
+            paths = [os.path.join(slice_dir, name) for name in os.listdir(slice_dir) if not name.startswith('.')]
+        for path in paths:
+            size = _remove_if_unused(path)
+            io_governor.account()
+            if size is not None:
+                removed_count += 1
+                removed_bytes += size
+        if max_seconds is not None and time.time() - start_time > max_seconds and slice_name != slices[-1]:
+            open(checkpoint_file, 'w').write(slice_name or '')
+            return (removed_count, removed_bytes, False)
+
+    if os.path.isfile(checkpoint_file):
+        os.remove(checkpoint_file)
+    return (removed_count, removed_bytes, True)
 
+
+def dedup_fsck(hardlink_checksum_dir, sample_ratio=None, workers=None, max_seconds=None, sleep_ratio=0, io_governor=None):
+    """Re-hash the files in the hardlinks dir and check that each still matches the checksum and size in its name; a
+    corrupted dedup file silently corrupts every version that links to it. Files that don't match are moved into a
+    ".quarantine" dir in the hardlinks dir, so that no new install links to them (versions already linked to them keep
+    the bad copy until they're reinstalled).
+    Files are hashed across up to <workers> processes, throttled by io_governor (or else by sleep_ratio). With
+    sample_ratio (0 to 1), only a random sample of that fraction of files is checked. If max_seconds is given, stop
+    after roughly that long; the next call resumes where this one left off, so the pool can be checked in slices from
+    a cron job.
+    Returns a dict with:
+      files, bytes: number and total size of files checked
+      bad: dict of checksum name -> quarantined path (None if it couldn't be moved), for files that didn't match
+      seconds: time taken
+      is_complete: False if the check stopped early"""
+    blob_store = DedupBlobStore(hardlink_checksum_dir)
+    blob_store.check_safety_file()
+    checkpoint_file = os.path.join(blob_store.get_root(), ".dedup_fsck_checkpoint")
+    quarantine_dir = os.path.join(blob_store.get_root(), ".quarantine")
+    resume_after = None
+    if max_seconds is not None and os.path.isfile(checkpoint_file):
+        resume_after = open(checkpoint_file, 'r').read().strip()  # Empty if only the flat slice was done
+
+    if io_governor is None:
+        io_governor = IOGovernor(sleep_ratio=sleep_ratio)
+    start_time = time.time()
+    ret_val = {'files': 0, 'bytes': 0, 'bad': {}, 'seconds': 0, 'is_complete': True}
+
+    def _quarantine(name, path):
+        try:
+            if not os.path.isdir(quarantine_dir):
+                os.makedirs(quarantine_dir, 0700)
+            quarantine_path = os.path.join(quarantine_dir, '%s.%d' % (name, time.time()))
+            os.rename(path, quarantine_path)  # Keeps the inode, so linked versions are unaffected
+            return quarantine_path
+        except OSError as e:
+            print >>sys.stderr, "Error: unable to quarantine bad dedup file %s (%s)." % (path, e)
+            return None
+
+    # Flat (legacy layout) files are checked as the first slice, then each fan-out dir in sorted order. All slices are
+    # streamed through one worker pool, with a marker item (which isn't hashed) at the end of each slice:
+    slices = [None] + [shard_dir[len(blob_store.get_root())+1:] for shard_dir in blob_store.iter_shard_dirs()]
+    unknown_algorithms = set()
+
+    def _files_to_check():
+        for slice_name in slices:
+            if resume_after is not None and (slice_name is None or slice_name <= resume_after):
+                continue
+            if slice_name is None:
+                paths = [path for (name, path) in blob_store.iter_blobs() if os.path.dirname(path) == blob_store.get_root()]
+            else:
+                slice_dir = os.path.join(blob_store.get_root(), slice_name)
+                paths = [os.path.join(slice_dir, name) for name in os.listdir(slice_dir) if not name.startswith('.')]
+            for path in paths:
+                if sample_ratio is not None and random.random() >= sample_ratio:
+                    continue
+                info = dedup_get_info_from_checksum(os.path.basename(path))
+                if info is None or info['algorithm'] in unknown_algorithms:
+                    continue
+                try:
+                    get_hasher(info['algorithm'])
+                except ValueError:
+                    print >>sys.stderr, "Warning: can't check dedup files with unknown checksum algorithm %s; skipping them." % info['algorithm']
+                    unknown_algorithms.add(info['algorithm'])
+                    continue
+                yield ((path, info), path, info['algorithm'])
+            yield ((None, slice_name), None)
+
+    for ((path, info), file_digest) in get_checksums_in_parallel(_files_to_check(), workers=workers):
+        if path is None:
+            slice_name = info
+            if max_seconds is not None and time.time() - start_time > max_seconds and slice_name != slices[-1]:
+                open(checkpoint_file, 'w').write(slice_name or '')
+                ret_val['is_complete'] = False
+                break
+            continue
+        try:
+            file_size = os.lstat(path).st_size
+        except OSError as e:
+            if e.errno == errno.ENOENT:
+                continue  # Removed (e.g. by a gc) since we listed it
+            raise
+        ret_val['files'] += 1
+        ret_val['bytes'] += file_size
+        io_governor.account(bytes=file_size)
+        if file_digest != split_prefixed_checksum(info['checksum'])[1] or file_size != info['size']:
+            name = os.path.basename(path)
+            print >>sys.stderr, "Error: dedup file %s doesn't match its name (size %s, checksum %s); quarantining it." % \
+                                (name, file_size, file_digest)
+            ret_val['bad'][name] = _quarantine(name, path)
+
+    if ret_val['is_complete'] and os.path.isfile(checkpoint_file):
+        os.remove(checkpoint_file)
+    ret_val['seconds'] = time.time() - start_time
+    return ret_val
+
+
+def remove_unused_links_in_manifest(hardlink_checksum_dir, file_checksums, io_governor=None):
+    """Remove the files in the hardlinks dir that are listed in file_checksums and have a link count of exactly one.
+    Use this after deleting a copy made by dedup_create_copy, passing the checksums it returned: only files that the
+    copy linked to can have become unused, so this avoids statting every file in the pool.
+    Returns (files_removed, bytes_removed)."""
+    if io_governor is None:
+        io_governor = IOGovernor()
+    blob_store = DedupBlobStore(hardlink_checksum_dir)
+    blob_store.check_safety_file()
+    removed_count = 0
+    removed_bytes = 0
+    for checksum_filename in set(file_checksums.values()):
+        if checksum_filename.startswith('0.'):
+            continue  # '0.' entries are dirs
+        path = blob_store.find(checksum_filename)
+        if path is None:
+            continue
+        file_stat = os.lstat(path)
+        io_governor.account()
+        if file_stat.st_nlink == 1:
+            os.remove(path)
+            removed_count += 1
+            removed_bytes += file_stat.st_size
+    return (removed_count, removed_bytes)
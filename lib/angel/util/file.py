@@ -1,5 +1,5 @@
-
 import angel.exceptions
+import bisect
 import grp
 import os
 import pwd
@@ -7,59 +7,149 @@ import stat
 import sys
 
 
-def is_path_in_use(path_to_check, do_false_negative_check=True):
-    ''' Given a path, return True if files underneath that path are in active use or if it can't be determined.'''
+class OpenPathIndex():
+
+    """ A snapshot of every path that running processes have open or mapped, taken in one pass over /proc, that can then
+    answer "is anything under this path in use?" for any number of paths.
+
+    Checking paths one at a time means rescanning every process's fds and maps for each path -- with hundreds of versions
+    on a host running thousands of processes, that's millions of readlinks. Instead, build one index per command and pass
+    it to each check. The index only sees what was in use when it was built; build a new one to re-check.
+
+    If the index can't be trusted to be complete -- we aren't root, there's no /proc, or the false-negative check (we
+    hold sentinel_path, by default angel's own lib dir, open during the scan and must see it) fails -- is_complete is False and is_path_in_use always answers
+    "in use"; get_paths_under still returns what was seen.
+
+    """
+
+    is_complete = False
+    incomplete_reason = None
+    process_count = 0
+    _paths = None
+    _exact_paths = None
+    _has_warned = False
+
+    _DELETED_SUFFIX = ' (deleted)'
+
+    def __init__(self, sentinel_path=None):
+        self._paths = []
+        self._exact_paths = set()
+        self.is_complete = False
+        self.incomplete_reason = None
+        self.process_count = 0
+        self._has_warned = False
+        if not os.path.isdir('/proc'):
+            self.incomplete_reason = "checking for open files requires /proc"
+            return
+        self._scan(os.path.realpath(sentinel_path or os.path.dirname(__file__)))
+        if self.incomplete_reason is None and 0 != os.getuid():
+            self.incomplete_reason = "checking for open files must be run as root"
+        self.is_complete = self.incomplete_reason is None
+
+
+    def _scan(self, sentinel_path):
+        # Sanity check: hold a path open during the scan and make sure we see it, so that a /proc we can't read properly
+        # (e.g. a restricted container) doesn't make everything look unused:
+        sentinel_fd = os.open(sentinel_path, os.O_RDONLY)
+        sentinel_fd_path = '/proc/%d/fd/%d' % (os.getpid(), sentinel_fd)
+        saw_sentinel = False
+        paths = set()
+        try:
+            for pid in os.listdir('/proc'):
+                if not pid.isdigit():
+                    continue
+                fd_dir = '/proc/%s/fd' % pid
+                try:
+                    fds = os.listdir(fd_dir)
+                except OSError:
+                    continue  # Process exited after we listed /proc
+                self.process_count += 1
+                for fd in fds:
+                    fd_path = '%s/%s' % (fd_dir, fd)
+                    try:
+                        f_path = os.readlink(fd_path)
+                    except OSError:
+                        continue  # fd closed since we listed it
+                    if fd_path == sentinel_fd_path and f_path == sentinel_path:
+                        saw_sentinel = True
+                        continue
+                    if f_path.startswith('/'):  # Skip sockets, pipes, anon inodes, ...
+                        paths.add(f_path)
+                try:
+                    maps = open('/proc/%s/maps' % pid, 'r').read()
+                except IOError:
+                    continue
+                for map in maps.split('\n'):
+                    # Lines are "<address> <perms> <offset> <dev> <inode> <path>"; anonymous mappings have no path:
+                    fields = map.split(None, 5)
+                    if len(fields) == 6 and fields[5].startswith('/'):
+                        paths.add(fields[5])
+        finally:
+            os.close(sentinel_fd)
+        if not saw_sentinel:
+            self.incomplete_reason = "false negative check for open files failed (didn't see %s open); this should never happen" % \
+                                     sentinel_path
+        self._paths = sorted(paths)
+        self._exact_paths = paths
+
+
+    def _iter_paths_under(self, path):
+        prefix = '%s/' % path  # The trailing '/' avoids /foo/10 matching /foo/100
+        i = bisect.bisect_left(self._paths, prefix)
+        while i < len(self._paths) and self._paths[i].startswith(prefix):
+            yield self._paths[i]
+            i += 1
+
+
+    def is_path_in_use(self, path):
+        """Return True if path, or anything under it, is open or mapped by a process (or if the index isn't complete)."""
+        if not self.is_complete:
+            if not self._has_warned:
+                print >>sys.stderr, "Warning: %s; assuming paths are in use." % self.incomplete_reason
+                self._has_warned = True
+            return True
+        path = os.path.realpath(path)
+        if path in self._exact_paths:
+            return True
+        for f_path in self._iter_paths_under(path):
+            return True
+        return False
+
+
+    def get_paths_under(self, path):
+        """Return the set of paths, relative to path, that are open or mapped under path. Files that have been deleted
+        since they were opened are left out."""
+        path = os.path.realpath(path)
+        return set([f_path[len(path) + 1:] for f_path in self._iter_paths_under(path) if not f_path.endswith(self._DELETED_SUFFIX)])
+
+
+def is_path_in_use(path_to_check, open_path_index=None):
+    ''' Given a path, return True if files underneath that path are in active use or if it can't be determined.
+        When checking many paths, build one OpenPathIndex and pass it in as open_path_index. '''
     if path_to_check[-1] == '/':
         path_to_check = path_to_check[:-1]  # Trim trailing slash if given
     if not os.path.exists(path_to_check):
         print >>sys.stderr, "Error: is_path_in_use(): path doesn't exist at %s" % path_to_check
         return True
-    if 0 != os.getuid():
-        print >>sys.stderr, "Warning: is_path_in_use must be run as root; assuming path is in use."
-        return True
-    if not os.path.isdir('/proc'):
-        print >>sys.stderr, "Warning: is_path_in_use requires /proc; assuming path is in use."
-        return True
-    for pid in os.listdir('/proc'):
-        fd_dir = '/proc/%s/fd' % pid
-        try:
-            if not os.path.isdir(fd_dir):
-                # /proc contains non-pid files; instead of globbing to exclude those we skip over ones that lack fd dir
-                continue
-            for f in os.listdir(fd_dir):
-                f_path = os.path.realpath(os.path.join(fd_dir, f))
-                if f_path == path_to_check or os.path.realpath(f_path).startswith('%s/' % path_to_check):
-                    # The extra '/' at the end above is to avoid /foo/10 false-positive matching path /foo/100
-                    return True
-            map_file = '/proc/%s/maps' % pid
-            if not os.path.isfile(map_file):
-                if os.path.isdir('/proc/%s' % pid):  # Our proc could've exited between listdir time and now?
-                    print >>sys.stderr, "Warning: is_path_in_use can't find map file %s?" % map_file
-                continue
-            for map in open(map_file, 'r').read().split('\n'):
-                if path_to_check in map:
-                    return True
-        except (OSError, IOError):
-            # A process can exut after we called os.listdir(fd_dir) and before we called os.path.realpath() or open
-            pass
-
-    # If we get here, then no files are open under path.
-    # As a sanity check, open a file under path and make sure that we see path flip to being open:
-    if do_false_negative_check:
-        # It's possible that the version was *just* deleted (this has been observed):
-        if not os.path.exists(path_to_check):
-            return False
+    if open_path_index is None:
         try:
-            fh = os.open(path_to_check, os.O_RDONLY)
-            if not is_path_in_use(path_to_check, do_false_negative_check=False):
-                print >>sys.stderr, "Error: false negative check for path %s failed! This should never happen." %\
-                                    path_to_check
-                return True
-            os.close(fh)
-        except Exception as e:
+            open_path_index = OpenPathIndex(sentinel_path=path_to_check)
+        except OSError as e:
+            # It's possible that the path was *just* deleted (this has been observed):
+            if not os.path.exists(path_to_check):
+                return False
             print >>sys.stderr, "Error: false negative check for path %s failed: %s" % (path_to_check, e)
             return True
-    return False
+    return open_path_index.is_path_in_use(path_to_check)
+
+
+def get_open_files_under_path(path, open_path_index=None):
+    ''' Return the set of paths, relative to path, of regular files under path that running processes have open or mapped.
+        This is a single sample of /proc (or of the given OpenPathIndex), so it only sees what's in use right now; processes
+        we can't inspect (e.g. of other users, when not root) are skipped. '''
+    if open_path_index is None:
+        open_path_index = OpenPathIndex()
+    return set([f for f in open_path_index.get_paths_under(path) if os.path.isfile(os.path.join(path, f))])
 
 
 def create_dirs_if_needed(absolute_path,
@@ -0,0 +1,126 @@
+import ctypes
+import ctypes.util
+import errno
+import fcntl
+import os
+import shutil
+
+
+# Ways to copy file data, fastest first. copy_file() tries each in turn, falling back on the next when the kernel or
+# filesystem doesn't support one:
+#   reflink:          FICLONE ioctl; the copy shares the source's data blocks (copy-on-write), so no data is copied at all (btrfs, xfs, ...)
+#   copy_file_range:  in-kernel copy, which some filesystems offload (e.g. to the server, on NFS 4.2); Linux 4.5+
+#   sendfile:         in-kernel copy through the page cache; avoids copying through userspace buffers
+#   copy:             read/write through python buffers
+COPY_METHODS = ('reflink', 'copy_file_range', 'sendfile', 'copy')
+
+_FICLONE = 0x40049409  # _IOW(0x94, 9, int), from linux/fs.h
+_CHUNK_SIZE = 1 << 30
+
+# Errors that mean "this method isn't available here", as opposed to a real I/O error:
+_UNSUPPORTED_ERRNOS = set([errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP, errno.ENOTTY, errno.EBADF,
+                           getattr(errno, 'ENOTSUP', errno.EOPNOTSUPP)])
+
+# (method, st_dev) pairs found to be unsupported, so that we don't retry them for every file:
+_unsupported_methods = set()
+_libc = None
+
+
+def _get_libc():
+    global _libc
+    if _libc is None:
+        _libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+    return _libc
+
+
+def copy_file(src_path, dest_path, methods=COPY_METHODS):
+    ''' Copy the file at src_path to a new file at dest_path, preserving its mode and timestamps (as shutil.copy2 does).
+        The data is copied with the first of the given methods (see COPY_METHODS) that works on this system and
+        filesystem. Returns the name of the method used; throws OSError/IOError on failure. '''
+    src_fd = os.open(src_path, os.O_RDONLY)
+    dest_fd = None
+    try:
+        src_stat = os.fstat(src_fd)
+        dest_fd = os.open(dest_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0600)
+        try:
+            dest_dev = os.fstat(dest_fd).st_dev
+            method_used = None
+            for method in methods:
+                if (method, dest_dev) in _unsupported_methods:
+                    continue
+                try:
+                    _copy_functions[method](src_fd, dest_fd, src_stat.st_size)
+                    method_used = method
+                    break
+                except (OSError, IOError) as e:
+                    if e.errno not in _UNSUPPORTED_ERRNOS:
+                        raise
+                    _unsupported_methods.add((method, dest_dev))
+                    # Start over from scratch with the next method, in case this one copied part of the file:
+                    os.ftruncate(dest_fd, 0)
+                    os.lseek(dest_fd, 0, os.SEEK_SET)
+                    os.lseek(src_fd, 0, os.SEEK_SET)
+            if method_used is None:
+                raise OSError(errno.ENOTSUP, "no copy method available for %s (tried %s)" % (dest_path, ', '.join(methods)))
+        finally:
+            os.close(dest_fd)
+    except:
+        if dest_fd is not None and os.path.exists(dest_path):  # Only remove the dest file if we created it
+            os.remove(dest_path)
+        raise
+    finally:
+        os.close(src_fd)
+    shutil.copystat(src_path, dest_path)
+    return method_used
+
+
+def _copy_reflink(src_fd, dest_fd, size):
+    fcntl.ioctl(dest_fd, _FICLONE, src_fd)
+
+
+def _copy_file_range(src_fd, dest_fd, size):
+    libc = _get_libc()
+    if not hasattr(libc, 'copy_file_range'):  # glibc < 2.27
+        raise OSError(errno.ENOSYS, "copy_file_range not available")
+    libc.copy_file_range.restype = ctypes.c_ssize_t
+    libc.copy_file_range.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t, ctypes.c_uint]
+    _copy_with_syscall(lambda count: libc.copy_file_range(src_fd, None, dest_fd, None, count, 0), size)
+
+
+def _copy_sendfile(src_fd, dest_fd, size):
+    libc = _get_libc()
+    libc.sendfile.restype = ctypes.c_ssize_t
+    libc.sendfile.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t]
+    _copy_with_syscall(lambda count: libc.sendfile(dest_fd, src_fd, None, count), size)
+
+
+def _copy_with_syscall(copy_chunk, size):
+    # Both calls copy from the current offset of src to the current offset of dest, and may copy less than asked for:
+    remaining = size
+    while True:
+        copied = copy_chunk(min(max(remaining, 65536), _CHUNK_SIZE))
+        if copied < 0:
+            e = ctypes.get_errno()
+            if e == errno.EINTR:
+                continue
+            raise OSError(e, os.strerror(e))
+        if copied == 0:
+            break  # EOF; keep going past size, in case the file grew since we stat'ed it
+        remaining -= copied
+
+
+def _copy_read_write(src_fd, dest_fd, size):
+    while True:
+        data = os.read(src_fd, 1048576)
+        if not data:
+            break
+        while len(data):
+            data = data[os.write(dest_fd, data):]
+
+
+_copy_functions = {
+    'reflink': _copy_reflink,
+    'copy_file_range': _copy_file_range,
+    'sendfile': _copy_sendfile,
+    'copy': _copy_read_write,
+}
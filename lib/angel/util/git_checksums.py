@@ -0,0 +1,226 @@
+import os
+import stat
+import subprocess
+import sys
+
+import angel.exceptions
+from angel.util.checksum import get_prefixed_checksum
+
+
+# Modes of git tree entries: regular and executable files (whose blob ids can stand in for hashing the file), symlinks
+# and submodules:
+_GIT_FILE_MODES = ('100644', '100755')
+_GIT_SYMLINK_MODE = '120000'
+_GIT_SUBMODULE_MODE = '160000'
+
+# Git doesn't record dir permissions; dirs in versions made from a git tree get the mode a checkout would give them:
+_GIT_TREE_DIR_MODE = stat.S_IFDIR | 0755
+
+
+def _run_git(args, cwd):
+    ''' Run git with the given args in cwd; returns its stdout, or None if git isn't available or fails. '''
+    try:
+        p = subprocess.Popen(['git'] + args, cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except OSError:
+        return None
+    (output, output_stderr) = p.communicate()
+    if p.returncode != 0:
+        return None
+    return output
+
+
+def _get_dirty_paths(src_path):
+    ''' Return the set of paths (relative to the repo top) of tracked files that differ from HEAD, or None on error. '''
+    output = _run_git(['status', '--porcelain', '-z', '--untracked-files=no', '--ignore-submodules=all'], src_path)
+    if output is None:
+        return None
+    dirty_paths = set()
+    entries = output.split('\0')
+    i = 0
+    while i < len(entries):
+        entry = entries[i]
+        i += 1
+        if len(entry) < 4:
+            continue
+        dirty_paths.add(entry[3:])
+        if entry[0] in 'RC':
+            # Renames and copies are followed by the original path, which no longer matches HEAD either:
+            dirty_paths.add(entries[i])
+            i += 1
+    return dirty_paths
+
+
+def get_git_blob_checksums(src_path):
+    ''' Given a path inside a git checkout, return a dict of path (relative to src_path) to (checksum, size) of every
+        committed file under it, using the blob ids git already has for them, so that files don't need to be read to be
+        checksummed. Checksums are prefixed "git" checksums (see angel.util.checksum.GitBlobHasher), which are what
+        hashing the file with the "git" algorithm gives.
+
+        The tree is listed from HEAD in a single "git ls-tree" call; files that git status shows as modified since HEAD
+        are left out, as are symlinks and submodules. Untracked files aren't listed at all. Callers should still compare
+        each file's size against the size given here before trusting its checksum.
+
+        Returns None if src_path isn't in a git checkout (or git isn't installed). '''
+    src_path = os.path.abspath(os.path.expanduser(src_path))
+    prefix = _run_git(['rev-parse', '--show-prefix'], src_path)
+    if prefix is None:
+        return None
+    prefix = prefix.strip()
+    output = _run_git(['ls-tree', '-r', '-l', '-z', '--full-name', 'HEAD'], src_path)
+    if output is None:
+        return None
+    dirty_paths = _get_dirty_paths(src_path)
+    if dirty_paths is None:
+        print >>sys.stderr, "Warning: unable to get git status of %s; not using git blob ids." % src_path
+        return None
+
+    checksums = {}
+    for entry in output.split('\0'):
+        if not len(entry):
+            continue
+        # Entries are "<mode> <type> <id> <size, padded>\t<path>":
+        (info, path) = entry.split('\t', 1)
+        (mode, object_type, object_id, size) = info.split(None, 3)
+        if object_type != 'blob' or mode not in _GIT_FILE_MODES or path in dirty_paths:
+            continue
+        if not path.startswith(prefix):
+            continue
+        checksums[path[len(prefix):]] = (get_prefixed_checksum(object_id, 'git'), int(size))
+    return checksums
+
+
+def get_git_tree_manifest(repo_path, ref):
+    ''' Return (file_checksums, symlink_ids) for the tree at ref in the git repo at repo_path (bare or not), without
+        checking anything out: file_checksums is a manifest of every file and dir in the tree (as returned by
+        angel.util.dedup_files.dedup_calculate_checksums, with "git" checksums), and symlink_ids is a dict of the path
+        of each symlink in the tree to the id of the blob holding its target, for GitObjectReader to read. As with
+        manifests of checked-out trees, symlinks aren't in file_checksums. Submodules are given as empty dirs, as in a
+        checkout that hasn't initialized them.
+        Throws an AngelVersionException if repo_path isn't a git repo or ref isn't in it. '''
+    repo_path = os.path.abspath(os.path.expanduser(repo_path))
+    if not os.path.isdir(repo_path):
+        raise angel.exceptions.AngelVersionException("Missing git repo '%s'" % repo_path)
+    if _run_git(['rev-parse', '--verify', '--quiet', '%s^{tree}' % ref], repo_path) is None:
+        raise angel.exceptions.AngelVersionException("Unable to find ref '%s' in git repo '%s'" % (ref, repo_path))
+    output = _run_git(['ls-tree', '-r', '-t', '-l', '-z', '--full-tree', ref], repo_path)
+    if output is None:
+        raise angel.exceptions.AngelVersionException("Unable to list ref '%s' in git repo '%s'" % (ref, repo_path))
+
+    file_checksums = {}
+    symlink_ids = {}
+    for entry in output.split('\0'):
+        if not len(entry):
+            continue
+        (info, path) = entry.split('\t', 1)
+        (mode, object_type, object_id, size) = info.split(None, 3)
+        if object_type == 'tree' or mode == _GIT_SUBMODULE_MODE:
+            file_checksums[path] = '0.0.%s' % _GIT_TREE_DIR_MODE
+        elif mode in _GIT_FILE_MODES:
+            file_checksums[path] = '%s.%s.%s' % (get_prefixed_checksum(object_id, 'git'), int(size), int(mode, 8))
+        elif mode == _GIT_SYMLINK_MODE:
+            symlink_ids[path] = object_id
+        else:
+            print >>sys.stderr, "Warning: unknown git tree entry mode %s at %s; skipping it." % (mode, path)
+    return (file_checksums, symlink_ids)
+
+
+class GitObjectReader():
+
+    """ Reads objects out of a git repo through a single long-lived "git cat-file --batch" process, so that reading many
+    blobs costs one process rather than one per blob.
+
+    Objects are read one at a time: open_blob() returns a file object over the blob's contents straight from the pipe,
+    which must be read (or abandoned) before the next call. Use close() (or a with block) to end the process.
+
+    """
+
+    _repo_path = None
+    _process = None
+    _pending_bytes = 0
+
+    def __init__(self, repo_path):
+        self._repo_path = os.path.abspath(os.path.expanduser(repo_path))
+        self._process = None
+        self._pending_bytes = 0
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+    def _start(self):
+        try:
+            self._process = subprocess.Popen(['git', 'cat-file', '--batch'], cwd=self._repo_path,
+                                             stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        except OSError as e:
+            raise angel.exceptions.AngelVersionException("Unable to run git in '%s': %s" % (self._repo_path, e))
+
+
+    def _skip_pending(self):
+        # Each object's contents are followed by a newline; skip past them (and whatever the caller didn't read):
+        while self._pending_bytes > 0:
+            data = self._process.stdout.read(min(self._pending_bytes, 65536))
+            if not data:
+                raise angel.exceptions.AngelVersionException("git cat-file exited early in '%s'" % self._repo_path)
+            self._pending_bytes -= len(data)
+
+
+    def open_blob(self, object_id):
+        ''' Return (size, fileobj) for the blob with the given id; fileobj reads exactly size bytes.
+            Throws an AngelVersionException if the object is missing or isn't a blob. '''
+        if self._process is None:
+            self._start()
+        self._skip_pending()
+        self._process.stdin.write('%s\n' % object_id)
+        self._process.stdin.flush()
+        header = self._process.stdout.readline().rstrip('\n').split(' ')
+        if len(header) != 3:
+            raise angel.exceptions.AngelVersionException("Unable to read git object %s from '%s' (%s)" %
+                                                         (object_id, self._repo_path, ' '.join(header)))
+        if header[1] != 'blob':
+            self._pending_bytes = int(header[2]) + 1
+            raise angel.exceptions.AngelVersionException("Git object %s in '%s' is a %s, not a blob" %
+                                                         (object_id, self._repo_path, header[1]))
+        size = int(header[2])
+        self._pending_bytes = size + 1
+        return (size, _GitBlobStream(self, size))
+
+
+    def read_blob(self, object_id):
+        ''' Return the contents of the blob with the given id, as a string; for small blobs (e.g. symlink targets). '''
+        return self.open_blob(object_id)[1].read()
+
+
+    def close(self):
+        if self._process is not None:
+            self._process.stdin.close()
+            self._process.stdout.close()
+            self._process.wait()
+            self._process = None
+
+
+class _GitBlobStream():
+
+    """ File object over one blob's contents in a GitObjectReader's pipe; see GitObjectReader.open_blob. """
+
+    _reader = None
+    _remaining = 0
+
+    def __init__(self, reader, size):
+        self._reader = reader
+        self._remaining = size
+
+
+    def read(self, size=-1):
+        if size < 0 or size > self._remaining:
+            size = self._remaining
+        if size == 0:
+            return ''
+        data = self._reader._process.stdout.read(size)
+        self._remaining -= len(data)
+        self._reader._pending_bytes -= len(data)
+        return data
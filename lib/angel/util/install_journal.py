@@ -0,0 +1,162 @@
+import errno
+import fcntl
+import os
+import sys
+import threading
+import time
+
+import angel.exceptions
+
+
+class InstallJournal():
+
+    """ Record of the progress of a dedup copy (see angel.util.dedup_files.dedup_create_copy), so that an interrupted
+    install can be resumed instead of started over.
+
+    The journal is an append-only log: a "angel-install-journal 1 <src path>" header line, then a "D <relpath>" line for
+    each dir created and a "F <checksum name> <size> <mtime> <inode> <relpath>" line for each file linked, giving the
+    stat info the source file had when it was hashed. Lines are appended in batches, so a crash loses at most the last
+    few entries (and can leave a partial last line, which is ignored on load); those entries are simply redone.
+
+    Entries can be recorded from several threads (e.g. from the callbacks of a ParallelLinker).
+
+    A journal entry is only a hint: the caller must still check that the file in the partial tree is linked to the
+    entry's dedup file, and entries for source files whose stat info has changed are not returned at all.
+
+    """
+
+    _journal_path = None
+    _src_path = None
+    _fd = None
+    _dirs = None
+    _files = None
+    _pending = None
+    _pending_lock = None
+    _last_flush_time = 0
+    is_resuming = False
+    reused_dirs = 0
+    reused_files = 0
+    reused_bytes = 0
+
+    _HEADER = 'angel-install-journal 1'
+    _FLUSH_ENTRIES = 1000
+    _FLUSH_SECONDS = 2
+
+    def __init__(self, journal_path, src_path):
+        """
+        @param journal_path: path to the journal file; it's created if it doesn't exist
+        @param src_path: path of the tree being copied; a journal written for a different src path is discarded
+        """
+        self._journal_path = journal_path
+        self._src_path = src_path
+        self._dirs = set()
+        self._files = {}
+        self._pending = []
+        self._pending_lock = threading.Lock()
+        self.is_resuming = False
+        self.reused_dirs = 0
+        self.reused_files = 0
+        self.reused_bytes = 0
+
+
+    def open(self):
+        """Open and lock the journal, loading any entries from an earlier attempt. Sets is_resuming if there was a
+        journal to resume from. Throws AngelVersionException if another process has the journal open."""
+        self.is_resuming = os.path.exists(self._journal_path)
+        self._fd = os.open(self._journal_path, os.O_RDWR | os.O_CREAT | os.O_APPEND, 0600)
+        try:
+            fcntl.flock(self._fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError as e:
+            os.close(self._fd)
+            self._fd = None
+            if e.errno in (errno.EAGAIN, errno.EACCES):
+                raise angel.exceptions.AngelVersionException("another install is using journal %s" % self._journal_path)
+            raise
+        lines = []
+        while True:
+            data = os.read(self._fd, 1048576)
+            if not data:
+                break
+            lines.append(data)
+        lines = ''.join(lines).split('\n')
+        header = '%s %s' % (self._HEADER, self._src_path)
+        if lines[0] != header:
+            if len(lines[0]):
+                print >>sys.stderr, "Warning: install journal %s is for a different source; ignoring its entries." % self._journal_path
+            os.ftruncate(self._fd, 0)
+            os.write(self._fd, header + '\n')
+            return
+        # The last element is either empty or a partially-written line from an interrupted append; skip it either way:
+        for line in lines[1:-1]:
+            try:
+                if line.startswith('D '):
+                    self._dirs.add(line[2:])
+                elif line.startswith('F '):
+                    (checksum_name, size, mtime, ino, relpath) = line[2:].split(' ', 4)
+                    self._files[relpath] = (checksum_name, int(size), float(mtime), int(ino))
+            except ValueError:
+                continue
+
+
+    def has_dir(self, relpath):
+        """Return True if the journal records that the given dir was created."""
+        return relpath in self._dirs
+
+
+    def get_file(self, relpath, file_stat):
+        """Return the checksum name that the given file was linked to, if the journal records it and the source file's
+        stat info is unchanged since; otherwise None."""
+        entry = self._files.get(relpath)
+        if entry is None or entry[1:] != (file_stat.st_size, file_stat.st_mtime, file_stat.st_ino):
+            return None
+        return entry[0]
+
+
+    def record_dir(self, relpath):
+        self._append('D %s\n' % relpath)
+
+
+    def record_file(self, relpath, checksum_name, file_stat):
+        self._append('F %s %d %r %d %s\n' % (checksum_name, file_stat.st_size, file_stat.st_mtime, file_stat.st_ino, relpath))
+
+
+    def _append(self, line):
+        with self._pending_lock:
+            self._pending.append(line)
+            if len(self._pending) >= self._FLUSH_ENTRIES or time.time() - self._last_flush_time > self._FLUSH_SECONDS:
+                self._flush()
+
+
+    def flush(self):
+        """Write any pending entries to the journal file."""
+        with self._pending_lock:
+            self._flush()
+
+
+    def _flush(self):
+        if len(self._pending) and self._fd is not None:
+            os.write(self._fd, ''.join(self._pending))
+            self._pending = []
+        self._last_flush_time = time.time()
+
+
+    def close(self):
+        """Flush and close (unlocking) the journal, keeping the file so that a later attempt can resume."""
+        if self._fd is None:
+            return
+        try:
+            self.flush()
+            os.fsync(self._fd)
+        finally:
+            os.close(self._fd)
+            self._fd = None
+
+
+    def remove(self):
+        """Delete the journal once the install it records is complete."""
+        if os.path.exists(self._journal_path):
+            os.remove(self._journal_path)
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+        self._pending = []
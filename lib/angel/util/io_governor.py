@@ -0,0 +1,201 @@
+import ctypes
+import errno
+import multiprocessing
+import os
+import sys
+import time
+
+
+# ioprio_set(2) syscall numbers, by architecture (there's no libc wrapper for it):
+_IOPRIO_SET_SYSCALLS = {'x86_64': 251, 'i386': 289, 'i686': 289, 'aarch64': 30, 'armv7l': 314, 'ppc64le': 273, 's390x': 282}
+_IOPRIO_CLASSES = {'realtime': 1, 'best-effort': 2, 'idle': 3}
+_IOPRIO_WHO_PROCESS = 1
+_IOPRIO_CLASS_SHIFT = 13
+
+
+def set_ionice(ionice_class, ionice_level=4):
+    ''' Set the I/O scheduling class of this process (like "ionice -c"): one of 'realtime', 'best-effort' or 'idle'.
+        Returns True on success; warns and returns False if the class can't be set (e.g. non-Linux systems). '''
+    if ionice_class not in _IOPRIO_CLASSES:
+        raise ValueError("unknown ionice class '%s' (available: %s)" % (ionice_class, ', '.join(sorted(_IOPRIO_CLASSES))))
+    syscall_number = _IOPRIO_SET_SYSCALLS.get(os.uname()[4])
+    if syscall_number is None:
+        print >>sys.stderr, "Warning: don't know how to set ionice on %s; ignoring." % os.uname()[4]
+        return False
+    ioprio = _IOPRIO_CLASSES[ionice_class] << _IOPRIO_CLASS_SHIFT
+    if ionice_class != 'idle':
+        ioprio |= ionice_level
+    try:
+        libc = ctypes.CDLL("libc.so.6", use_errno=True)
+        if libc.syscall(syscall_number, _IOPRIO_WHO_PROCESS, 0, ioprio) != 0:
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+    except (OSError, AttributeError) as e:
+        print >>sys.stderr, "Warning: unable to set ionice class %s (%s); ignoring." % (ionice_class, e)
+        return False
+    return True
+
+
+def get_io_pressure():
+    ''' Return the percent of the last 10 seconds in which some task was stalled on I/O, from /proc/pressure/io
+        (Linux 4.20+ with PSI enabled); None if unavailable. '''
+    try:
+        for line in open('/proc/pressure/io', 'r').read().split('\n'):
+            if line.startswith('some '):
+                for field in line.split(' ')[1:]:
+                    if field.startswith('avg10='):
+                        return float(field[6:])
+    except (IOError, ValueError):
+        pass
+    return None
+
+
+class IOGovernor():
+
+    """ Throttles background disk work -- version installs, deletes, dedup runs -- so that it has a bounded impact on
+    anything else running on the host.
+
+    Callers report each unit of work with account(bytes, ops); the governor sleeps as needed to keep the work within:
+      - bytes_per_second / ops_per_second: token buckets, allowing bursts of up to one second's budget;
+      - sleep_ratio: ratio of sleep-to-work time, as used by the sleep_ratio options of install and dedup commands;
+      - max_loadavg / max_io_pressure: when the 1-minute load average per cpu, or the percent of time tasks are stalled
+        on I/O (see get_io_pressure), is above these, the budgets are progressively cut (down to 1/16th), and restored
+        once the host is quiet again. Without budgets, the governor pauses instead while the host is busy.
+    If ionice_class is given, the process's I/O scheduling class is set as well (see set_ionice).
+
+    A governor is not thread-safe; use one per thread of work.
+
+    """
+
+    bytes_per_second = None
+    ops_per_second = None
+    sleep_ratio = 0
+    max_loadavg = None
+    max_io_pressure = None
+    bytes_done = 0
+    ops_done = 0
+    seconds_slept = 0
+
+    _MIN_BACKOFF = 1.0 / 16
+    _PRESSURE_CHECK_INTERVAL = 1.0
+    _MAX_SLEEP_RATIO_SLEEP = 2.0
+
+    def __init__(self, bytes_per_second=None, ops_per_second=None, sleep_ratio=0, max_loadavg=None, max_io_pressure=None,
+                 ionice_class=None):
+        if sleep_ratio > 0.999:
+            print >>sys.stderr, "Warning: sleep ratio '%s' too large; using 0.99" % sleep_ratio
+            sleep_ratio = 0.99
+        if sleep_ratio < 0:
+            sleep_ratio = 0
+        self.bytes_per_second = bytes_per_second
+        self.ops_per_second = ops_per_second
+        self.sleep_ratio = sleep_ratio
+        self.max_loadavg = max_loadavg
+        self.max_io_pressure = max_io_pressure
+        self.bytes_done = 0
+        self.ops_done = 0
+        self.seconds_slept = 0
+        self._start_time = time.time()
+        self._last_refill_time = self._start_time
+        self._last_pressure_check_time = 0
+        self._byte_tokens = bytes_per_second or 0
+        self._op_tokens = ops_per_second or 0
+        self._backoff = 1.0
+        self._cpu_count = multiprocessing.cpu_count()
+        if ionice_class is not None:
+            set_ionice(ionice_class)
+
+
+    def account(self, bytes=0, ops=1):
+        ''' Record that bytes of data were read or written and ops metadata operations (creates, links, unlinks, ...)
+            done, sleeping first if that exceeds the budget. Returns the number of seconds slept. '''
+        self.bytes_done += bytes
+        self.ops_done += ops
+        now = time.time()
+        if self.max_loadavg is not None or self.max_io_pressure is not None:
+            if now - self._last_pressure_check_time > self._PRESSURE_CHECK_INTERVAL:
+                self._last_pressure_check_time = now
+                self._update_backoff()
+
+        seconds_to_sleep = 0
+        elapsed = now - self._last_refill_time
+        self._last_refill_time = now
+        if self.bytes_per_second:
+            rate = self.bytes_per_second * self._backoff
+            self._byte_tokens = min(rate, self._byte_tokens + elapsed * rate) - bytes
+            if self._byte_tokens < 0:
+                seconds_to_sleep = max(seconds_to_sleep, -self._byte_tokens / rate)
+        if self.ops_per_second:
+            rate = self.ops_per_second * self._backoff
+            self._op_tokens = min(rate, self._op_tokens + elapsed * rate) - ops
+            if self._op_tokens < 0:
+                seconds_to_sleep = max(seconds_to_sleep, -self._op_tokens / rate)
+        if self._backoff < 1 and not self.bytes_per_second and not self.ops_per_second:
+            # No budget to cut, so pause for longer the longer the host stays busy:
+            seconds_to_sleep = max(seconds_to_sleep, 0.1 / self._backoff)
+        if self.sleep_ratio > 0:
+            sleep_ratio_seconds = (now - self._start_time) * self.sleep_ratio - self.seconds_slept
+            seconds_to_sleep = max(seconds_to_sleep, min(sleep_ratio_seconds, self._MAX_SLEEP_RATIO_SLEEP))
+
+        if seconds_to_sleep > 0.05:  # Don't bother with tiny sleeps; the budget carries over to the next call
+            time.sleep(seconds_to_sleep)
+            self.seconds_slept += seconds_to_sleep
+            return seconds_to_sleep
+        return 0
+
+
+    def _update_backoff(self):
+        busy = False
+        if self.max_loadavg is not None:
+            try:
+                if os.getloadavg()[0] / self._cpu_count > self.max_loadavg:
+                    busy = True
+            except OSError:
+                pass
+        if self.max_io_pressure is not None:
+            io_pressure = get_io_pressure()
+            if io_pressure is not None and io_pressure > self.max_io_pressure:
+                busy = True
+        if busy:
+            self._backoff = max(self._MIN_BACKOFF, self._backoff / 2)
+        else:
+            self._backoff = min(1.0, self._backoff * 1.25)
+
+
+    def get_elapsed_seconds(self):
+        return time.time() - self._start_time
+
+
+def get_io_governor(io_limits=None, sleep_ratio=0):
+    ''' Return a new IOGovernor using the given dict of IOGovernor keyword args (e.g. from settings) and sleep_ratio. '''
+    return IOGovernor(sleep_ratio=sleep_ratio, **(io_limits or {}))
+
+
+def remove_tree(path, io_governor=None, deadline=None):
+    ''' Like shutil.rmtree(path), but accounts every unlink and rmdir with the given IOGovernor, so that deleting a large
+        tree doesn't starve other I/O. Entries that disappear while we're removing them (e.g. another process removing
+        the same tree) are ignored. If deadline (a time.time() value) is given, stops once it's passed and returns False,
+        leaving the rest of the tree in place; returns True once path is gone. '''
+    if io_governor is None:
+        io_governor = IOGovernor()
+
+    def _remove(remove_function, entry_path):
+        try:
+            remove_function(entry_path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+        io_governor.account()
+
+    if not os.path.isdir(path) or os.path.islink(path):
+        _remove(os.unlink, path)
+        return True
+    for (dir_path, dir_names, file_names) in os.walk(path, topdown=False):
+        for name in file_names:
+            _remove(os.unlink, os.path.join(dir_path, name))
+        for name in dir_names:
+            dir_entry_path = os.path.join(dir_path, name)
+            _remove(os.unlink if os.path.islink(dir_entry_path) else os.rmdir, dir_entry_path)
+        if deadline is not None and time.time() > deadline:
+            return False
+    _remove(os.rmdir, path)
+    return True
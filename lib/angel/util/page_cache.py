@@ -0,0 +1,74 @@
+import ctypes
+import ctypes.util
+import os
+import sys
+
+
+# Page-cache prewarming: asking the kernel to read files into the page cache ahead of use, so that the first requests
+# served by newly-started code don't stall on disk reads. posix_fadvise(POSIX_FADV_WILLNEED) starts readahead in the
+# background and returns at once; where it's unavailable, files are read through instead.
+
+_POSIX_FADV_WILLNEED = 3
+_READ_CHUNK_SIZE = 1048576
+
+_libc = None
+_has_fadvise = None
+
+
+def _fadvise_willneed(fd, length):
+    ''' Start readahead of the first length bytes of fd; returns False if posix_fadvise isn't available. '''
+    global _libc, _has_fadvise
+    if _has_fadvise is None:
+        try:
+            _libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+            _libc.posix_fadvise.restype = ctypes.c_int
+            _libc.posix_fadvise.argtypes = [ctypes.c_int, ctypes.c_int64, ctypes.c_int64, ctypes.c_int]
+            _has_fadvise = True
+        except (OSError, AttributeError):
+            _has_fadvise = False
+    if not _has_fadvise:
+        return False
+    # posix_fadvise returns the error number instead of setting errno:
+    return _libc.posix_fadvise(fd, 0, length, _POSIX_FADV_WILLNEED) == 0
+
+
+def prewarm_files(base_path, relpaths, byte_budget, shared_with_path=None):
+    ''' Pull the given files (paths relative to base_path) into the page cache, in the order given, until byte_budget
+        bytes have been requested; files that would go over the budget are skipped. If shared_with_path is given, files
+        that are the same inode under it (i.e. hardlinked to the same dedup file as the running version) are assumed to
+        be cached already and cost nothing. Returns (files_warmed, bytes_warmed, files_shared, files_skipped). '''
+    files_warmed = 0
+    bytes_warmed = 0
+    files_shared = 0
+    files_skipped = 0
+    for relpath in relpaths:
+        path = os.path.join(base_path, relpath)
+        try:
+            file_stat = os.stat(path)
+        except OSError:
+            continue  # Not in this version
+        if shared_with_path is not None:
+            try:
+                shared_stat = os.stat(os.path.join(shared_with_path, relpath))
+                if (shared_stat.st_dev, shared_stat.st_ino) == (file_stat.st_dev, file_stat.st_ino):
+                    files_shared += 1
+                    continue
+            except OSError:
+                pass
+        if bytes_warmed + file_stat.st_size > byte_budget:
+            files_skipped += 1
+            continue
+        try:
+            fd = os.open(path, os.O_RDONLY)
+            try:
+                if not _fadvise_willneed(fd, file_stat.st_size):
+                    while len(os.read(fd, _READ_CHUNK_SIZE)):
+                        pass
+            finally:
+                os.close(fd)
+        except (OSError, IOError) as e:
+            print >>sys.stderr, "Warning: unable to prewarm %s (%s)." % (path, e)
+            continue
+        files_warmed += 1
+        bytes_warmed += file_stat.st_size
+    return (files_warmed, bytes_warmed, files_shared, files_skipped)
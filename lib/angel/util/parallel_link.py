@@ -0,0 +1,163 @@
+import errno
+import multiprocessing
+import os
+import Queue
+import threading
+
+
+# Most threads used to create links by default (see ParallelLinker):
+MAX_DEFAULT_LINK_WORKERS = 8
+
+
+def _call(function, source, dest_path):
+    try:
+        function(source, dest_path)
+    except OSError as e:
+        if e.filename is None:
+            e.filename = '%s -> %s' % (source, dest_path)  # os.link() and os.symlink() don't say which path failed
+        raise
+
+
+def _is_missing_source(e, source):
+    return isinstance(e, OSError) and e.errno == errno.ENOENT and not os.path.lexists(source)
+
+
+class ParallelLinker():
+
+    """ Creates hardlinks and symlinks in a tree across a bounded pool of threads, for materializing versions: on SSDs
+    and network-backed volumes, metadata operations on different dirs run in parallel far better than one at a time.
+
+    Operations are sharded by the dir they create an entry in, so each dir is only ever written to by one thread (no
+    contention for its lock, and its entries are created in the order given). Callers must create a dir before queueing
+    links into it; the usual way is to create the dir skeleton of the tree first.
+
+    Each worker's queue is bounded, so a caller that throttles itself (e.g. with an IOGovernor, as it queues operations)
+    throttles the workers too. Callbacks given with an operation are called once it's done, from the worker thread but
+    never concurrently with each other. After an operation fails, the rest are skipped; finish() raises the first error.
+    Links whose source turns out to be missing are retried by finish(), in the calling thread (see link()).
+
+    With workers=1, operations are done right away in the calling thread, exactly as the serial code would do them.
+    The default is one worker per cpu, up to MAX_DEFAULT_LINK_WORKERS: on local disks the kernel's work for a link is
+    cpu-bound, so on a single cpu the threads only add overhead (see "angel-benchmark link-tree"). Volumes where links
+    wait on the device or network can gain from more workers than cpus.
+
+    """
+
+    workers = 1
+    _queues = None
+    _batches = None
+    _threads = None
+    _error = None
+    _is_closing = False
+    _callback_lock = None
+    _missing_source_ops = None
+
+    _QUEUE_SIZE = 16
+    _BATCH_SIZE = 64
+
+    def __init__(self, workers=None):
+        if workers is None:
+            workers = min(MAX_DEFAULT_LINK_WORKERS, multiprocessing.cpu_count())
+        self.workers = max(1, workers)
+        self._queues = []
+        self._batches = []
+        self._threads = []
+        self._error = None
+        self._is_closing = False
+        self._callback_lock = threading.Lock()
+        self._missing_source_ops = []
+        if self.workers > 1:
+            for i in range(self.workers):
+                self._queues.append(Queue.Queue(self._QUEUE_SIZE))
+                self._batches.append([])
+                thread = threading.Thread(target=self._run_worker, args=(self._queues[-1],))
+                thread.daemon = True  # So that an interrupted install doesn't hang on exit
+                thread.start()
+                self._threads.append(thread)
+
+
+    def link(self, src_path, dest_path, callback=None, find_source=None):
+        """Queue a hardlink of src_path at dest_path; callback(), if given, is called once it's made.
+        If src_path doesn't exist and find_source is given, the link is made from the path find_source() returns instead,
+        for callers that link from where a file is expected to be without checking first. find_source() is called from
+        the calling thread (by finish(), when there are workers), so it can copy files under the caller's IOGovernor."""
+        self._add(os.link, src_path, dest_path, callback, find_source)
+
+
+    def symlink(self, link_target, dest_path, callback=None):
+        """Queue a symlink to link_target at dest_path; callback(), if given, is called once it's made."""
+        self._add(os.symlink, link_target, dest_path, callback)
+
+
+    def _add(self, function, source, dest_path, callback, find_source=None):
+        if self._error is not None:
+            raise self._error
+        if not len(self._queues):
+            try:
+                _call(function, source, dest_path)
+            except OSError as e:
+                if find_source is None or not _is_missing_source(e, source):
+                    raise
+                _call(function, find_source(), dest_path)
+            if callback is not None:
+                callback()
+            return
+        # Operations are handed over in batches, as a queue put costs about as much as making a link:
+        shard = hash(os.path.dirname(dest_path)) % self.workers
+        self._batches[shard].append((function, source, dest_path, callback, find_source))
+        if len(self._batches[shard]) >= self._BATCH_SIZE:
+            self._queues[shard].put(self._batches[shard])
+            self._batches[shard] = []
+
+
+    def _run_worker(self, queue):
+        while True:
+            batch = queue.get()
+            if batch is None:
+                return
+            for (function, source, dest_path, callback, find_source) in batch:
+                if self._error is not None or self._is_closing:
+                    break
+                try:
+                    _call(function, source, dest_path)
+                    if callback is not None:
+                        with self._callback_lock:
+                            callback()
+                except Exception as e:
+                    with self._callback_lock:
+                        if find_source is not None and _is_missing_source(e, source):
+                            self._missing_source_ops.append((function, dest_path, callback, find_source))
+                        elif self._error is None:
+                            self._error = e
+
+
+    def _stop(self):
+        for (queue, batch) in zip(self._queues, self._batches):
+            if len(batch):
+                queue.put(batch)
+            queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._queues = []
+        self._batches = []
+        self._threads = []
+
+
+    def finish(self):
+        """Wait for every queued operation to be done; raises the first error, if any operation failed."""
+        self._stop()
+        if self._error is not None:
+            raise self._error
+        missing_source_ops = self._missing_source_ops
+        self._missing_source_ops = []
+        for (function, dest_path, callback, find_source) in missing_source_ops:
+            _call(function, find_source(), dest_path)
+            if callback is not None:
+                callback()
+
+
+    def close(self):
+        """Stop the workers, skipping any operations still queued; use in a finally block, after finish()."""
+        if len(self._threads):
+            self._is_closing = True
+            self._stop()
@@ -0,0 +1,112 @@
+import os
+import sys
+import time
+
+from angel.util.checksum import split_prefixed_checksum
+
+
+class StatSnapshot():
+
+    """ Path-keyed stat info of the files in a tree as of a checksum run, used to make the next run over the same tree
+    incremental: a file whose size and mtime are unchanged since the baseline run is given the checksum the baseline
+    manifest has for it, and isn't re-read.
+
+    Unlike a ChecksumIndex, which is keyed by inode and so only helps for files that are still the same inode, this is
+    keyed by path, so it works for build trees that are re-created or rewritten in place between builds.
+
+    The snapshot file has a "angel-stat-snapshot 1 <start time>" header line, then a "<size> <mtime> <path>" line per
+    file. Files whose mtime is within a couple of seconds of the start time of the run that recorded them could still
+    have been changing within mtime granularity, so they're never trusted.
+
+    """
+
+    _baseline_checksums = None
+    _baseline_stats = None
+    _baseline_start_time = None
+    _stats = None
+    _start_time = None
+    reused_paths = None
+    hits = 0
+    misses = 0
+
+    _HEADER = 'angel-stat-snapshot 1'
+    _RACY_WINDOW_SECONDS = 2
+
+    def __init__(self, baseline_checksums=None, baseline_snapshot_path=None):
+        """
+        @param baseline_checksums: dict of path to checksum name, from the baseline run's manifest (see
+            angel.util.dedup_files.dedup_load_checksum_file); without it, nothing is reused and this only records stats
+        @param baseline_snapshot_path: path to the snapshot file written by the baseline run
+        """
+        self._baseline_checksums = baseline_checksums
+        self._baseline_stats = {}
+        self._stats = {}
+        self._start_time = time.time()
+        self.reused_paths = []
+        self.hits = 0
+        self.misses = 0
+        if baseline_checksums is not None and baseline_snapshot_path is not None:
+            self._load(baseline_snapshot_path)
+
+
+    def _load(self, snapshot_path):
+        try:
+            lines = open(snapshot_path, 'r').read().split('\n')
+            header = lines[0].split(' ')
+            if ' '.join(header[:-1]) != self._HEADER:
+                raise ValueError("unknown header '%s'" % lines[0][:40])
+            self._baseline_start_time = float(header[-1])
+            for line in lines[1:]:
+                if not len(line):
+                    continue
+                (size, mtime, path) = line.split(' ', 2)
+                self._baseline_stats[path] = (int(size), float(mtime))
+        except (IOError, ValueError) as e:
+            print >>sys.stderr, "Warning: unable to load stat snapshot %s (%s); re-hashing every file." % (snapshot_path, e)
+            self._baseline_stats = {}
+
+
+    def is_baseline_loaded(self):
+        return len(self._baseline_stats) > 0
+
+
+    def get_checksum(self, relpath, file_stat, algorithm):
+        """Return the (prefixed) checksum that the baseline manifest has for the file at relpath, if its size and mtime
+        are unchanged since the baseline run; otherwise None, meaning the file needs to be hashed."""
+        entry = self._baseline_stats.get(relpath)
+        if entry is None or entry != (file_stat.st_size, file_stat.st_mtime) or \
+                file_stat.st_mtime >= self._baseline_start_time - self._RACY_WINDOW_SECONDS:
+            self.misses += 1
+            return None
+        checksum_name = self._baseline_checksums.get(relpath)
+        checksum = None
+        if checksum_name is not None:
+            checksum = checksum_name.split('.', 1)[0]
+            if split_prefixed_checksum(checksum)[0] != algorithm:
+                checksum = None  # The baseline run used a different algorithm
+        if checksum is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.reused_paths.append(relpath)
+        return checksum
+
+
+    def record(self, relpath, file_stat):
+        """Record the stat info of a file in this run, for save()."""
+        self._stats[relpath] = (file_stat.st_size, file_stat.st_mtime)
+
+
+    def save(self, snapshot_path):
+        """Atomically write the stats recorded in this run, for use as the next run's baseline."""
+        snapshot_path_tmp = '%s-%s' % (snapshot_path, time.time())
+        try:
+            with open(snapshot_path_tmp, 'w') as f:
+                f.write('%s %r\n' % (self._HEADER, self._start_time))
+                for relpath in sorted(self._stats):
+                    f.write('%d %r %s\n' % (self._stats[relpath][0], self._stats[relpath][1], relpath))
+            os.rename(snapshot_path_tmp, snapshot_path)
+        except (IOError, OSError) as e:
+            print >>sys.stderr, "Warning: unable to write stat snapshot %s (%s)." % (snapshot_path, e)
+            if os.path.exists(snapshot_path_tmp):
+                os.remove(snapshot_path_tmp)
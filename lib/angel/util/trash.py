@@ -0,0 +1,132 @@
+import errno
+import fcntl
+import os
+import stat
+import sys
+import time
+
+from angel.util.io_governor import IOGovernor, remove_tree
+
+
+class Trash():
+
+    """ A dir that doomed trees (old versions, tmp files) are renamed into, so that deleting them
+    returns at once; empty() then removes them at a rate bounded by an IOGovernor, normally from a background worker.
+
+    Moving into the trash is a single rename(), so it's atomic and the trash must be on the same filesystem as the trees
+    given to it. Removal works from whatever is left on disk, so an empty() that's interrupted (or a crash) simply picks
+    up where it stopped the next time. Entries are named "<time>.<pid>.<n>.<original name>" and removed oldest first;
+    dot-files in the trash dir are ours (the lock file).
+
+    """
+
+    _trash_dir = None
+    _entry_count = 0
+
+    _LOCK_FILENAME = '.lock'
+
+    def __init__(self, trash_dir):
+        self._trash_dir = trash_dir
+
+
+    def get_path(self):
+        return self._trash_dir
+
+
+    def make_entry_name(self, path):
+        """Return a new, unique trash entry name for the given path; pass it to move_to_trash."""
+        self._entry_count += 1
+        return '%d.%d.%d.%s' % (time.time(), os.getpid(), self._entry_count, os.path.basename(path.rstrip('/')))
+
+
+    def move_to_trash(self, path, entry_name=None):
+        """Atomically rename the file or dir at path into the trash; returns the trash entry name.
+        Throws OSError if path can't be renamed into the trash (e.g. EXDEV, if it's on a different filesystem)."""
+        if entry_name is None:
+            entry_name = self.make_entry_name(path)
+        if not os.path.isdir(self._trash_dir):
+            try:
+                os.makedirs(self._trash_dir, 0700)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+        os.rename(path, os.path.join(self._trash_dir, entry_name))
+        return entry_name
+
+
+    def has_entry(self, entry_name):
+        return os.path.lexists(os.path.join(self._trash_dir, entry_name))
+
+
+    def get_entry_names(self):
+        """Return the names of the entries still in the trash, oldest first."""
+        if not os.path.isdir(self._trash_dir):
+            return []
+        names = [name for name in os.listdir(self._trash_dir) if not name.startswith('.')]
+        return sorted(names, key=lambda name: (name.split('.', 1)[0].zfill(20), name))
+
+
+    def get_status(self):
+        """Return (entries, inodes, bytes) still waiting to be removed; this walks the trash, so it takes a while on
+        large trees."""
+        entry_count = 0
+        inode_count = 0
+        byte_count = 0
+        for name in self.get_entry_names():
+            entry_count += 1
+            path = os.path.join(self._trash_dir, name)
+            try:
+                entry_stat = os.lstat(path)
+            except OSError:
+                continue  # Removed since we listed it
+            inode_count += 1
+            if not stat.S_ISDIR(entry_stat.st_mode):
+                byte_count += entry_stat.st_size
+                continue
+            for (dir_path, dir_names, file_names) in os.walk(path):
+                for file_name in dir_names + file_names:
+                    try:
+                        file_stat = os.lstat(os.path.join(dir_path, file_name))
+                    except OSError:
+                        continue
+                    inode_count += 1
+                    if stat.S_ISREG(file_stat.st_mode):
+                        byte_count += file_stat.st_size
+        return (entry_count, inode_count, byte_count)
+
+
+    def empty(self, io_governor=None, max_seconds=None):
+        """Remove everything in the trash, throttled by io_governor; returns (entries_removed, is_complete).
+        With max_seconds, stops after roughly that long, leaving the rest for the next call. Only one process empties a
+        given trash at a time; if another one is, this returns (0, False) right away. Entries that can't be removed
+        (e.g. permission errors) are warned about and left in place, and the rest are still removed."""
+        if not os.path.isdir(self._trash_dir):
+            return (0, True)
+        if io_governor is None:
+            io_governor = IOGovernor()
+        deadline = None
+        if max_seconds is not None:
+            deadline = time.time() + max_seconds
+        lock_fd = os.open(os.path.join(self._trash_dir, self._LOCK_FILENAME), os.O_WRONLY | os.O_CREAT, 0600)
+        try:
+            try:
+                fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError as e:
+                if e.errno in (errno.EAGAIN, errno.EACCES):
+                    return (0, False)
+                raise
+            removed_count = 0
+            failed_count = 0
+            for name in self.get_entry_names():
+                try:
+                    if not remove_tree(os.path.join(self._trash_dir, name), io_governor=io_governor, deadline=deadline):
+                        return (removed_count, False)
+                    removed_count += 1
+                except (IOError, OSError) as e:
+                    print >>sys.stderr, "Warning: unable to remove trash entry %s (%s); skipping it." % (os.path.join(self._trash_dir, name), e)
+                    failed_count += 1
+                if deadline is not None and time.time() > deadline:
+                    return (removed_count, not len(self.get_entry_names()))
+            return (removed_count, failed_count == 0)
+        finally:
+            os.close(lock_fd)
@@ -0,0 +1,191 @@
+import hashlib
+import os
+import sys
+import time
+
+
+# Tree manifests hold the same path -> checksum mapping as flat checksum files (see angel.util.dedup_files), grouped by
+# dir and with a Merkle hash per dir, so that two trees can be compared by descending only into the dirs that differ:
+#
+#   header:  "angel-tree-manifest 1 <dir count> <distinct files> <distinct file bytes>"
+#   index:   "<tree hash> <block offset> <block length> <dir>" per dir, sorted by dir; the top dir is "."
+#   blocks:  per dir, "<checksum name> <name>" lines for its entries (files and subdirs), sorted by name
+#
+# A dir's tree hash is the sha1 of its block followed by its subdirs' tree hashes (in name order), so it changes if
+# anything below the dir does. Block offsets are relative to the end of the index. Readers load only the header and
+# index up front, and read the blocks of the dirs they look into, so comparing two trees that differ in one file costs
+# a read of the index plus one block per dir on the path to that file.
+#
+# Tree manifests are written next to flat ones ("<checksum file>.tree"), which stay the format every reader understands.
+
+TREE_MANIFEST_SUFFIX = '.tree'
+_HEADER = 'angel-tree-manifest 1'
+_TOP_DIR = '.'
+
+
+def get_tree_manifest_path(checksum_file):
+    ''' Return the path of the tree manifest that goes with the given flat checksum file. '''
+    return checksum_file + TREE_MANIFEST_SUFFIX
+
+
+def _split_path(path):
+    ''' Return (dir, name) of a manifest path; entries at the top of the tree are in _TOP_DIR. '''
+    if '/' not in path:
+        return (_TOP_DIR, path)
+    return tuple(path.rsplit('/', 1))
+
+
+def _join_path(dir_path, name):
+    if dir_path == _TOP_DIR:
+        return name
+    return '%s/%s' % (dir_path, name)
+
+
+def write_tree_manifest(path, checksums):
+    ''' Atomically write a tree manifest of the given dict of path to checksum name; returns the top dir's tree hash. '''
+    entries_by_dir = {_TOP_DIR: []}
+    distinct_sizes = {}
+    for (file_path, checksum) in checksums.iteritems():
+        (dir_path, name) = _split_path(file_path)
+        entries_by_dir.setdefault(dir_path, []).append((name, checksum))
+        if checksum.startswith('0.'):
+            entries_by_dir.setdefault(file_path, [])  # '0.' entries are dirs
+        else:
+            distinct_sizes[checksum] = int(checksum.split('.')[1])
+    # Every dir needs a block, even if the manifest only lists its entries (e.g. manifests that leave dirs out):
+    for dir_path in entries_by_dir.keys():
+        while dir_path != _TOP_DIR:
+            dir_path = _split_path(dir_path)[0]
+            entries_by_dir.setdefault(dir_path, [])
+
+    # Hash the deepest dirs first, so that each dir's subdir hashes are known when it's hashed:
+    tree_hashes = {}
+    blocks = {}
+    for dir_path in sorted(entries_by_dir, key=lambda dir_path: -dir_path.count('/') - (dir_path != _TOP_DIR)):
+        entries = sorted(entries_by_dir[dir_path])
+        blocks[dir_path] = ''.join(['%s %s\n' % (checksum, name) for (name, checksum) in entries])
+        h = hashlib.sha1(blocks[dir_path])
+        for (name, checksum) in entries:
+            subdir_path = _join_path(dir_path, name)
+            if subdir_path in entries_by_dir:
+                h.update(tree_hashes[subdir_path])
+        tree_hashes[dir_path] = h.hexdigest()
+
+    index = []
+    offset = 0
+    for dir_path in sorted(blocks):
+        index.append('%s %d %d %s\n' % (tree_hashes[dir_path], offset, len(blocks[dir_path]), dir_path))
+        offset += len(blocks[dir_path])
+    path_tmp = '%s-%s' % (path, time.time())
+    try:
+        with open(path_tmp, 'w') as f:
+            f.write('%s %d %d %d\n' % (_HEADER, len(blocks), len(distinct_sizes), sum(distinct_sizes.itervalues())))
+            f.write(''.join(index))
+            for dir_path in sorted(blocks):
+                f.write(blocks[dir_path])
+        os.rename(path_tmp, path)
+    finally:
+        if os.path.exists(path_tmp):
+            os.remove(path_tmp)
+    return tree_hashes[_TOP_DIR]
+
+
+def load_tree_manifest(path):
+    ''' Return a TreeManifest for the tree manifest at path, or None if there isn't a readable one. '''
+    if not os.path.isfile(path):
+        return None
+    try:
+        return TreeManifest(path)
+    except (IOError, ValueError) as e:
+        print >>sys.stderr, "Warning: unable to load tree manifest %s (%s); ignoring it." % (path, e)
+        return None
+
+
+class TreeManifest():
+
+    """ Read-only view of a tree manifest (see write_tree_manifest). Only the index is loaded; dir blocks are read from
+    the file as they're asked for. """
+
+    _path = None
+    _dirs = None
+    _blocks_offset = 0
+    distinct_files = 0
+    distinct_bytes = 0
+
+    def __init__(self, path):
+        self._path = path
+        self._dirs = {}
+        with open(path, 'r') as f:
+            header = f.readline().rstrip('\n').split(' ')
+            if ' '.join(header[:-3]) != _HEADER:
+                raise ValueError("unknown header '%s'" % ' '.join(header)[:40])
+            (dir_count, self.distinct_files, self.distinct_bytes) = [int(value) for value in header[-3:]]
+            for i in range(dir_count):
+                (tree_hash, offset, length, dir_path) = f.readline().rstrip('\n').split(' ', 3)
+                self._dirs[dir_path] = (tree_hash, int(offset), int(length))
+            self._blocks_offset = f.tell()
+        if _TOP_DIR not in self._dirs:
+            raise ValueError("no top dir")
+
+
+    def get_tree_hash(self, dir_path=_TOP_DIR):
+        """Return the tree hash of the given dir, or None if it isn't in the tree."""
+        if dir_path not in self._dirs:
+            return None
+        return self._dirs[dir_path][0]
+
+
+    def get_entries(self, dir_path):
+        """Return a dict of name to checksum name of the entries directly in the given dir (empty if it isn't in the tree)."""
+        if dir_path not in self._dirs:
+            return {}
+        (tree_hash, offset, length) = self._dirs[dir_path]
+        with open(self._path, 'r') as f:
+            f.seek(self._blocks_offset + offset)
+            block = f.read(length)
+        entries = {}
+        for line in block.split('\n'):
+            if len(line):
+                (checksum, name) = line.split(' ', 1)
+                entries[name] = checksum
+        return entries
+
+
+    def iteritems(self, dir_path=_TOP_DIR):
+        """Yield (path, checksum name) of every entry below the given dir."""
+        for (name, checksum) in sorted(self.get_entries(dir_path).items()):
+            path = _join_path(dir_path, name)
+            yield (path, checksum)
+            if path in self._dirs:
+                for item in self.iteritems(path):
+                    yield item
+
+
+def diff_tree_manifests(old_tree, new_tree):
+    ''' Compare two TreeManifests, descending only into dirs whose tree hashes differ. Returns a list of
+        (path, old checksum name, new checksum name) for every entry (file or dir) that was added (old is None), removed
+        (new is None) or changed; entries below a dir that's only in one of the trees are listed too. '''
+    differences = []
+
+    def _compare_dir(dir_path):
+        if old_tree.get_tree_hash(dir_path) == new_tree.get_tree_hash(dir_path):
+            return
+        old_entries = old_tree.get_entries(dir_path)
+        new_entries = new_tree.get_entries(dir_path)
+        for name in sorted(set(old_entries) | set(new_entries)):
+            path = _join_path(dir_path, name)
+            old_checksum = old_entries.get(name)
+            new_checksum = new_entries.get(name)
+            old_is_dir = old_tree.get_tree_hash(path) is not None
+            new_is_dir = new_tree.get_tree_hash(path) is not None
+            if old_checksum != new_checksum:
+                differences.append((path, old_checksum, new_checksum))
+            if old_is_dir and new_is_dir:
+                _compare_dir(path)
+            elif old_is_dir:
+                differences.extend([(sub_path, checksum, None) for (sub_path, checksum) in old_tree.iteritems(path)])
+            elif new_is_dir:
+                differences.extend([(sub_path, None, checksum) for (sub_path, checksum) in new_tree.iteritems(path)])
+
+    _compare_dir(_TOP_DIR)
+    return differences
@@ -0,0 +1,129 @@
+import os
+import stat
+
+try:
+    from os import scandir as _scandir  # python 3.5+
+except ImportError:
+    try:
+        from scandir import scandir as _scandir  # the "scandir" backport, when installed
+    except ImportError:
+        _scandir = None
+
+
+# Tree walking for code that looks at every file in a large tree (installs, checksums, dedup).
+#
+# os.walk() stats every entry to decide if it's a dir, and its callers then lstat/isdir/islink the same entries again,
+# so each file costs several stat syscalls. The entries here cache what they learn: with scandir, types come from the
+# directory listing itself (d_type) and lstat() is only issued when asked for; without it, each entry is lstat'ed
+# exactly once. Only symlinks need a second stat, and only when the caller asks about their target.
+
+
+class TreeEntry():
+
+    """ A directory entry with cached type and stat info; the interface mirrors scandir's DirEntry.
+
+    lstat() is the entry's own stat info; stat() follows symlinks. is_dir() and is_file() follow symlinks by default,
+    like os.path.isdir/isfile; pass follow_symlinks=False to ask about the entry itself. Dangling symlinks are neither.
+
+    """
+
+    name = None
+    path = None
+    _dir_entry = None
+    _lstat = None
+    _stat = None
+
+    def __init__(self, path, name, dir_entry=None):
+        self.path = path
+        self.name = name
+        self._dir_entry = dir_entry
+        if dir_entry is None:
+            self._lstat = os.lstat(path)
+
+
+    def lstat(self):
+        if self._lstat is None:
+            self._lstat = self._dir_entry.stat(follow_symlinks=False)
+        return self._lstat
+
+
+    def stat(self, follow_symlinks=True):
+        if not follow_symlinks or not self.is_symlink():
+            return self.lstat()
+        if self._stat is None:
+            self._stat = os.stat(self.path)
+        return self._stat
+
+
+    def is_symlink(self):
+        if self._dir_entry is not None and self._lstat is None:
+            return self._dir_entry.is_symlink()
+        return stat.S_ISLNK(self.lstat().st_mode)
+
+
+    def is_dir(self, follow_symlinks=True):
+        return self._is_type(stat.S_ISDIR, follow_symlinks)
+
+
+    def is_file(self, follow_symlinks=True):
+        return self._is_type(stat.S_ISREG, follow_symlinks)
+
+
+    def _is_type(self, is_type_function, follow_symlinks):
+        if self._dir_entry is not None and self._lstat is None and not self._dir_entry.is_symlink():
+            return is_type_function(stat.S_IFDIR if self._dir_entry.is_dir(follow_symlinks=False) else
+                                    stat.S_IFREG if self._dir_entry.is_file(follow_symlinks=False) else 0)
+        try:
+            return is_type_function(self.stat(follow_symlinks).st_mode)
+        except OSError:
+            return False  # Dangling symlink
+
+
+def list_dir_entries(path, sort=False):
+    ''' Return a list of TreeEntry objects for the contents of the dir at path, optionally sorted by name.
+        Entries that disappear while being listed are skipped. Throws OSError if path can't be listed. '''
+    entries = []
+    if _scandir is not None:
+        for dir_entry in _scandir(path):
+            entries.append(TreeEntry(dir_entry.path, dir_entry.name, dir_entry))
+    else:
+        for name in os.listdir(path):
+            try:
+                entries.append(TreeEntry(os.path.join(path, name), name))
+            except OSError:
+                continue  # Removed since we listed the dir
+    if sort:
+        entries.sort(key=lambda entry: entry.name)
+    return entries
+
+
+def walk_tree(top, sort=False, follow_symlinks=False):
+    ''' Like os.walk(top) (top-down, errors ignored), but yields (dir_path, dir_entries, file_entries), where the entries
+        are TreeEntry objects. As with os.walk, symlinks to dirs are listed in dir_entries but are only descended into
+        if follow_symlinks is True (dirs reachable more than once, e.g. through a symlink loop, are walked only once),
+        and removing entries from dir_entries prunes the walk. '''
+    stack = [top]
+    seen_dirs = set()
+    while len(stack):
+        dir_path = stack.pop()
+        try:
+            entries = list_dir_entries(dir_path, sort=sort)
+        except OSError:
+            continue
+        dir_entries = []
+        file_entries = []
+        for entry in entries:
+            if entry.is_dir():
+                dir_entries.append(entry)
+            else:
+                file_entries.append(entry)
+        yield (dir_path, dir_entries, file_entries)
+        for entry in reversed(dir_entries):
+            if not follow_symlinks:
+                if not entry.is_symlink():
+                    stack.append(entry.path)
+                continue
+            dir_stat = entry.stat()
+            if (dir_stat.st_dev, dir_stat.st_ino) not in seen_dirs:
+                seen_dirs.add((dir_stat.st_dev, dir_stat.st_ino))
+                stack.append(entry.path)
@@ -0,0 +1,238 @@
+import errno
+import fcntl
+import os
+import sys
+import time
+
+
+def get_version_sort_key(version):
+    ''' Return a key that sorts version strings of the form X[.Y[...Z]] (X, Y, .. Z ints) oldest first, so that 1.10
+        sorts after 1.9. Missing parts count as 0, so "1" and "1.0" get the same key. Throws ValueError for other strings. '''
+    key = [int(part) for part in version.split('.')]
+    while len(key) > 1 and key[-1] == 0:
+        key.pop()
+    return tuple(key)
+
+
+class VersionCatalog():
+
+    """ Index of the installed versions of each branch, so that version queries don't have to list and re-sort the
+    versions dir every time.
+
+    For each version, the catalog records a pre-parsed sort key (see get_version_sort_key), the install time, the total
+    size and file count (when known) and the version it downgrades to (if any), as a dict with the keys 'version',
+    'sort_key', 'install_time', 'size', 'file_count' and 'downgrade_to'.
+
+    The catalog is a cache of what's on disk. For each branch it records the mtime of the branch dir as of the last
+    update; adding or removing a version dir changes that mtime, so a branch that was changed behind our back (by an
+    older angel, a crash between installing a version and updating the catalog, or by hand) is noticed with a single
+    stat and rebuilt from disk with the given scan function. Updates are made under a lock and written atomically, so
+    readers always see a complete catalog.
+
+    A change made within the mtime granularity of a scan wouldn't change the mtime the scan recorded, so a branch that
+    was scanned within _RACY_WINDOW_SECONDS of its dir's mtime is recorded as unverified (an mtime of -1), and is
+    scanned again by the next reader.
+
+    The file has a "angel-version-catalog 1" header line, then a "B <branch> <branch dir mtime>" line per branch, each
+    followed by "V <version> <sort key> <install time> <size> <file count> <downgrade to>" lines, oldest version first;
+    unknown values are written as "-".
+
+    """
+
+    _catalog_path = None
+    _scan_function = None
+    _branches = None
+    _catalog_stat = None
+
+    _HEADER = 'angel-version-catalog 1'
+    _RACY_WINDOW_SECONDS = 2
+    _UNVERIFIED_MTIME = -1.0
+
+    def __init__(self, catalog_path, scan_function):
+        """
+        @param catalog_path: path to the catalog file; it's created on first update
+        @param scan_function: function(branch, old_entries) that lists the given branch's versions on disk, returning
+            (branch dir mtime, list of entries); old_entries is a dict of version to entry from the catalog, to re-use
+            values that are expensive to get from disk. Returns (None, []) if the branch doesn't exist.
+        """
+        self._catalog_path = catalog_path
+        self._scan_function = scan_function
+        self._branches = {}
+        self._catalog_stat = None
+
+
+    def _load(self):
+        """(Re-)read the catalog file if it's changed since we last read it."""
+        try:
+            catalog_stat = os.stat(self._catalog_path)
+        except OSError:
+            self._branches = {}
+            self._catalog_stat = None
+            return
+        if self._catalog_stat is not None and \
+                (catalog_stat.st_ino, catalog_stat.st_mtime, catalog_stat.st_size) == \
+                (self._catalog_stat.st_ino, self._catalog_stat.st_mtime, self._catalog_stat.st_size):
+            return
+        branches = {}
+        try:
+            lines = open(self._catalog_path, 'r').read().split('\n')
+            if lines[0] != self._HEADER:
+                raise ValueError("unknown header '%s'" % lines[0][:40])
+            branch = None
+            for line in lines[1:]:
+                if not len(line):
+                    continue
+                fields = line.split(' ')
+                if fields[0] == 'B':
+                    branch = fields[1]
+                    branches[branch] = (float(fields[2]), [])
+                elif fields[0] == 'V':
+                    def _optional(value, f):
+                        if value == '-':
+                            return None
+                        return f(value)
+                    branches[branch][1].append({'version': fields[1],
+                                                'sort_key': tuple([int(part) for part in fields[2].split('.')]),
+                                                'install_time': _optional(fields[3], float),
+                                                'size': _optional(fields[4], int),
+                                                'file_count': _optional(fields[5], int),
+                                                'downgrade_to': _optional(fields[6], str)})
+                else:
+                    raise ValueError("unknown line '%s'" % line[:40])
+        except (IOError, ValueError, IndexError, KeyError) as e:
+            print >>sys.stderr, "Warning: unable to read version catalog %s (%s); rebuilding it." % (self._catalog_path, e)
+            branches = {}
+        self._branches = branches
+        self._catalog_stat = catalog_stat
+
+
+    def _save(self):
+        lines = [self._HEADER]
+        for branch in sorted(self._branches):
+            (branch_mtime, entries) = self._branches[branch]
+            lines.append('B %s %r' % (branch, branch_mtime))
+            for entry in entries:
+                def _optional(value, format):
+                    if value is None:
+                        return '-'
+                    return format % value
+                lines.append('V %s %s %s %s %s %s' % (entry['version'],
+                                                      '.'.join([str(part) for part in entry['sort_key']]),
+                                                      _optional(entry['install_time'], '%r'),
+                                                      _optional(entry['size'], '%d'),
+                                                      _optional(entry['file_count'], '%d'),
+                                                      _optional(entry['downgrade_to'], '%s')))
+        catalog_path_tmp = '%s-%s' % (self._catalog_path, time.time())
+        try:
+            with open(catalog_path_tmp, 'w') as f:
+                f.write('\n'.join(lines) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(catalog_path_tmp, self._catalog_path)
+        except (IOError, OSError) as e:
+            print >>sys.stderr, "Warning: unable to write version catalog %s (%s)." % (self._catalog_path, e)
+            if os.path.exists(catalog_path_tmp):
+                os.remove(catalog_path_tmp)
+            return
+        self._catalog_stat = os.stat(self._catalog_path)
+
+
+    def _lock(self):
+        """Lock the catalog for an update; returns the lock fd, or None if we can't (e.g. when not root), in which case
+        updates are only made in memory."""
+        try:
+            lock_fd = os.open('%s.lock' % self._catalog_path, os.O_WRONLY | os.O_CREAT, 0600)
+        except OSError as e:
+            if e.errno not in (errno.EACCES, errno.EPERM, errno.EROFS, errno.ENOENT):
+                raise
+            return None
+        fcntl.flock(lock_fd, fcntl.LOCK_EX)
+        return lock_fd
+
+
+    def _get_branch_mtime(self, branch_path):
+        try:
+            return os.stat(branch_path).st_mtime
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return None
+
+
+    def _rebuild_branch(self, branch):
+        old_entries = {}
+        if branch in self._branches:
+            old_entries = dict([(entry['version'], entry) for entry in self._branches[branch][1]])
+        (branch_mtime, entries) = self._scan_function(branch, old_entries)
+        if branch_mtime is None:
+            self._branches.pop(branch, None)
+        else:
+            if time.time() - branch_mtime < self._RACY_WINDOW_SECONDS:
+                branch_mtime = self._UNVERIFIED_MTIME
+            self._branches[branch] = (branch_mtime, sorted(entries, key=lambda entry: (entry['sort_key'], entry['version'])))
+
+
+    def get_entries(self, branch, branch_path):
+        """Return the list of entries of the given branch's versions, oldest first; empty if the branch isn't installed.
+        branch_path is stat'ed to check that the catalog is up to date; if it's not, the branch is rebuilt from disk."""
+        branch_mtime = self._get_branch_mtime(branch_path)
+        if branch in self._branches and self._branches[branch][0] == branch_mtime:
+            return self._branches[branch][1]
+        self._load()
+        if branch in self._branches and self._branches[branch][0] == branch_mtime:
+            return self._branches[branch][1]
+        if branch_mtime is None and branch not in self._branches:
+            return []
+        self.update_branch(branch)
+        if branch not in self._branches:
+            return []
+        return self._branches[branch][1]
+
+
+    def get_entry(self, branch, branch_path, version):
+        """Return the entry of the given version, or None if it's not installed."""
+        entries = self.get_entries(branch, branch_path)
+        try:
+            sort_key = get_version_sort_key(version)
+        except ValueError:
+            return None
+        i = self._bisect_entries(entries, sort_key)
+        while i < len(entries) and entries[i]['sort_key'] == sort_key:
+            if entries[i]['version'] == version:
+                return entries[i]
+            i += 1
+        return None
+
+
+    def _bisect_entries(self, entries, sort_key):
+        """Return the index of the first entry whose sort key is >= sort_key."""
+        lo = 0
+        hi = len(entries)
+        while lo < hi:
+            mid = (lo + hi) / 2
+            if entries[mid]['sort_key'] < sort_key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+
+    def update_branch(self, branch, updated_entries=None):
+        """Re-scan the given branch from disk (after adding or removing a version) and save the catalog; entries in
+        updated_entries (a list of entry dicts) replace what the catalog or the scan has for those versions."""
+        lock_fd = self._lock()
+        try:
+            if lock_fd is not None:
+                self._load()
+            if updated_entries:
+                (branch_mtime, entries) = self._branches.get(branch, (None, []))
+                by_version = dict([(entry['version'], entry) for entry in entries])
+                for entry in updated_entries:
+                    by_version[entry['version']] = entry
+                self._branches[branch] = (branch_mtime, by_version.values())
+            self._rebuild_branch(branch)
+            if lock_fd is not None:
+                self._save()
+        finally:
+            if lock_fd is not None:
+                os.close(lock_fd)
@@ -1,12 +1,21 @@
+import angel.util.blob_store
+import angel.util.checksum
+import angel.util.checksum_index
 import angel.util.dedup_files
 import angel.util.file
+import angel.util.git_checksums
+import angel.util.io_governor
+import angel.util.page_cache
 import angel.util.process
+import angel.util.trash
+import angel.util.tree_manifest
+import angel.util.version_catalog
 import ctypes
 import glob
 import os
 import random
-import shutil
 import signal
+import stat
 import sys
 import time
 
@@ -29,12 +38,16 @@ class AngelVersionManager():
     """
 
     _versions_dir = None
+    _io_limits = None
+    _version_catalog = None
 
-    def __init__(self, versions_dir):
+    def __init__(self, versions_dir, io_limits=None):
         """
         @param versions_dir: path to top level of our versions dir
+        @param io_limits: dict of angel.util.io_governor.IOGovernor options, used to throttle installs, deletes and dedup work
         """
         self._versions_dir = versions_dir
+        self._io_limits = io_limits
         if not os.path.isdir(versions_dir):
             try:
                 os.makedirs(versions_dir)
@@ -52,55 +65,442 @@ class AngelVersionManager():
         return os.path.join(self._get_angel_version_data_dir(), 'dedup_hardlinks')
 
 
-    def add_version(self, branch, version, path_to_src_code, sleep_ratio=0):
+    def _get_checksum_index_path(self):
+        return os.path.join(self._get_angel_version_data_dir(), 'checksum_index')
+
+
+    def _get_pending_gc_dir(self):
+        """Return the dir of manifests of deleted versions whose dedup files still need to be cleaned up."""
+        return os.path.join(self._get_angel_version_data_dir(), 'pending_gc')
+
+
+    def get_trash(self):
+        """Return the angel.util.trash.Trash that deleted versions are moved into."""
+        return angel.util.trash.Trash(os.path.join(self._get_angel_version_data_dir(), 'trash'))
+
+
+    def _get_version_catalog(self):
+        """Return the angel.util.version_catalog.VersionCatalog that version queries are answered from."""
+        if self._version_catalog is None:
+            self._version_catalog = angel.util.version_catalog.VersionCatalog(os.path.join(self._get_angel_version_data_dir(), 'version_catalog'),
+                                                                              self._scan_branch_versions)
+        return self._version_catalog
+
+
+    def _scan_branch_versions(self, branch, old_entries):
+        """List the versions of the given branch on disk, for rebuilding the version catalog; see VersionCatalog."""
+        branch_path = self._get_path_for_branch(branch)
+        try:
+            branch_mtime = os.stat(branch_path).st_mtime  # Before listing, so that a change during the listing is noticed later
+        except OSError:
+            return (None, [])
+        entries = []
+        # Versions are X[.Y]; this skips our _default symlink, in-progress installs and anything else that isn't a version:
+        for name in os.listdir(branch_path):
+            if not name[0].isdigit():
+                continue
+            try:
+                sort_key = angel.util.version_catalog.get_version_sort_key(name)
+            except ValueError:
+                continue
+            version_path = os.path.join(branch_path, name)
+            try:
+                install_time = os.stat(version_path).st_mtime
+            except OSError:
+                continue
+            entry = old_entries.get(name)
+            if entry is None or entry['install_time'] != install_time:
+                downgrade_to = None
+                downgrade_control_file = self._get_downgrade_control_filepath(branch, name)
+                if os.path.isfile(downgrade_control_file):
+                    downgrade_to = open(downgrade_control_file).read().rstrip() or None
+                entry = {'version': name, 'sort_key': sort_key, 'install_time': install_time, 'size': None,
+                         'file_count': None, 'downgrade_to': downgrade_to}
+            entries.append(entry)
+        return (branch_mtime, entries)
+
+
+    def get_version_catalog_entry(self, branch, version):
+        """Return the catalog info of the given version -- a dict with 'install_time', 'size', 'file_count' and
+        'downgrade_to' keys; see angel.util.version_catalog.VersionCatalog -- or None if it isn't installed."""
+        return self._get_version_catalog().get_entry(branch, self._get_path_for_branch(branch), version)
+
+
+    def _get_io_governor(self, sleep_ratio=0):
+        return angel.util.io_governor.get_io_governor(self._io_limits, sleep_ratio=sleep_ratio)
+
+
+    def _get_version_manifest_path(self, branch, version):
+        """Return the path to the checksum file recording every dedup file that the given version links to."""
+        return os.path.join(self._get_angel_version_data_dir(), 'manifests', branch, version)
+
+
+    def _get_version_file_usage_path(self, branch, version):
+        """Return the path to the list of files that the given version's running services were seen using."""
+        return os.path.join(self._get_angel_version_data_dir(), 'file_usage', branch, version)
+
+
+    def get_version_manifest(self, branch, version):
+        """Return the checksum dict (path to checksum) of the given installed version, or None if it has no manifest.
+        This only reads manifest files; the version's files aren't walked or hashed."""
+        if not self.is_version_installed(branch, version):
+            raise angel.exceptions.AngelVersionException("Branch %s, version %s not installed." % (branch, version))
+        # Prefer the manifest recorded at install time, as it lists every file; the build's checksum file may not:
+        for checksum_file in (self._get_version_manifest_path(branch, version),
+                              os.path.join(self.get_path_for_version(branch, version), '.angel', 'file_checksums.bin'),
+                              os.path.join(self.get_path_for_version(branch, version), '.angel', 'file_checksums')):
+            if os.path.isfile(checksum_file):
+                return angel.util.dedup_files.dedup_load_checksum_file(checksum_file)
+        return None
+
+
+    def get_version_tree_manifest(self, branch, version):
+        """Return the TreeManifest of the given installed version (see angel.util.tree_manifest), or None if it has none
+        (e.g. versions installed before tree manifests were recorded)."""
+        if not self.is_version_installed(branch, version):
+            raise angel.exceptions.AngelVersionException("Branch %s, version %s not installed." % (branch, version))
+        for checksum_file in (self._get_version_manifest_path(branch, version),
+                              os.path.join(self.get_path_for_version(branch, version), '.angel', 'file_checksums')):
+            tree_manifest = angel.util.tree_manifest.load_tree_manifest(angel.util.tree_manifest.get_tree_manifest_path(checksum_file))
+            if tree_manifest is not None:
+                return tree_manifest
+        return None
+
+
+    def _get_newest_version_tree_manifest(self, branch):
+        """Return the TreeManifest of the newest installed version of the given branch that has one, or None. All the
+        files it lists are in the dedup dir, so other trees can be compared against it to find what may be missing."""
+        if not os.path.isdir(self._get_path_for_branch(branch)):
+            return None
+        for version in reversed(self.get_available_installed_versions(branch)):
+            tree_manifest = self.get_version_tree_manifest(branch, version)
+            if tree_manifest is not None:
+                return tree_manifest
+        return None
+
+
+    def diff_versions(self, old_checksums, new_checksums, old_tree_manifest=None, new_tree_manifest=None):
+        """Compare two version manifests (see get_version_manifest), checking the dedup dir for files that the new one
+        can share; see angel.util.dedup_files.dedup_diff_checksums for the returned dict. If both versions' tree
+        manifests are given (see get_version_tree_manifest), only the dirs that differ are compared, and the checksum
+        dicts aren't used (so they can be None)."""
+        if old_tree_manifest is not None and new_tree_manifest is not None:
+            return angel.util.dedup_files.dedup_diff_tree_manifests(old_tree_manifest, new_tree_manifest,
+                                                                    self._get_checksum_hardlink_path())
+        return angel.util.dedup_files.dedup_diff_checksums(old_checksums, new_checksums,
+                                                           hardlink_checksum_dir=self._get_checksum_hardlink_path())
+
+
+    def get_version_file_usage(self, branch, version):
+        """Return the sorted list of paths (relative to the version dir) recorded by record_version_file_usage."""
+        usage_path = self._get_version_file_usage_path(branch, version)
+        if not os.path.isfile(usage_path):
+            return []
+        return [path for path in open(usage_path, 'r').read().split('\n') if len(path)]
+
+
+    def record_version_file_usage(self, branch, version):
+        """Sample the files under the given version that running processes have open or mapped, and add them to the
+        version's recorded usage list; returns the updated list. Sampling is cheap (one pass over /proc), so this can be
+        called whenever the version is known to be running."""
+        paths = set(self.get_version_file_usage(branch, version))
+        paths.update(angel.util.file.get_open_files_under_path(self.get_path_for_version(branch, version)))
+        paths = sorted(paths)
+        usage_path = self._get_version_file_usage_path(branch, version)
+        try:
+            if not os.path.isdir(os.path.dirname(usage_path)):
+                os.makedirs(os.path.dirname(usage_path))
+            usage_path_tmp = '%s-%s' % (usage_path, os.getpid())
+            open(usage_path_tmp, 'w').write(''.join(['%s\n' % path for path in paths]))
+            os.rename(usage_path_tmp, usage_path)
+        except (IOError, OSError) as e:
+            print >>sys.stderr, "Warning: unable to record file usage of branch %s, version %s (%s)." % (branch, version, e)
+        return paths
+
+
+    def prewarm_version(self, branch, version, byte_budget, running_branch=None, running_version=None):
+        """Pull the files that the running version uses (and that the given version used, if it has run before) from
+        the given version into the page cache, up to byte_budget bytes, so that services reloaded onto it start warm.
+        Files shared with the running version are already cached and aren't counted against the budget.
+        Returns (files_warmed, bytes_warmed, files_shared, files_skipped); see angel.util.page_cache.prewarm_files."""
+        if not self.is_version_installed(branch, version):
+            raise angel.exceptions.AngelVersionException("Branch %s, version %s not installed." % (branch, version))
+        paths = []
+        running_path = None
+        if running_branch is not None and running_version is not None and \
+                self.is_version_installed(running_branch, running_version):
+            running_path = self.get_path_for_version(running_branch, running_version)
+            paths = self.record_version_file_usage(running_branch, running_version)
+        seen_paths = set(paths)
+        paths += [path for path in self.get_version_file_usage(branch, version) if path not in seen_paths]
+        return angel.util.page_cache.prewarm_files(self.get_path_for_version(branch, version), paths, byte_budget,
+                                                   shared_with_path=running_path)
+
+
+    def add_version(self, branch, version, path_to_src_code, sleep_ratio=0, workers=None, verify_checksums=False,
+                    algorithm=angel.util.checksum.DEFAULT_CHECKSUM_ALGORITHM, link_workers=None):
         """Add the files at the given path to our version system, hardlink-copying it as given branch and version.
+        If an earlier call for the same version was interrupted, the copy resumes from where that one left off.
         @param branch: branch name, as a string
         @param version: branch version, as a string, in X.Y format; 1.10 is "newer" than 1.9
         @param path_to_src_code: path to code to add to version system
         @param sleep_ratio: ratio of sleep-to-work; useful for background slow installs on loaded systems
+        @param workers: number of processes to use for checksumming files; None for one per cpu
+        @param verify_checksums: re-hash every file instead of trusting the checksum index for unchanged files
+        @param algorithm: checksum algorithm for files that aren't listed in the version's checksum file
+        @param link_workers: number of threads to use for linking files into the new version; None for the default
         """
 
         new_version_path = self.get_path_for_version(branch, version)
 
-        def _first_time_install_logic():
-            # Check if we're a new install:
-            if not os.path.exists(self._get_default_branch_symlink()):
-                # If there's no default branch, then it's a new install:
-                print >>sys.stderr, "Creating default branch/version links and activating version"
-                self.activate_version(branch, version)
-
-            # Check if the default symlinks need creating (on new branches):
-            if not os.path.exists(self._get_default_version_symlink(branch)):
-                print >>sys.stderr, "Creating default version link"
-                self.set_default_version_for_branch(branch, version)
-
         if self.is_version_installed(branch, version):
             # We've seen failure where the version installed but didn't activate,
             # so re-check first-time installs even if version is installed:
-            _first_time_install_logic()
+            self._first_time_install_logic(branch, version)
             raise angel.exceptions.AngelVersionException("Branch %s, version %s already installed" % (branch, version))
 
         # Checksum files, when they exist, contain checksums for files in the src directory, meaning we
         # can skip calculating checksums for those entries.
-        checksum_file = os.path.join(path_to_src_code, '.angel', 'file_checksums')
+        # A binary manifest, when the build wrote one alongside the text one, is faster to load (see angel-get-checksums --binary):
+        checksum_file = os.path.join(path_to_src_code, '.angel', 'file_checksums.bin')
+        if not os.path.isfile(checksum_file):
+            checksum_file = os.path.join(path_to_src_code, '.angel', 'file_checksums')
         src_path_checksum_values = None
         if not os.path.isfile(checksum_file):
             print >>sys.stderr, "Warning: no checksum file at %s" % checksum_file
         else:
             src_path_checksum_values = angel.util.dedup_files.dedup_load_checksum_file(checksum_file)
 
-        # Create a dedup-based copy of the version:
-        angel.util.dedup_files.dedup_create_copy(path_to_src_code,
-                                                 new_version_path,
-                                                 self._get_checksum_hardlink_path(),
-                                                 file_checksums=src_path_checksum_values,
-                                                 sleep_ratio=sleep_ratio)
+        # With a tree manifest of the checksum file (see angel-get-checksums --tree), the files that the dedup dir may not
+        # have yet can be found by comparing it with an installed version's, skipping the dirs they have in common;
+        # every other file in the checksum file is linked without being looked up first:
+        unknown_checksums = None
+        if src_path_checksum_values is not None:
+            tree_manifest = angel.util.tree_manifest.load_tree_manifest(angel.util.tree_manifest.get_tree_manifest_path(
+                os.path.join(path_to_src_code, '.angel', 'file_checksums')))
+            known_tree_manifest = None
+            if tree_manifest is not None:
+                known_tree_manifest = self._get_newest_version_tree_manifest(branch)
+            if known_tree_manifest is not None:
+                unknown_checksums = angel.util.dedup_files.dedup_get_unknown_checksums_in_manifest(src_path_checksum_values,
+                                                                                                   self._get_checksum_hardlink_path(),
+                                                                                                   tree_manifest=tree_manifest,
+                                                                                                   known_tree_manifest=known_tree_manifest)
+
+        # Create a dedup-based copy of the version, re-using checksums of files that haven't changed since a prior install:
+        checksum_index = angel.util.checksum_index.ChecksumIndex(self._get_checksum_index_path(), verify=verify_checksums)
+        try:
+            version_checksums = angel.util.dedup_files.dedup_create_copy(path_to_src_code,
+                                                     new_version_path,
+                                                     self._get_checksum_hardlink_path(),
+                                                     file_checksums=src_path_checksum_values,
+                                                     workers=workers,
+                                                     checksum_index=checksum_index,
+                                                     algorithm=algorithm,
+                                                     io_governor=self._get_io_governor(sleep_ratio),
+                                                     resumable=True,
+                                                     link_workers=link_workers,
+                                                     unknown_checksums=unknown_checksums)
+        finally:
+            checksum_index.save()
+        if checksum_index.mismatches:
+            print >>sys.stderr, "Warning: %s files didn't match their checksum index entries." % checksum_index.mismatches
+
+        self._finish_version_install(branch, version, version_checksums)
+
+
+    def add_version_from_git(self, branch, version, repo_path, ref, sleep_ratio=0, link_workers=None):
+        """Add the tree at the given ref of a git repo (bare or not) as the given branch and version, without checking it
+        out: files the dedup dir doesn't have yet are streamed straight into it from git, and the version is then made
+        of hardlinks to them, as with add_version_from_manifest. Files are keyed by their git blob ids ("git" checksums).
+        @param repo_path: path to the git repo
+        @param ref: the commit, tag, branch or tree to install, in any form git accepts
+        """
+        (file_checksums, symlink_ids) = angel.util.git_checksums.get_git_tree_manifest(repo_path, ref)
+        symlinks = {}
+        if len(symlink_ids):
+            with angel.util.git_checksums.GitObjectReader(repo_path) as git_reader:
+                for path in symlink_ids:
+                    symlinks[path] = git_reader.read_blob(symlink_ids[path])
+        self.add_version_from_manifest(branch, version, file_checksums, blob_source_git_repo=repo_path, symlinks=symlinks,
+                                       sleep_ratio=sleep_ratio, link_workers=link_workers)
+
+
+    def add_version_from_manifest(self, branch, version, file_checksums, blob_source_dir=None, blob_source_fileobj=None,
+                                  blob_source_tar=None, blob_source_git_repo=None, symlinks=None,
+                                  sleep_ratio=0, link_workers=None, tree_manifest=None):
+        """Add a version given only its checksum manifest, copying in just the files that the dedup dir doesn't have yet.
+        @param branch: branch name, as a string
+        @param version: branch version, as a string
+        @param file_checksums: dict of path to checksum (see angel.util.dedup_files.dedup_load_checksum_file); must list dirs too
+        @param blob_source_dir: dir of files named by checksum (e.g. another host's dedup dir) to copy missing files from
+        @param blob_source_fileobj: file object of a tarball of files named by checksum (e.g. stdin), as an alternative to blob_source_dir
+        @param blob_source_tar: an open tarfile.TarFile to read the rest of (e.g. from dedup_open_version_pack), as another alternative
+        @param blob_source_git_repo: path to a git repo to read missing files out of, for manifests of "git" checksums
+        @param symlinks: dict of path to link target of the symlinks in the version, which manifests don't list
+        @param link_workers: number of threads to use for linking files into the new version; None for the default
+        @param sleep_ratio: ratio of sleep-to-work; useful for background slow installs on loaded systems
+        @param tree_manifest: TreeManifest of file_checksums, if there is one; only the files that differ from an installed
+            version are then imported from the blob source, plus any of the rest that the dedup dir turns out not to have
+        """
+        if self.is_version_installed(branch, version):
+            self._first_time_install_logic(branch, version)
+            raise angel.exceptions.AngelVersionException("Branch %s, version %s already installed" % (branch, version))
+        if not len(file_checksums):
+            raise angel.exceptions.AngelVersionException("Empty manifest for branch %s, version %s" % (branch, version))
+        # Manifests and blobs can come from other hosts; check the paths before importing anything:
+        angel.util.dedup_files.dedup_check_manifest(file_checksums, symlinks)
+
+        # Files that are the same as in an installed version should already be in the dedup dir, so only the rest need
+        # importing. "Should": fsck may have quarantined some since, and the tree manifest may not match file_checksums,
+        # so the rest are still checked, and any that are missing are imported too:
+        lookup_checksums = file_checksums
+        if tree_manifest is not None:
+            known_tree_manifest = self._get_newest_version_tree_manifest(branch)
+            if known_tree_manifest is not None:
+                lookup_checksums = angel.util.dedup_files.dedup_get_changed_checksums(tree_manifest, known_tree_manifest)
+                changed_checksum_names = set(lookup_checksums.itervalues())
+                unchanged_checksums = dict([(path, checksum) for (path, checksum) in file_checksums.iteritems()
+                                            if checksum not in changed_checksum_names])
+                missing_checksums = angel.util.dedup_files.dedup_get_unknown_checksums_in_manifest(unchanged_checksums,
+                                                                                                   self._get_checksum_hardlink_path())
+                if len(missing_checksums):
+                    print >>sys.stderr, "Warning: %s files of branch %s, version %s aren't in the dedup dir, though its tree manifest says an installed version has them; importing them too." % \
+                                        (len(missing_checksums), branch, version)
+                    lookup_checksums.update([(path, checksum) for (path, checksum) in unchanged_checksums.iteritems()
+                                             if checksum in missing_checksums])
+
+        start_time = time.time()
+        io_governor = self._get_io_governor(sleep_ratio)
+        if blob_source_dir is not None:
+            (added_count, added_bytes) = angel.util.dedup_files.dedup_import_blobs_from_dir(lookup_checksums, blob_source_dir,
+                                                                                          self._get_checksum_hardlink_path(),
+                                                                                          io_governor=io_governor)
+        elif blob_source_fileobj is not None:
+            (added_count, added_bytes) = angel.util.dedup_files.dedup_import_blobs_from_tarfile(lookup_checksums, blob_source_fileobj,
+                                                                                              self._get_checksum_hardlink_path(),
+                                                                                              io_governor=io_governor)
+        elif blob_source_tar is not None:
+            (added_count, added_bytes) = angel.util.dedup_files.dedup_import_blobs_from_tar(lookup_checksums, blob_source_tar,
+                                                                                          self._get_checksum_hardlink_path(),
+                                                                                          io_governor=io_governor)
+        elif blob_source_git_repo is not None:
+            (added_count, added_bytes) = angel.util.dedup_files.dedup_import_blobs_from_git(lookup_checksums, blob_source_git_repo,
+                                                                                          self._get_checksum_hardlink_path(),
+                                                                                          io_governor=io_governor)
+        else:
+            (added_count, added_bytes) = (0, 0)
+        missing_checksums = angel.util.dedup_files.dedup_get_unknown_checksums_in_manifest(lookup_checksums, self._get_checksum_hardlink_path())
+        if len(missing_checksums):
+            raise angel.exceptions.AngelVersionException("Blob source is missing %s of the files for branch %s, version %s (e.g. %s)" %
+                                                         (len(missing_checksums), branch, version, sorted(missing_checksums)[0]))
+
+        ret_val = angel.util.dedup_files.dedup_create_copy_from_manifest(file_checksums, self.get_path_for_version(branch, version),
+                                                                         self._get_checksum_hardlink_path(), io_governor=io_governor,
+                                                                         symlinks=symlinks, link_workers=link_workers)
+        if ret_val != 0 or not os.path.isdir(self.get_path_for_version(branch, version)):
+            raise angel.exceptions.AngelVersionException("Unable to create branch %s, version %s from manifest (error %s)" %
+                                                         (branch, version, ret_val))
+        print >>sys.stderr, "Installed %s files; copied in %s new files (%s bytes) in %.1f seconds." % \
+                            (len(file_checksums), added_count, added_bytes, time.time() - start_time)
+        self._finish_version_install(branch, version, file_checksums)
+
+
+    def pack_version(self, branch, version, fileobj, base_version=None):
+        """Write a version pack of the given version to fileobj: its manifest plus only the files that a host with
+        base_version installed doesn't have (or every file, without a base); see angel.util.dedup_files.dedup_write_version_pack.
+        Returns (files_written, bytes_written)."""
+        file_checksums = self.get_version_manifest(branch, version)
+        if file_checksums is None:
+            raise angel.exceptions.AngelVersionException("No manifest for branch %s, version %s" % (branch, version))
+        base_checksums = None
+        if base_version is not None:
+            base_checksums = self.get_version_manifest(branch, base_version)
+            if base_checksums is None:
+                raise angel.exceptions.AngelVersionException("No manifest for branch %s, version %s" % (branch, base_version))
+        return angel.util.dedup_files.dedup_write_version_pack(fileobj, file_checksums, self._get_checksum_hardlink_path(),
+                                                               base_checksums=base_checksums,
+                                                               pack_info={'branch': branch, 'version': version, 'base': base_version or '-'},
+                                                               io_governor=self._get_io_governor())
+
+
+    def unpack_version(self, fileobj, branch=None, version=None, sleep_ratio=0):
+        """Install a version from a version pack (see pack_version) read sequentially from fileobj; new files are streamed
+        straight into the dedup dir. The branch and version recorded in the pack are used unless given. The pack's base
+        version (or at least its files) must already be installed. Returns (branch, version)."""
+        (tar, pack_info, file_checksums) = angel.util.dedup_files.dedup_open_version_pack(fileobj)
+        try:
+            if branch is None:
+                branch = pack_info.get('branch')
+            if version is None:
+                version = pack_info.get('version')
+            if branch is None or version is None:
+                raise angel.exceptions.AngelVersionException("Version pack doesn't say which branch and version it is")
+            base_version = pack_info.get('base', '-')
+            if base_version != '-' and not self.is_version_installed(branch, base_version):
+                print >>sys.stderr, "Warning: version pack is relative to branch %s, version %s, which isn't installed; " \
+                                    "some files may be missing." % (branch, base_version)
+            self.add_version_from_manifest(branch, version, file_checksums, blob_source_tar=tar, sleep_ratio=sleep_ratio)
+        finally:
+            tar.close()
+        return (branch, version)
 
-        # Add the versions_dir info into the versions .angel directory:
-        open(os.path.join(new_version_path,".angel","versions_dir"), "w").write(self._versions_dir)
+
+    def _finish_version_install(self, branch, version, version_checksums):
+        """Record the manifest and versions_dir info of a newly-created version, and activate it if it's the first one."""
+        # Record what the version links to, so that deleting it only has to check those dedup files:
+        manifest_path = self._get_version_manifest_path(branch, version)
+        try:
+            if not os.path.isdir(os.path.dirname(manifest_path)):
+                os.makedirs(os.path.dirname(manifest_path))
+            angel.util.dedup_files.dedup_write_checksum_file(manifest_path, version_checksums)
+        except (IOError, OSError) as e:
+            print >>sys.stderr, "Warning: unable to write version manifest %s (%s); deleting this version will require a full dedup sweep." % (manifest_path, e)
+        # ...and its tree manifest, so that later versions can be compared against it dir by dir:
+        tree_manifest_path = angel.util.tree_manifest.get_tree_manifest_path(manifest_path)
+        try:
+            angel.util.tree_manifest.write_tree_manifest(tree_manifest_path, version_checksums)
+        except (IOError, OSError) as e:
+            print >>sys.stderr, "Warning: unable to write version tree manifest %s (%s); installs and diffs against this version will be slower." % (tree_manifest_path, e)
+
+        # Add the versions_dir info into the versions .angel directory; unlink any existing copy first, as it'd be a hardlink into the dedup dir:
+        versions_dir_file = os.path.join(self.get_path_for_version(branch, version), ".angel", "versions_dir")
+        if os.path.lexists(versions_dir_file):
+            os.remove(versions_dir_file)
+        if not os.path.isdir(os.path.dirname(versions_dir_file)):
+            os.mkdir(os.path.dirname(versions_dir_file))
+        open(versions_dir_file, "w").write(self._versions_dir)
+
+        # Record the new version in the version catalog:
+        size = 0
+        file_count = 0
+        for checksum in version_checksums.itervalues():
+            info = angel.util.dedup_files.dedup_get_info_from_checksum(checksum)
+            if info is not None and not stat.S_ISDIR(info['mode']):
+                size += info['size']
+                file_count += 1
+        self._get_version_catalog().update_branch(branch, [{'version': version,
+                                                            'sort_key': angel.util.version_catalog.get_version_sort_key(version),
+                                                            'install_time': os.stat(self.get_path_for_version(branch, version)).st_mtime,
+                                                            'size': size,
+                                                            'file_count': file_count,
+                                                            'downgrade_to': None}])
 
         # Check and run any first-time install logic:
-        _first_time_install_logic()
+        self._first_time_install_logic(branch, version)
+
+
+    def _first_time_install_logic(self, branch, version):
+        # Check if we're a new install:
+        if not os.path.exists(self._get_default_branch_symlink()):
+            # If there's no default branch, then it's a new install:
+            print >>sys.stderr, "Creating default branch/version links and activating version"
+            self.activate_version(branch, version)
+
+        # Check if the default symlinks need creating (on new branches):
+        if not os.path.exists(self._get_default_version_symlink(branch)):
+            print >>sys.stderr, "Creating default version link"
+            self.set_default_version_for_branch(branch, version)
 
 
     def exec_command_with_version(self, branch, version, command, args, env=None):
@@ -165,18 +565,7 @@ class AngelVersionManager():
         branches_dir = os.path.join(self._versions_dir, branch)
         if not os.path.isdir(branches_dir):
             raise angel.exceptions.AngelVersionException("Unknown branch '%s'" % branch)
-        dirs = glob.glob("%s/[0-9]*" % (branches_dir))
-        # Versions are X[.Y], this will capture all names whose first character is 0-9 to skip our _default symlink
-        versions = ()
-        for dir in dirs:
-            versions += (os.path.basename(dir),)
-        def sort_function(x,y):
-            if x == y:
-                return 0
-            if self.is_version_newer(x,y):
-                return -1
-            return 1
-        return sorted(versions, cmp=sort_function)
+        return [entry['version'] for entry in self._get_version_catalog().get_entries(branch, branches_dir)]
 
 
     def _get_path_for_branch(self, branch):
@@ -208,14 +597,17 @@ class AngelVersionManager():
 
     def get_highest_installed_version_number(self, branch):
         """Return the highest locally installed version number for the given branch; throws exception if not found."""
-        available_versions = self.get_available_installed_versions(branch)
-        if 0 == len(available_versions):
+        entries = self._get_version_catalog().get_entries(branch, self._get_path_for_branch(branch))
+        if 0 == len(entries):
             raise angel.exceptions.AngelVersionException("No versions found for branch %s" % branch)
-        return available_versions[-1]
+        return entries[-1]['version']
 
 
-    def delete_version(self, branch, version, delete_even_if_in_use=False):
-        """Delete the given version from the system; throws exception if version is in use or not found."""
+    def delete_version(self, branch, version, delete_even_if_in_use=False, in_background=False):
+        """Delete the given version from the system; throws exception if version is in use or not found.
+        The version is moved into the trash (see get_trash), which is atomic; its files and any dedup files that only it
+        used are then removed by empty_trash(). If in_background is True, that's left to the caller (e.g. to run from a
+        background worker), so this returns at once; otherwise empty_trash() is called before returning."""
         if not self.is_version_installed(branch, version):
             raise angel.exceptions.AngelVersionException("Version %s not installed." % version)
         if not delete_even_if_in_use:
@@ -236,15 +628,26 @@ class AngelVersionManager():
             if not os.path.isdir(self._versions_dir):
                 print >>sys.stderr, "Missing branches dir during delete version?! (%s)" % self._versions_dir
                 raise angel.exceptions.AngelVersionException("Missing versions dir")
-            # Move the version to an invalid version path so that it's not accidentally used during delete:
-            version_dir_deletion_path = os.path.join(self._versions_dir, branch, "_deleteing_%s" % (version))
-            os.rename(version_dir, version_dir_deletion_path)
-            shutil.rmtree(version_dir_deletion_path)
-            try:
-                angel.util.dedup_files.remove_unused_links(self._get_checksum_hardlink_path())
-            except Exception as e:
-                # On the off-chance that another process is also cleaning up, we ignore dedup issues.
-                print >>sys.stderr, "Warning: unable to clean up dedup links while deleting branch %s, version %s (%s); ignoring." % (branch, version, e)
+            # Queue up cleaning the version's dedup files once the trash entry is gone, then move the version into the trash.
+            # The manifest is linked (not moved) first, so that a crash at any point leaves either the version installed
+            # with its manifest, or the trash entry with a pending GC entry. Versions installed before manifests were
+            # recorded get an empty GC entry, which means a sweep of the entire dedup dir.
+            trash = self.get_trash()
+            trash_entry_name = trash.make_entry_name(version_dir)
+            if not os.path.isdir(self._get_pending_gc_dir()):
+                os.makedirs(self._get_pending_gc_dir())
+            pending_gc_path = os.path.join(self._get_pending_gc_dir(), trash_entry_name)
+            manifest_path = self._get_version_manifest_path(branch, version)
+            if os.path.isfile(manifest_path):
+                os.link(manifest_path, pending_gc_path)
+            else:
+                open(pending_gc_path, 'w').close()
+            trash.move_to_trash(version_dir, trash_entry_name)
+            self._get_version_catalog().update_branch(branch)
+            for path in (manifest_path, angel.util.tree_manifest.get_tree_manifest_path(manifest_path),
+                         self._get_version_file_usage_path(branch, version)):
+                if os.path.isfile(path):
+                    os.remove(path)
         except Exception as e:
             raise angel.exceptions.AngelUnexpectedException("Error deleting branch %s, version %s (%s: %s)" % (branch, version, version_dir, e))
         finally:
@@ -253,6 +656,47 @@ class AngelVersionManager():
         if _delete_version_ignore_handler_triggered:
             raise KeyboardInterrupt
         del _delete_version_ignore_handler_triggered
+        if not in_background:
+            self.empty_trash()
+
+
+    def empty_trash(self, io_governor=None, max_seconds=None):
+        """Remove deleted versions from the trash, then the dedup files that only they used. Safe to interrupt at any
+        point; the next call picks up where this one stopped. Returns True if nothing is left to do."""
+        if io_governor is None:
+            io_governor = self._get_io_governor()
+        start_time = time.time()
+        (removed_entries, is_complete) = self.get_trash().empty(io_governor=io_governor, max_seconds=max_seconds)
+        if not os.path.isdir(self._get_pending_gc_dir()):
+            return is_complete
+        trash = self.get_trash()
+        removed_count = 0
+        removed_bytes = 0
+        for name in sorted(os.listdir(self._get_pending_gc_dir())):
+            if trash.has_entry(name):
+                continue  # Its files still link to the dedup files
+            pending_gc_path = os.path.join(self._get_pending_gc_dir(), name)
+            try:
+                version_checksums = None
+                if os.path.getsize(pending_gc_path):
+                    version_checksums = angel.util.dedup_files.dedup_load_checksum_file(pending_gc_path)
+                if version_checksums is not None:
+                    (count, size) = angel.util.dedup_files.remove_unused_links_in_manifest(self._get_checksum_hardlink_path(),
+                                                                                           version_checksums,
+                                                                                           io_governor=io_governor)
+                else:
+                    (count, size, is_sweep_complete) = angel.util.dedup_files.remove_unused_links(self._get_checksum_hardlink_path(),
+                                                                                                   io_governor=io_governor)
+                removed_count += count
+                removed_bytes += size
+                os.remove(pending_gc_path)
+            except Exception as e:
+                # On the off-chance that another process is also cleaning up, we ignore dedup issues.
+                print >>sys.stderr, "Warning: unable to clean up dedup links of deleted version %s (%s); ignoring." % (name, e)
+        if removed_entries or removed_count:
+            print >>sys.stderr, "Removed %s deleted versions and reclaimed %s bytes from %s unused dedup files in %.1f seconds." % \
+                                (removed_entries, removed_bytes, removed_count, time.time() - start_time)
+        return is_complete
 
 
     def _get_default_branch_symlink(self):
@@ -312,11 +756,11 @@ class AngelVersionManager():
             raise angel.exceptions.AngelVersionException("Failed to unpin system (%s)." % (e))
 
 
-    def is_branch_in_use(self, branch):
-        """Return true if the given branch is actively or potentially in-use."""
+    def is_branch_in_use(self, branch, open_path_index=None):
+        """Return true if the given branch is actively or potentially in-use. See get_open_path_index for open_path_index."""
         if self.get_default_branch() == branch:
             return True
-        if angel.util.file.is_path_in_use(self._get_path_for_branch(branch)):
+        if angel.util.file.is_path_in_use(self._get_path_for_branch(branch), open_path_index=open_path_index):
             return True
         return False
 
@@ -332,7 +776,12 @@ class AngelVersionManager():
         if version is None or branch is None:
             return False
         try:
+            angel.util.version_catalog.get_version_sort_key(version)
+        except ValueError:
+            # Not something the catalog can sort, so it won't list it; check on disk:
             return os.path.isdir(os.path.join(self._versions_dir, branch, version, ".angel"))
+        try:
+            return self.get_version_catalog_entry(branch, version) is not None
         except:
             return False
 
@@ -348,41 +797,189 @@ class AngelVersionManager():
         return False
 
 
-    def is_version_in_use_by_processes(self, branch, version):
+    def get_open_path_index(self):
+        """Return a snapshot of the files running processes have open (see angel.util.file.OpenPathIndex). Checking
+        many versions for use one at a time rescans /proc for each; pass one index to each check instead."""
+        return angel.util.file.OpenPathIndex()
+
+
+    def is_version_in_use_by_processes(self, branch, version, open_path_index=None):
         """Return true if the given branch/version is actively running processes."""
-        return angel.util.file.is_path_in_use(self.get_path_for_version(branch, version))
+        return angel.util.file.is_path_in_use(self.get_path_for_version(branch, version), open_path_index=open_path_index)
 
 
-    def is_version_in_use(self, branch, version):
+    def is_version_in_use(self, branch, version, open_path_index=None):
         """Return true if the given version of the given branch is actively or potentially in-use, including set as
         the default version for the branch."""
         if self.get_default_version(branch) == version:
             return True
-        if self.is_version_in_use_by_processes(branch, version):
+        if self.is_version_in_use_by_processes(branch, version, open_path_index=open_path_index):
             return True
         return False
 
 
-    def delete_stale_versions(self, branch, keep_newest_n_versions, limit=3):
+    def delete_stale_versions(self, branch, keep_newest_n_versions, limit=3, in_background=False):
         """Delete up to <limit> unused versions of given branch, without ever deleting anything in the N newest versions.
-        Always excludes the running and default versions, so after this there may be still be more than N versions."""
+        Always excludes the running and default versions, so after this there may be still be more than N versions.
+        See delete_version for in_background."""
         versions = self.get_available_installed_versions(branch)
         if len(versions) <= keep_newest_n_versions:
             return
         versions = versions[:-keep_newest_n_versions]
+        open_path_index = self.get_open_path_index()
         for version in versions:
             if limit <= 0:
                 return
-            if not self.is_version_in_use(branch, version):
-                self.delete_version(branch, version, delete_even_if_in_use=True)  # Skip re-checking if it's in use
+            if not self.is_version_in_use(branch, version, open_path_index=open_path_index):
+                self.delete_version(branch, version, delete_even_if_in_use=True, in_background=in_background)  # Skip re-checking if it's in use
                 limit -= 1
 
 
-    # Disabling this -- now that we're tucking the .gitcheckout dir under the versioned path, deduping the
-    # innards of ".gitcheckout/.git" might be really, really bad; we need to add an "exclude" pattern match for this
-    #def dedup_files(self, sleep_ratio=0):
-    #    '''Dedup versioned files; where sleep ratio of 0 is no sleep at all, and at 1, very little work is done.'''
-    #    return angel.util.dedup_files.dedup_files(self._versions_dir, sleep_ratio=sleep_ratio)
+    def remove_unused_dedup_files(self, max_seconds=None, sleep_ratio=0):
+        """Sweep the entire dedup dir for files no version links to; deleting a version normally takes care of this, but
+        a sweep catches anything missed (e.g. an interrupted delete). With max_seconds, the sweep stops after roughly that
+        long and the next call resumes it. Returns (files_removed, bytes_removed, is_complete)."""
+        if not os.path.isdir(self._get_checksum_hardlink_path()):
+            return (0, 0, True)
+        return angel.util.dedup_files.remove_unused_links(self._get_checksum_hardlink_path(),
+                                                          max_seconds=max_seconds, io_governor=self._get_io_governor(sleep_ratio))
+
+
+    def fsck(self, sample_ratio=None, workers=None, max_seconds=None, sleep_ratio=0):
+        """Check the dedup files against their checksums, quarantining any that don't match; see
+        angel.util.dedup_files.dedup_fsck for the args and returned dict. The returned dict also has 'bad_versions': a
+        dict of bad checksum name -> list of (branch, version) of the installed versions that link to it."""
+        if not os.path.isdir(self._get_checksum_hardlink_path()):
+            return {'files': 0, 'bytes': 0, 'bad': {}, 'bad_versions': {}, 'seconds': 0, 'is_complete': True}
+        ret_val = angel.util.dedup_files.dedup_fsck(self._get_checksum_hardlink_path(), sample_ratio=sample_ratio, workers=workers,
+                                                    max_seconds=max_seconds, io_governor=self._get_io_governor(sleep_ratio))
+        ret_val['bad_versions'] = self.get_versions_using_dedup_files(ret_val['bad'].keys())
+        return ret_val
+
+
+    def get_space_usage(self, keep_newest_n_versions=None):
+        """Return how much disk each installed version costs, from the version manifests and the link counts of the dedup
+        files they use; version trees aren't walked, so this takes time in proportion to the size of the manifests.
+        Returns (versions, candidates_reclaimable_bytes): versions is a list of dicts, one per version, with keys:
+          branch, version
+          files, bytes: number and total size of files in the version (None if the version has no manifest)
+          unique_bytes: size of files in dedup files that no other version's manifest lists
+          shared_bytes: size of files in dedup files that other versions' manifests list as well
+          reclaimable_bytes: size of the dedup files that deleting just this version would free (i.e. nothing else
+            links to them, going by their link counts)
+          is_purge_candidate: True if delete_stale_versions could delete it (with keep_newest_n_versions, if given)
+        candidates_reclaimable_bytes is what deleting all purge candidates would free."""
+        blob_store = angel.util.blob_store.DedupBlobStore(self._get_checksum_hardlink_path())
+        aliases = blob_store.get_aliases()
+        open_path_index = self.get_open_path_index()
+        versions = []
+        version_links = []  # Per version: dict of dedup file name -> number of links to it in the version
+        links_by_blob = {}  # Dedup file name -> number of links to it from all versions' manifests
+        for branch in self.get_available_installed_branches():
+            branch_versions = self.get_available_installed_versions(branch)
+            for (i, version) in enumerate(branch_versions):
+                is_purge_candidate = not self.is_version_in_use(branch, version, open_path_index=open_path_index)
+                if keep_newest_n_versions is not None and i >= len(branch_versions) - keep_newest_n_versions:
+                    is_purge_candidate = False
+                version_checksums = self.get_version_manifest(branch, version)
+                links = {}
+                if version_checksums is None:
+                    print >>sys.stderr, "Warning: no manifest for branch %s, version %s; its size is unknown, and files it shares count as used." % (branch, version)
+                else:
+                    for checksum in version_checksums.itervalues():
+                        if checksum.startswith('0.'):
+                            continue  # '0.' entries are dirs
+                        name = aliases.get(checksum, checksum)
+                        links[name] = links.get(name, 0) + 1
+                    for name in links:
+                        links_by_blob[name] = links_by_blob.get(name, 0) + links[name]
+                versions.append({'branch': branch, 'version': version, 'is_purge_candidate': is_purge_candidate,
+                                 'files': None, 'bytes': None, 'unique_bytes': None, 'shared_bytes': None,
+                                 'reclaimable_bytes': None})
+                version_links.append(links if version_checksums is not None else None)
+
+        # Links that no manifest accounts for (a version without a manifest, or anything else) show up in the link count:
+        blob_nlinks = {}
+        for name in links_by_blob:
+            path = blob_store.find(name)
+            try:
+                blob_nlinks[name] = os.lstat(path).st_nlink if path is not None else None
+            except OSError:
+                blob_nlinks[name] = None
+
+        candidate_links = {}
+        for (usage, links) in zip(versions, version_links):
+            if links is None:
+                continue
+            usage.update({'files': 0, 'bytes': 0, 'unique_bytes': 0, 'shared_bytes': 0, 'reclaimable_bytes': 0})
+            for (name, count) in links.items():
+                size = angel.util.dedup_files.dedup_get_info_from_checksum(name)['size']
+                usage['files'] += count
+                usage['bytes'] += size * count
+                if links_by_blob[name] == count:
+                    usage['unique_bytes'] += size
+                else:
+                    usage['shared_bytes'] += size
+                # The dedup dir's own link, plus this version's:
+                if blob_nlinks[name] is not None and blob_nlinks[name] <= 1 + count:
+                    usage['reclaimable_bytes'] += size
+                if usage['is_purge_candidate']:
+                    candidate_links[name] = candidate_links.get(name, 0) + count
+        candidates_reclaimable_bytes = 0
+        for (name, count) in candidate_links.items():
+            if blob_nlinks[name] is not None and blob_nlinks[name] <= 1 + count:
+                candidates_reclaimable_bytes += angel.util.dedup_files.dedup_get_info_from_checksum(name)['size']
+        return (versions, candidates_reclaimable_bytes)
+
+
+    def get_versions_using_dedup_files(self, checksum_names):
+        """Return a dict of each of the given dedup file names -> list of (branch, version) of installed versions whose
+        manifests list it (under its current name or a name it had before a checksum migration)."""
+        ret_val = dict([(name, []) for name in checksum_names])
+        if not len(ret_val):
+            return ret_val
+        aliases = angel.util.blob_store.DedupBlobStore(self._get_checksum_hardlink_path()).get_aliases()
+        for branch in self.get_available_installed_branches():
+            for version in self.get_available_installed_versions(branch):
+                version_checksums = self.get_version_manifest(branch, version)
+                if version_checksums is None:
+                    print >>sys.stderr, "Warning: no manifest for branch %s, version %s; can't tell if it uses the given dedup files." % (branch, version)
+                    continue
+                for checksum in set(version_checksums.itervalues()):
+                    name = aliases.get(checksum, checksum)
+                    if name in ret_val:
+                        ret_val[name].append((branch, version))
+        return ret_val
+
+
+    def migrate_checksum_algorithm(self, algorithm, sleep_ratio=0, max_seconds=None):
+        """Rename legacy md5-named dedup files to use the given checksum algorithm; returns the number of files left to migrate."""
+        if not os.path.isdir(self._get_checksum_hardlink_path()):
+            return 0
+        return angel.util.dedup_files.dedup_migrate_hardlinks(self._get_checksum_hardlink_path(), algorithm,
+                                                              max_seconds=max_seconds, io_governor=self._get_io_governor(sleep_ratio))
+
+
+    def migrate_dedup_layout(self, sleep_ratio=0, max_seconds=None):
+        """Move dedup files from the legacy flat dir into fan-out subdirs; returns the number of files left to migrate."""
+        if not os.path.isdir(self._get_checksum_hardlink_path()):
+            return 0
+        return angel.util.blob_store.DedupBlobStore(self._get_checksum_hardlink_path()).migrate_flat_layout(max_seconds=max_seconds,
+                                                                                                             io_governor=self._get_io_governor(sleep_ratio))
+
+
+    def dedup_files(self, sleep_ratio=0):
+        """Hardlink identical files across installed versions that don't already share a dedup file (e.g. files
+        created after install); where sleep ratio of 0 is no sleep at all, and at 1, very little work is done.
+        The dedup dir and version data are skipped, as are the innards of ".gitcheckout" dirs (deduping ".gitcheckout/.git"
+        might be really, really bad) and partially-installed or -deleted versions.
+        Files that link to a dedup file are left alone (others can be linked to them), so that the version manifests
+        recording those links stay accurate for cleaning up the dedup dir."""
+        return angel.util.dedup_files.dedup_files(self._versions_dir,
+                                                  exclude=('.angel_version_data/', '*/.gitcheckout/*',
+                                                           '*/.dedup_creating_*', '*/_deleteing_*'),
+                                                  io_governor=self._get_io_governor(sleep_ratio),
+                                                  keep_external_links=True)
 
 
     def is_version_newer(self, a, b):
@@ -394,22 +991,7 @@ class AngelVersionManager():
         if a == b:
             return False
         try:
-            a_parts = a.split('.')
-            b_parts = b.split('.')
-            while len(a_parts) or len(b_parts):
-                this_a = 0
-                this_b = 0
-                if len(a_parts):
-                    this_a = int(a_parts[0])
-                    a_parts.pop(0)
-                if len(b_parts):
-                    this_b = int(b_parts[0])
-                    b_parts.pop(0)
-                if this_b > this_a:
-                    return True
-                if this_b < this_a:
-                    return False
-            return False
+            return angel.util.version_catalog.get_version_sort_key(b) > angel.util.version_catalog.get_version_sort_key(a)
         except Exception as e:
             raise angel.exceptions.AngelUnexpectedException("Invalid versions in comparison of '%s' to '%s' (%s)." % (a, b, e))
 
@@ -464,6 +1046,11 @@ class AngelVersionManager():
         except Exception as e:
             raise angel.exceptions.AngelVersionException("Unable to set downgrade version (file %s; error %s)" %
                                                          (downgrade_control_file, e))
+        entry = self.get_version_catalog_entry(branch, downgrade_from_version)
+        if entry is not None:
+            entry = dict(entry)
+            entry['downgrade_to'] = str(downgrade_to_version)
+            self._get_version_catalog().update_branch(branch, [entry])
 
 
     def set_default_branch(self, branch, force=False):
@@ -9,6 +9,7 @@ import sys
 import time
 
 import angel.util.checksum
+import angel.util.tree_walk
 
 
 def devops_build_cache_create(name, checksum, input_dir):
@@ -161,10 +162,14 @@ def get_latest_mtime(path):
         return os.stat(path).st_mtime
     if os.path.isdir(path):
         newest_mtime = 0
-        for entry in os.listdir(path):
-            m = get_latest_mtime('%s/%s' % (path, entry))
-            if m > newest_mtime:
-                newest_mtime = m
+        for (dir_path, dir_entries, file_entries) in angel.util.tree_walk.walk_tree(path, follow_symlinks=True):
+            for entry in file_entries:
+                if not entry.is_file():
+                    print >>sys.stderr, "Error: get_latest_mtime given invalid path '%s'." % entry.path
+                    continue
+                m = entry.stat().st_mtime
+                if m > newest_mtime:
+                    newest_mtime = m
         return newest_mtime
     print >>sys.stderr, "Error: get_latest_mtime given invalid path '%s'." % path
     return None